@@ -0,0 +1,69 @@
+"""
+Measure the startup cost of a zogy worker: the time needed to import zogy,
+and the extra import time of the optional modules needed by each
+configuration. Every measurement is done in a fresh interpreter, as the
+modules are cached after the first import.
+
+Usage: python Bench/startup.py [--repeat N]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# configuration name and the optional modules it needs on top of zogy
+configs = [('core', []),
+           ('fratio (any full run)', ['astropy.io.ascii']),
+           ('astrometry.net WCS', ['sip_tpv']),
+           ('make_plots', ['matplotlib.pyplot']),
+           ('bkg_method=4', ['photutils']),
+           ('psffit', ['lmfit']),
+           ('all', ['astropy.io.ascii', 'sip_tpv', 'matplotlib.pyplot',
+                    'photutils', 'lmfit'])]
+
+code = """
+import time, json, importlib
+t0 = time.time()
+import zogy
+t1 = time.time()
+for module in {modules}:
+    importlib.import_module(module)
+t2 = time.time()
+print json.dumps([t1-t0, t2-t1])
+"""
+
+"""
+Run the imports of one configuration in a new interpreter, and return
+the time spent importing zogy, importing the optional modules and the
+total wall-time of the process, including the interpreter startup.
+"""
+def measure(modules, repoDir):
+
+    t = time.time()
+    output = subprocess.check_output([sys.executable, '-c', code.format(modules=repr(modules))],
+                                     cwd=repoDir)
+    wallTime = time.time() - t
+    zogyTime, optTime = json.loads(output.strip().split('\n')[-1])
+    return zogyTime, optTime, wallTime
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Measure the import time of zogy configurations')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measurements per configuration')
+    args = parser.parse_args()
+
+    repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    print '{:24s} {:>10s} {:>10s} {:>10s}'.format('configuration', 'zogy [s]', 'extra [s]', 'process [s]')
+    for name, modules in configs:
+        times = np.array([measure(modules, repoDir) for i in range(args.repeat)])
+        zogyTime, optTime, wallTime = np.median(times, axis=0)
+        print '{:24s} {:10.3f} {:10.3f} {:10.3f}'.format(name, zogyTime, optTime, wallTime)
+
+if __name__ == "__main__":
+    main()
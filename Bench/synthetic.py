@@ -0,0 +1,363 @@
+"""
+Benchmark of the numpy stages of zogy on synthetic new/ref image pairs.
+
+For each configuration (image size), a reference and a new image are
+generated with Gaussian PSFs of known width, a sloped sky background,
+Gaussian-approximated Poisson and read noise, a field of stars and, in
+the new image only, a number of injected transients. The external tools
+are not used: the PSFEx output (.psf file) is written directly from the
+known PSF, and the object mask that SExtractor would produce is derived
+from the noiseless star field.
+
+The following stages are timed with the instrumentation of zogy (see
+zogy.Spans): reading the subimages from disk (read_fits_tile), get_back,
+get_psf (new and ref), get_optflux_xycoords on all stars of the new image,
+run_ZOGY on each subimage and write_products. For each stage the wall
+time, the throughput in Mpix/s of the full image and the peak resident
+memory of the process are reported, as well as the fraction of the
+transients that is recovered in Scorr. Each configuration is run in a
+separate process, so that the peak memory of one does not carry over to
+the next.
+
+Usage: python Bench/synthetic.py [--configs decam,meerlicht]
+                                 [--baseline FILE] [--save-baseline FILE]
+                                 [--tolerance 0.2] [--output FILE]
+
+With --baseline, the wall time of each stage is compared to the stored
+one, and the script exits with status 1 if any stage is slower by more
+than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import astropy.io.fits as fits
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+import zogy
+
+# benchmark configurations: image size (ysize, xsize), zogy settings
+# and the properties of the synthetic images
+configs = {
+    'decam': {'shape': (4096, 2048), 'telescope': 'Decam',
+              'fwhm_new': 4.0, 'fwhm_ref': 3.2, 'sky': 800., 'readnoise': 7.,
+              'nstars': 1500, 'ntransients': 20},
+    'meerlicht': {'shape': (10560, 10560), 'telescope': None,
+                  'fwhm_new': 5.0, 'fwhm_ref': 4.0, 'sky': 300., 'readnoise': 10.,
+                  'nstars': 20000, 'ntransients': 100},
+}
+
+# stages that are reported, in this order
+stages = ['read_fits_tile', 'get_back', 'get_psf', 'get_optflux_xycoords',
+          'run_ZOGY', 'write_products']
+
+"""
+Return a normalized 2D Gaussian with FWHM [fwhm] centered at [x0],[y0] on
+a grid of [size] x [size] pixels, sampled every [samp] pixels.
+"""
+def gaussStamp(size, fwhm, x0=0., y0=0., samp=1.):
+
+    sigma = fwhm / 2.355 / samp
+    coords = np.arange(size) - size/2
+    gx = np.exp(-0.5 * ((coords - x0/samp) / sigma)**2)
+    gy = np.exp(-0.5 * ((coords - y0/samp) / sigma)**2)
+    stamp = np.outer(gy, gx)
+    return stamp / np.sum(stamp)
+
+"""
+Add stars with fluxes [flux] at positions [x], [y] to [image], using a
+Gaussian PSF with FWHM [fwhm].
+"""
+def addStars(image, x, y, flux, fwhm):
+
+    size = int(6*fwhm) | 1
+    hsize = size/2
+    ysize, xsize = image.shape
+    for i in range(len(x)):
+        xint, yint = int(round(x[i])), int(round(y[i]))
+        stamp = flux[i] * gaussStamp(size, fwhm, x[i]-xint, y[i]-yint)
+        y1, y2 = max(0, yint-hsize), min(ysize, yint+hsize+1)
+        x1, x2 = max(0, xint-hsize), min(xsize, xint+hsize+1)
+        image[y1:y2, x1:x2] += stamp[y1-(yint-hsize):y2-(yint-hsize),
+                                     x1-(xint-hsize):x2-(xint-hsize)]
+
+"""
+Write a PSFEx-format .psf file describing a Gaussian PSF with FWHM
+[fwhm] for an image of [shape], with a weak quadratic (POLDEG=2) spatial
+variation of the width, so that the evaluation of the polynomial in
+get_psf and get_psf_xycoords is exercised.
+"""
+def writePSFEx(fileName, fwhm, shape, psfRadius=5, samp=1.):
+
+    sizeConfig = int(2*psfRadius*fwhm/samp) | 1
+    ncomp = 6
+    comps = np.zeros((ncomp, sizeConfig, sizeConfig), dtype='float32')
+    comps[0] = gaussStamp(sizeConfig, fwhm, samp=samp)
+    variation = gaussStamp(sizeConfig, 1.1*fwhm, samp=samp) - comps[0]
+    # components in order 1, x, x**2, y, x*y, y**2
+    comps[1] = 0.1 * variation
+    comps[3] = 0.1 * variation
+
+    col = fits.Column(name='PSF_MASK', format='{}E'.format(comps.size),
+                      dim='({},{},{})'.format(sizeConfig, sizeConfig, ncomp),
+                      array=comps[np.newaxis])
+    hdu = fits.BinTableHDU.from_columns([col])
+    header = hdu.header
+    header['POLNAXIS'] = 2
+    header['POLGRP1'] = 1
+    header['POLNAME1'] = 'X_IMAGE'
+    header['POLZERO1'] = shape[1]/2.
+    header['POLSCAL1'] = float(shape[1])
+    header['POLGRP2'] = 1
+    header['POLNAME2'] = 'Y_IMAGE'
+    header['POLZERO2'] = shape[0]/2.
+    header['POLSCAL2'] = float(shape[0])
+    header['POLNGRP'] = 1
+    header['POLDEG1'] = 2
+    header['PSF_FWHM'] = fwhm
+    header['PSF_SAMP'] = samp
+    header['PSFNAXIS'] = 3
+    header['PSFAXIS1'] = sizeConfig
+    header['PSFAXIS2'] = sizeConfig
+    header['PSFAXIS3'] = ncomp
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fileName, clobber=True)
+
+"""
+Generate the synthetic new and ref images of configuration [conf] in
+[workDir] and return a dictionary with the file names, the noiseless
+star field and background, the star and transient positions.
+"""
+def makeImages(conf, workDir, seed=1):
+
+    np.random.seed(seed)
+    ysize, xsize = conf['shape']
+    yy, xx = np.mgrid[0:ysize, 0:xsize].astype('float32')
+    sky = (conf['sky'] * (1. + 0.1*xx/xsize + 0.05*yy/ysize)).astype('float32')
+    del xx, yy
+
+    nstars = conf['nstars']
+    xstar = np.random.uniform(10, xsize-10, nstars)
+    ystar = np.random.uniform(10, ysize-10, nstars)
+    # power-law distribution of fluxes
+    fluxStar = 2e3 * (1. - np.random.rand(nstars))**-1.5
+
+    sim = {'sky': sky, 'xstar': xstar, 'ystar': ystar}
+    for imtype in ['ref', 'new']:
+        fwhm = conf['fwhm_'+imtype]
+        stars = np.zeros((ysize, xsize), dtype='float32')
+        addStars(stars, xstar, ystar, fluxStar, fwhm)
+        if imtype == 'new':
+            sim['stars'] = stars
+        model = sky + stars
+        if imtype == 'new':
+            # transients within the area covered by the subimages
+            ntrans = conf['ntransients']
+            size = conf['subimage_size']
+            ycover, xcover = (ysize/size)*size, (xsize/size)*size
+            xtrans = np.random.uniform(20, xcover-20, ntrans)
+            ytrans = np.random.uniform(20, ycover-20, ntrans)
+            # flux of a S/N~20 point source on top of the sky
+            fluxTrans = 20. * np.sqrt(4*np.pi*(fwhm/2.355)**2 *
+                                      (conf['sky'] + conf['readnoise']**2)) * np.ones(ntrans)
+            addStars(model, xtrans, ytrans, fluxTrans, fwhm)
+            sim['xtrans'], sim['ytrans'] = xtrans, ytrans
+            noiseScale = 1.
+        else:
+            # the ref is a deeper stack
+            noiseScale = 0.5
+        noise = np.random.normal(size=(ysize, xsize)).astype('float32')
+        noise *= noiseScale * np.sqrt(model + conf['readnoise']**2)
+        image = model + noise
+        del noise, model
+
+        fileName = os.path.join(workDir, imtype+'.fits')
+        header = fits.Header()
+        header['GAIN'] = 1.
+        header['RDNOISE'] = conf['readnoise']
+        header['SEEING'] = fwhm
+        fits.writeto(fileName, image, header, clobber=True)
+        writePSFEx(fileName.replace('.fits', '.psf'), fwhm, conf['shape'])
+        # get_psf only runs PSFEx if this catalog does not exist
+        open(fileName.replace('.fits', '.psfexcat'), 'w').close()
+        sim[imtype] = fileName
+        sim[imtype+'_header'] = fits.getheader(fileName)
+        sim[imtype+'_fwhm'] = fwhm
+        del image, stars
+
+    # object mask as produced by SExtractor's -OBJECTS check image:
+    # zero where there are objects
+    sim['objmask'] = (sim['stars'] < conf['readnoise']).astype('float32')
+    return sim
+
+"""
+Run all stages of configuration [name] and return the results per stage.
+"""
+def runConfig(name):
+
+    conf = dict(configs[name])
+    workDir = tempfile.mkdtemp(prefix='zogy_bench_')
+    try:
+        ctx = zogy.RunContext(conf['telescope'], verbose=False, timing=False, redo=False,
+                              dosex=False, dosex_psffit=False, nfakestars=0, display=False,
+                              instrument=True)
+        conf['subimage_size'] = ctx.subimage_size
+        sim = makeImages(conf, workDir)
+
+        ctx.spans = zogy.Spans()
+        ctx.base_new = os.path.join(workDir, 'new')
+        ctx.base_ref = os.path.join(workDir, 'ref')
+        ctx.output_dir = workDir
+        ctx.template_dir = workDir
+        ysize, xsize = conf['shape']
+        readnoise = conf['readnoise']
+
+        centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = \
+            zogy.centers_cutouts(ctx.subimage_size, ysize, xsize, border=ctx.subimage_border)
+        nsubs = centers.shape[0]
+
+        tiles = {}
+        with ctx.span('read_fits_tile'):
+            for imtype in ['new', 'ref']:
+                tiles[imtype] = [zogy.read_fits_tile(ctx, sim[imtype], cuts_ima_fft[nsub],
+                                                     cuts_fft[nsub])
+                                 for nsub in range(nsubs)]
+
+        data_new = ctx.read_fits(sim['new'], copy=True)
+        bkg, bkg_std = zogy.get_back(ctx, data_new, sim['objmask'])
+
+        psf = {}
+        for imtype in ['ref', 'new']:
+            psf[imtype], psf_orig = zogy.get_psf(ctx, sim[imtype], sim[imtype+'_header'], nsubs,
+                                                 'new', sim[imtype+'_fwhm'], 1.)
+
+        nstars = len(sim['xstar'])
+        zeros = np.zeros(nstars)
+        zogy.get_optflux_xycoords(ctx, sim['new'].replace('.fits', '.psf'), data_new, bkg,
+                                  bkg_std, readnoise, sim['xstar'], sim['ystar'],
+                                  zeros, zeros, zeros)
+
+        # run_ZOGY on each subimage and assemble the full products
+        products = dict((product, np.zeros((ysize, xsize), dtype='float32'))
+                        for product in ['D', 'S', 'Scorr', 'Fpsf', 'Fpsferr'])
+        border, size = ctx.subimage_border, ctx.subimage_size
+        for nsub in range(nsubs):
+            data_ref, data_new_sub = tiles['ref'][nsub], tiles['new'][nsub]
+            std_sub = bkg_std[cuts_ima_fft[nsub][0]:cuts_ima_fft[nsub][1],
+                              cuts_ima_fft[nsub][2]:cuts_ima_fft[nsub][3]]
+            with ctx.span('run_ZOGY', nsub=nsub):
+                result = zogy.run_ZOGY(ctx, data_ref, data_new_sub, psf['ref'][nsub],
+                                       psf['new'][nsub], 0.5*np.median(std_sub),
+                                       np.median(std_sub), 1., 1.,
+                                       data_ref + readnoise**2, data_new_sub + readnoise**2,
+                                       0.05, 0.05)
+            index_sub = [slice(cuts_ima[nsub][0], cuts_ima[nsub][1]),
+                         slice(cuts_ima[nsub][2], cuts_ima[nsub][3])]
+            for product, data in zip(['D', 'S', 'Scorr', 'Fpsf', 'Fpsferr'], result):
+                products[product][index_sub] = data[border:border+size, border:border+size]
+
+        zogy.write_products(ctx, [(product, products[product]) for product in
+                                  ['D', 'S', 'Scorr', 'Fpsf', 'Fpsferr']])
+        ctx.close_fits()
+
+        # fraction of the transients recovered in Scorr
+        xtrans = np.round(sim['xtrans']).astype(int)
+        ytrans = np.round(sim['ytrans']).astype(int)
+        recovered = np.mean(products['Scorr'][ytrans, xtrans] >= ctx.transient_nsigma)
+
+        # summarize the spans per stage
+        npix = ysize * xsize
+        results = {'npix': npix, 'nsubs': nsubs, 'recovered': recovered, 'stages': {}}
+        for stage in stages:
+            records = [record for record in ctx.spans.records
+                       if record is not None and record['name'] == stage]
+            wall = sum(record['wall'] for record in records)
+            results['stages'][stage] = {'wall': wall,
+                                        'mpix_per_s': npix / 1e6 / wall if wall > 0 else None,
+                                        'maxrss_mb': max(record['maxrss_mb'] for record in records)}
+        results['stages']['get_optflux_xycoords']['sources_per_s'] = \
+            nstars / results['stages']['get_optflux_xycoords']['wall']
+        return results
+
+    finally:
+        shutil.rmtree(workDir)
+
+"""
+Compare [results] with [baseline] and return the list of regressions:
+stages whose wall time exceeds that in the baseline by more than the
+fraction [tolerance].
+"""
+def regressions(results, baseline, tolerance):
+
+    slower = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for stage, values in results[name]['stages'].items():
+            if stage not in baseline[name]['stages']:
+                continue
+            wallBase = baseline[name]['stages'][stage]['wall']
+            if values['wall'] > wallBase * (1. + tolerance):
+                slower.append((name, stage, wallBase, values['wall']))
+    return slower
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the zogy stages on synthetic images')
+    parser.add_argument('--configs', default='decam,meerlicht',
+                        help='comma-separated list of configurations: {}'.format(','.join(sorted(configs))))
+    parser.add_argument('--baseline', default=None, help='JSON file with the baseline results')
+    parser.add_argument('--save-baseline', default=None, help='save the results as baseline to this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional slowdown with respect to the baseline that is reported')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # run a single configuration and print the results as the last line
+    if args.run is not None:
+        results = runConfig(args.run)
+        print json.dumps(results)
+        return
+
+    results = {}
+    for name in args.configs.split(','):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', name])
+        results[name] = json.loads(output.strip().split('\n')[-1])
+
+        print '\n{}: {} x {} pixels, {} subimages, transients recovered: {:.0%}'.format(
+            name, configs[name]['shape'][0], configs[name]['shape'][1], results[name]['nsubs'],
+            results[name]['recovered'])
+        print '{:24s} {:>10s} {:>10s} {:>12s}'.format('stage', 'wall [s]', 'Mpix/s', 'peak RSS [MB]')
+        for stage in stages:
+            values = results[name]['stages'][stage]
+            print '{:24s} {:10.3f} {:10.2f} {:12.0f}'.format(stage, values['wall'],
+                                                            values['mpix_per_s'] or 0.,
+                                                            values['maxrss_mb'])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, args.tolerance)
+        for name, stage, wallBase, wall in slower:
+            print 'REGRESSION {} {}: {:.3f}s -> {:.3f}s ({:+.0%})'.format(name, stage, wallBase, wall,
+                                                                       wall/wallBase-1.)
+        if slower:
+            sys.exit(1)
+        print '\nno regressions with respect to {}'.format(args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -38,3 +38,8 @@ timing=True
 display=False 
 make_plots=True 
 show_plots=False
+output_compress=None
+output_quantize={'D': 16, 'S': -0.01, 'Scorr': -0.01, 'Scorr_abs': -0.01, 'Fpsf': 16, 'Fpsferr': 16}
+output_mef=False
+output_mef_name='products.fits'
+output_Scorr_abs=True
@@ -7,23 +7,70 @@ each, and put all ZOGY output in ./ccdXX_output
 
 When all CCD's have been processed, build in ./output MEFs for difference image,
 significance image, etc.
+
+With streamSplit, the MEFs are not split up front: each CCD job extracts its
+own extension of the image, DQ, weight and template MEFs straight into its
+ccd_XX directory, from the memory-mapped MEF, just before it runs ZOGY.
+
+zogyNight runs a whole night of exposures, with different templates, over a
+pool of worker processes, with a priority lane for newly arrived exposures.
+
+The CCDs can be processed in parallel by a pool of worker processes (nproc >
+1). Each CCD runs in its own process, which keeps the memory of one CCD's
+run from piling up in the next, and writes its log to ccd_XX/zogy.log. A failing CCD is reported
+but does not stop the other CCDs.
 """
 
 import numpy as np
 import pyfits as pf
 import os
 import os.path as path
+import json
 import re
+import sys
+import time
+import traceback
+import multiprocessing
+import cProfile
+import pstats
+from collections import OrderedDict, deque
 
 import zogy
 
+# products that are joined into an MEF per observation
+joinProducts = ['D', 'S', 'Scorr', 'Fpsf']
+
+# keywords that describe the structure of an HDU, which are not copied
+# from the original headers into the joined MEFs
+structuralKeywords = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND',
+                      'NEXTEND', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM']
+
+# keywords added to the header of each CCD image
+decamKeywords = dict(GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0)
+
 """
 obsDir is the directory where images to process are to be found
-obsList is a list of (image, dqmask) pairs
+obsList is a list of (image, dqmask, weight) triples
 template is the name of the template file
 configDir is the directory of config files (sex.config, etc) for ZOGY
+nproc is the number of CCDs processed concurrently
+profile switches on profiling: each CCD writes its cProfile stats and hot-spot
+summary next to its outputs (see zogy.write_profile), and the work of the
+driver itself (splitting and joining the MEFs) is profiled into
+obsDir/zogyDrive_profile.prof
+profileNsub limits the profiling of each CCD to this subimage
+streamSplit switches to extracting the CCDs in the jobs (see streamJobs)
+instead of splitting all MEFs beforehand
+compress is the tile compression ('RICE_1', 'HCOMPRESS_1', etc.) of the
+joined MEFs, or None for uncompressed MEFs (see MEFassemble)
 """
-def zogyDrive(obsDir, obsList, template, templateDQ, templateWt, configDir, filterName):
+def zogyDrive(obsDir, obsList, template, templateDQ, templateWt, configDir, filterName, nproc=1,
+              profile=False, profileNsub=None, streamSplit=False, compress=None):
+
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     
     # if template MEF hasn't already been split into obsDir/Template, do so
     try:
@@ -32,123 +79,498 @@ def zogyDrive(obsDir, obsList, template, templateDQ, templateWt, configDir, filt
     except OSError:
         pass
 
-    if prepMEF(templateDir, template, templateDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-        print 'Can\'t process template file ', template
-        return
+    if streamSplit:
+        jobs = []
+        imageIDs = []
+        for obs in obsList:
+            jobs += streamJobs(obsDir, obs, templateDir, template, templateDQ, templateWt, filterName)
+            imageIDs.append(obs[0][0:obs[0].rindex('.fits')])
+        return runDrive(obsDir, jobs, imageIDs, nproc, profiler, profileNsub, compress)
 
-    if prepMEF(templateDir, templateDQ, templateDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-        print 'Can\'t process template DQ file ', templateDQ
-        return
-
-    if prepMEF(templateDir, templateWt, templateDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-        print 'Can\'t process template weight file ', templateWt
-        return
+    for MEFname, kind in zip((template, templateDQ, templateWt), ['template', 'template DQ', 'template weight']):
+        if prepMEF(templateDir, MEFname, templateDir, FILTNAME=filterName, **decamKeywords):
+            print 'Can\'t process', kind, 'file ', MEFname
+            return
 
     tempDir = path.join(obsDir,'tmp')
-    mkdirNoSquawk(tempDir)
-    
+    keywords = dict(decamKeywords, FILTNAME=filterName)
+
+    jobs = []
+    imageIDs = []
     for obs in obsList:
         # MEFsplit obs, dq image, and weight image into tempDir
         # move each individual obs, dq, and weight image into appropriate ccd_nn subdirectory
         # run zogy.optimal_subtraction() on each image/dq/wt ccd trio
         # copy fits headers into S.fits and rename S_nn.fits (and for other images)
         # MEFjoin the S_nn.fits images (and similar)
-        image = obs[0]
-        dq = obs[1]
-        wt = obs[2]
-
-        indx = image.rindex('.fits')
-        imageID = image[0:indx]
-        indx = template.rindex('.fits')
-        templateID = template[0:indx]
-        indx = templateDQ.rindex('.fits')
-        templateDqID = templateDQ[0:indx]
-        indx = templateWt.rindex('.fits')
-        templateWtID = templateWt[0:indx]
-        indx = dq.rindex('.fits')
-        dqID = dq[0:indx]
-        indx = wt.rindex('.fits')
-        wtID = wt[0:indx]
-        
+        imageID = obs[0][0:obs[0].rindex('.fits')]
         mkdirNoSquawk(path.join(obsDir,imageID))
-        if prepMEF(obsDir, image, tempDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-            print 'Error processing image ', image
-
-        imagePat = re.compile(imageID + r'_(\d+).fits')
-        imageList = os.listdir(tempDir)
-        for i in imageList:
-            mtch = imagePat.match(i)
-            if mtch:
-                ccdID = mtch.group(1)
-                imageDestDir = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                mkdirNoSquawk(imageDestDir)
-                os.renames(path.join(tempDir,i), path.join(imageDestDir, i))
-
-        mkdirNoSquawk(tempDir)
-        if prepMEF(obsDir, dq, tempDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-           print 'Error processing dq image ', dq
-
-        imagePat = re.compile(dqID + r'_(\d+).fits')
-        imageList = os.listdir(tempDir)
-        for i in imageList:
-            mtch = imagePat.match(i)
-            if mtch:
-                ccdID = mtch.group(1)
-                imageDestDir = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                mkdirNoSquawk(imageDestDir)
-                os.renames(path.join(tempDir,i), path.join(imageDestDir, i))
-
-        mkdirNoSquawk(tempDir)
-        if prepMEF(obsDir, wt, tempDir, GAIN=4.0, RDNOISE=5.0, PIXSCALE=0.263, SEEING=1.0, FILTNAME=filterName):
-           print 'Error processing wt image ', wt
-
-        imagePat = re.compile(wtID + r'_(\d+).fits')
-        imageList = os.listdir(tempDir)
-        for i in imageList:
-            mtch = imagePat.match(i)
-            if mtch:
-                ccdID = mtch.group(1)
-                imageDestDir = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                mkdirNoSquawk(imageDestDir)
-                os.renames(path.join(tempDir,i), path.join(imageDestDir, i))
-
-        imageDirList = os.listdir(path.join(obsDir,imageID))
-        for d in imageDirList:
-            imageList = os.listdir(path.join(obsDir,imageID,d))
-            newPat = re.compile(imageID + r'_(\d+).fits')
-            newDqPat = re.compile(dqID + r'_(\d+).fits')
-            newWtPat = re.compile(wtID + r'_(\d+).fits')
-
-            for i in imageList:
-                mtch = newPat.match(i)
-                mtchDq = newDqPat.match(i)
-                mtchWt = newWtPat.match(i)
-                if mtch:
-                    ccdID = mtch.group(1)
-                    basePath = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                    newImage = path.join(basePath,i)
-                    templateImage = templateID + '_' + ccdID + '.fits'
-                    templateDqImage = templateDqID + '_' + ccdID + '.fits'
-                    templateWtImage = templateWtID + '_' + ccdID + '.fits'
-                    refImage = path.join(templateDir, templateImage)
-                    refDqImage = path.join(templateDir, templateDqImage)
-                    refWtImage = path.join(templateDir, templateWtImage)
-                    print newImage, refImage, refDqImage, refWtImage
-                elif mtchDq:
-                    ccdID = mtchDq.group(1)
-                    basePath = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                    newDqImage = path.join(basePath,i)
-                    print newDqImage
-                elif mtchWt:
-                    ccdID = mtchWt.group(1)
-                    basePath = path.join(obsDir, imageID, 'ccd_'+ccdID)
-                    newWtImage = path.join(basePath,i)
-                    print newWtImage
-            if newImage is not None and refImage is not None and newDqImage is not None and refDqImage is not None and newWtImage is not None and refWtImage is not None:
-                zogy.optimal_subtraction(newImage, refImage, use_existing_wcs=True, new_mask=newDqImage, ref_mask=refDqImage, new_wt=newWtImage, ref_wt=refWtImage, telescope='Decam')
+
+        for MEFname, kind in zip(obs, ['image', 'dq image', 'wt image']):
+            mkdirNoSquawk(tempDir)
+            if prepMEF(obsDir, MEFname, tempDir, **keywords):
+                print 'Error processing', kind, MEFname
+                continue
+            # the CCD files have the names given by ccdFile, so the
+            # index of the MEF tells which files to move
+            for ccdnum in MEFindex(path.join(obsDir, MEFname))['ccds']:
+                ccdName = ccdFile(tempDir, MEFname, ccdnum)
+                if path.isfile(ccdName):
+                    ccdDir = path.join(obsDir, imageID, 'ccd_%d' % ccdnum)
+                    os.renames(ccdName, ccdFile(ccdDir, MEFname, ccdnum))
+
+        jobs += ccdJobs(obsDir, obs, templateDir, (template, templateDQ, templateWt))
+        imageIDs.append(imageID)
+
+    return runDrive(obsDir, jobs, imageIDs, nproc, profiler, profileNsub, compress)
+
+"""
+Run the CCD jobs, report the failures and join the per-CCD products of the
+observations imageIDs; profiler is the profiler of the driver, or None if
+not profiling
+"""
+def runDrive(obsDir, jobs, imageIDs, nproc, profiler, profileNsub, compress):
+
+    if profiler is not None:
+        for job in jobs:
+            job[1]['settings'] = {'profile': True, 'profile_nsub': profileNsub}
+
+    # run zogy on all CCDs of all observations
+    if profiler is not None:
+        profiler.disable()
+    results = runJobs(jobs, nproc)
+    if profiler is not None:
+        profiler.enable()
+
+    failed = [r for r in results if not r[1]]
+    print '%d of %d CCDs processed successfully' % (len(results)-len(failed), len(results))
+    for (ccdDir, status, message) in failed:
+        print 'Failed:', ccdDir, message
+
+    # join the per-CCD products of each observation
+    for imageID in imageIDs:
+        joinObs(path.join(obsDir, imageID), imageID, compress)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(path.join(obsDir, 'zogyDrive_profile.prof'))
+        pstats.Stats(profiler).strip_dirs().sort_stats('cumulative').print_stats(20)
 
     return
 
+"""
+Return the list of CCD jobs for observation obs (an (image, dqmask, weight)
+triple of MEFs in obsDir), one (ccdDir, kwargs, extracts) tuple (with no
+files to extract) per CCD in the index of the image MEF for which the image,
+DQ and weight files in ccd_XX, and the corresponding files of the templates
+(template, DQ and weight MEFs) in templateDir, are all present
+"""
+def ccdJobs(obsDir, obs, templateDir, templates):
+    imageID = obs[0][0:obs[0].rindex('.fits')]
+
+    jobs = []
+    for ccdnum in sorted(MEFindex(path.join(obsDir, obs[0]))['ccds']):
+        ccdDir = path.join(obsDir, imageID, 'ccd_%d' % ccdnum)
+        newFiles = [ccdFile(ccdDir, MEFname, ccdnum) for MEFname in obs]
+        refFiles = [ccdFile(templateDir, MEFname, ccdnum) for MEFname in templates]
+        if not all([path.isfile(f) for f in newFiles]):
+            print 'Skipping incomplete CCD directory', ccdDir
+            continue
+        if not all([path.isfile(f) for f in refFiles]):
+            print 'Skipping CCD without template', ccdDir
+            continue
+
+        print newFiles[0], refFiles[0], refFiles[1], refFiles[2]
+        jobs.append((ccdDir, ccdKwargs(*(newFiles+refFiles)), []))
+
+    return jobs
+
+"""
+Return the keyword arguments of zogy.optimal_subtraction for a CCD
+"""
+def ccdKwargs(newImage, newDqImage, newWtImage, refImage, refDqImage, refWtImage):
+    return dict(new_fits=newImage, ref_fits=refImage, use_existing_wcs=True,
+                new_mask=newDqImage, ref_mask=refDqImage,
+                new_wt=newWtImage, ref_wt=refWtImage, telescope='Decam')
+
+"""
+Return the list of CCD jobs for observation obs (an (image, dqmask, weight)
+triple of MEFs in obsDir) without splitting the MEFs: each job is a
+(ccdDir, kwargs, extracts) tuple, where extracts lists the (MEF, CCDNUM,
+extension, file, keywords) of the CCD files that runCCD extracts with
+MEFextract before running zogy. The jobs are planned from the indices of
+the MEFs (see MEFindex), without opening them. The file names are the same as those of MEFsplit, and
+the template CCDs go to templateDir, where they are shared by the jobs of
+all observations.
+"""
+def streamJobs(obsDir, obs, templateDir, template, templateDQ, templateWt, filterName):
+    keywords = dict(decamKeywords, FILTNAME=filterName)
+    MEFs = ([(path.join(obsDir, MEFname), None) for MEFname in obs] +
+            [(path.join(templateDir, MEFname), templateDir)
+             for MEFname in (template, templateDQ, templateWt)])
+    indices = [MEFindex(MEFpath)['ccds'] for MEFpath, destDir in MEFs]
+
+    imageID = obs[0][0:obs[0].rindex('.fits')]
+    jobs = []
+    for ccdnum in sorted(indices[0]):
+        ccdDir = path.join(obsDir, imageID, 'ccd_%d' % ccdnum)
+        if not all([ccdnum in index for index in indices[1:3]]):
+            print 'Skipping incomplete CCD', ccdDir
+            continue
+        if not all([ccdnum in index for index in indices[3:]]):
+            print 'Skipping CCD without template', ccdDir
+            continue
+        extracts = []
+        for (MEFpath, destDir), index in zip(MEFs, indices):
+            extracts.append((MEFpath, ccdnum, index[ccdnum]['ext'],
+                             ccdFile(destDir or ccdDir, MEFpath, ccdnum), keywords))
+        files = [e[3] for e in extracts]
+        jobs.append((ccdDir, ccdKwargs(*files), extracts))
+
+    return jobs
+
+"""
+Return the name of the file in directory dir of CCD ccdnum of MEF MEFname,
+as written by MEFsplit
+"""
+def ccdFile(dir, MEFname, ccdnum):
+    MEFfileBase = path.basename(MEFname).replace('.fits','')
+    return '%s/%s_%d.fits' % (dir, MEFfileBase, ccdnum)
+
+"""
+Run zogy.optimal_subtraction for a single CCD job (ccdDir, kwargs,
+extracts), after extracting the CCD files in extracts (see streamJobs), with
+stdout and stderr, including that of the external programs started by zogy,
+redirected to ccdDir/zogy.log. If warmCache is not None, it is the
+zogy.WarmCache of the run context, kept by a long-lived worker between its
+jobs (see zogyNight). Any exception is caught and logged, so that one failing
+CCD does not affect the others. Returns (ccdDir, success, message).
+"""
+def runCCD(job, warmCache=None):
+    ccdDir, kwargs, extracts = job
+    mkdirNoSquawk(path.dirname(ccdDir))
+    mkdirNoSquawk(ccdDir)
+    logName = path.join(ccdDir, 'zogy.log')
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    savedFds = (os.dup(1), os.dup(2))
+    logFile = open(logName, 'w')
+    os.dup2(logFile.fileno(), 1)
+    os.dup2(logFile.fileno(), 2)
+
+    t = time.time()
+    try:
+        for MEFname, ccdnum, ext, outName, keywords in extracts:
+            MEFextract(MEFname, ccdnum, ext, outName, **keywords)
+        if warmCache is not None:
+            kwargs = dict(kwargs)
+            ctx = zogy.RunContext(kwargs.pop('telescope'), **(kwargs.pop('settings', None) or {}))
+            if kwargs.get('use_existing_wcs'):
+                ctx.dosex = True
+            ctx.warm_cache = warmCache
+            kwargs['ctx'] = ctx
+        zogy.optimal_subtraction(**kwargs)
+        status, message = True, 'done in %.1f s' % (time.time()-t)
+    except BaseException:
+        traceback.print_exc()
+        status, message = False, traceback.format_exc().splitlines()[-1]
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(savedFds[0], 1)
+        os.dup2(savedFds[1], 2)
+        os.close(savedFds[0])
+        os.close(savedFds[1])
+        logFile.close()
+
+    return ccdDir, status, message
+
+"""
+Run the CCD jobs received over connection conn with runJob (runCCD, or
+runLaneCCD in a zogyNight lane) and send back their results, until None is
+received; this is the loop of a worker process started by startWorker
+"""
+def workerLoop(conn, runJob):
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        conn.send(runJob(job))
+
+"""
+Start a worker process running workerLoop with runJob, and return it as a
+(process, connection) pair
+"""
+def startWorker(runJob):
+    conn, workerConn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=workerLoop, args=(workerConn, runJob))
+    process.start()
+    workerConn.close()
+    return process, conn
+
+"""
+Return the result of job, which was sent to worker (see startWorker), or None
+if it is still running. If the worker process died without sending the
+result (e.g. killed by the OOM killer, or crashed in FFTW or astropy), the
+job is reported as failed; the caller then replaces the worker.
+"""
+def pollWorker(worker, job):
+    process, conn = worker
+    try:
+        if conn.poll():
+            return conn.recv()
+    except (EOFError, IOError):
+        # the worker closed its end of the connection
+        process.join()
+    if process.is_alive():
+        return None
+    process.join()
+    return (job[0], False, 'worker process died with exit code %s' % process.exitcode)
+
+"""
+Stop worker (see startWorker) after its current job
+"""
+def stopWorker(worker):
+    process, conn = worker
+    try:
+        conn.send(None)
+    except (EOFError, IOError):
+        pass
+    process.join()
+    conn.close()
+
+"""
+Run the list of CCD jobs, either serially (nproc=1) or over nproc worker
+processes. The jobs are grouped by template CCD (ref_fits), and a worker
+handles all jobs of a group one after the other, so that the jobs of
+different observations never build the products of the same template CCD
+(catalog, PSF, WCS solution, stage record) concurrently, and the later jobs
+reuse the products of the first one. The state of each run is kept in its
+own zogy.RunContext, so a worker can run one group after another. A worker
+that dies is replaced, and its job in flight is reported as failed, so that
+the run never waits for a result that will not come. Returns the list of
+(ccdDir, success, message) results in the order of jobs.
+"""
+def runJobs(jobs, nproc=1, pollInterval=1.):
+    if nproc <= 1:
+        results = []
+        for job in jobs:
+            results.append(runCCD(job))
+            print results[-1]
+        return results
+
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job[1]['ref_fits'], []).append(job)
+    pending = deque([deque(group) for group in groups.values()])
+
+    workers = [startWorker(runCCD) for i in range(min(nproc, len(groups)))]
+    # per worker: the remaining jobs of its group and its job in flight
+    current = [None] * len(workers)
+    resultsByDir = {}
+    try:
+        while pending or current != [None] * len(workers):
+            for i in range(len(workers)):
+                if current[i] is None:
+                    if not pending:
+                        continue
+                    current[i] = [pending.popleft(), None]
+                group, job = current[i]
+                if job is not None:
+                    result = pollWorker(workers[i], job)
+                    if result is None:
+                        continue
+                    resultsByDir[result[0]] = result
+                    print result
+                    if not workers[i][0].is_alive():
+                        workers[i] = startWorker(runCCD)
+                if group:
+                    current[i][1] = group.popleft()
+                    workers[i][1].send(current[i][1])
+                else:
+                    current[i] = None
+            time.sleep(pollInterval)
+    finally:
+        for worker in workers:
+            stopWorker(worker)
+
+    return [resultsByDir[job[0]] for job in jobs]
+
+# the warm cache of a zogyNight lane worker, kept between its jobs
+laneCache = None
+
+"""
+Run a CCD job in the long-lived worker process of a zogyNight lane, with the
+warm cache of that worker
+"""
+def runLaneCCD(job):
+    global laneCache
+    if laneCache is None:
+        laneCache = zogy.WarmCache()
+    return runCCD(job, warmCache=laneCache)
+
+"""
+Run a night of exposures: each exposure is an (obsDir, obs, templateDir,
+template, templateDQ, templateWt, filterName) tuple as passed to streamJobs,
+and is expanded into its CCD jobs. The jobs are queued per template CCD, and
+a queue is handed to a single lane of the nproc worker lanes until it is
+empty, so that all jobs of the same template CCD run one after the other on
+the same lane: the first job extracts the template CCD and builds its
+products (catalog, PSF, etc.), which the next jobs of that CCD reuse instead
+of redoing them concurrently on other lanes. Each lane has a single
+long-lived worker process, which keeps the results of the steps on the
+template CCD (e.g. its WCS solution and PSF) in memory in a zogy.WarmCache
+for the next jobs of that template CCD, next to the products on disk. A lane
+worker that dies is replaced, and its job is reported as failed.
+
+arrivals, if given, is called regularly without arguments and returns the list
+of exposures that arrived since the previous call (e.g. from a directory
+watcher); these go to the priority lane: a lane that becomes free takes a
+priority job before any backfill job, so newly arrived exposures are not
+delayed by the backlog of exposures. The run ends when all jobs are done and
+arrivals returns None.
+
+Backpressure: at most nproc jobs are in flight, the exposures are expanded
+into jobs only when fewer than maxPending backfill jobs are queued, and
+arrivals is not called while maxPending priority jobs are waiting.
+
+The products of an exposure are joined (with tile compression compress, see
+MEFassemble) as soon as all of its CCDs are done; a failing join is logged.
+An exposure that is still being processed when it is passed again (e.g. by
+arrivals while it is in the backlog) is skipped.
+Returns the list of (ccdDir, success, message) results in order of completion.
+"""
+def zogyNight(exposures, nproc=1, arrivals=None, maxPending=200, pollInterval=1., compress=None):
+
+    # per template CCD: the job queues of the priority and backfill lanes
+    queues = (OrderedDict(), OrderedDict())
+    exposures = deque(exposures)
+    # number of unfinished CCDs per exposure
+    remaining = {}
+    # template CCD queue bound to each lane, and its job in flight
+    lanes = [None] * max(nproc, 1)
+    inFlight = [None] * len(lanes)
+    results = []
+
+    def npending(queue):
+        return sum([len(jobs) for jobs in queue.values()])
+
+    def enqueue(exposure, queue):
+        obsDir, obs = exposure[0:2]
+        imageID = obs[0][0:obs[0].rindex('.fits')]
+        if path.join(obsDir, imageID) in remaining:
+            # e.g. both in the backlog and reported by arrivals
+            print 'Skipping exposure already being processed:', imageID
+            return
+        mkdirNoSquawk(exposure[2])
+        jobs = streamJobs(*exposure)
+        if len(jobs) > 0:
+            remaining[path.join(obsDir, imageID)] = [imageID, len(jobs)]
+        for job in jobs:
+            queue.setdefault(job[1]['ref_fits'], deque()).append(job)
+
+    def nextJob(lane):
+        # in the priority lane and then in the backfill lane: the template
+        # CCD of this lane first, then the first one not bound to another lane
+        for queue in queues:
+            if queue.get(lanes[lane]):
+                return queue[lanes[lane]].popleft()
+            for key, jobs in queue.items():
+                if jobs and key not in lanes:
+                    lanes[lane] = key
+                    return jobs.popleft()
+        for queue in queues:
+            if lanes[lane] in queue:
+                del queue[lanes[lane]]
+        lanes[lane] = None
+        return None
+
+    workers = [startWorker(runLaneCCD) for lane in lanes]
+    try:
+        while True:
+            if arrivals is not None and npending(queues[0]) < maxPending:
+                arrived = arrivals()
+                if arrived is None:
+                    arrivals = None
+                else:
+                    for exposure in arrived:
+                        enqueue(exposure, queues[0])
+            while exposures and npending(queues[1]) < maxPending:
+                enqueue(exposures.popleft(), queues[1])
+
+            for lane in range(len(lanes)):
+                result = None
+                if inFlight[lane] is not None:
+                    result = pollWorker(workers[lane], inFlight[lane])
+                if result is not None:
+                    job = inFlight[lane]
+                    results.append(result)
+                    print results[-1]
+                    inFlight[lane] = None
+                    if not workers[lane][0].is_alive():
+                        # a new worker, without the warm cache of the old one
+                        workers[lane] = startWorker(runLaneCCD)
+                    imageDir = path.dirname(job[0])
+                    remaining[imageDir][1] -= 1
+                    if remaining[imageDir][1] == 0:
+                        imageID = remaining.pop(imageDir)[0]
+                        try:
+                            joinObs(imageDir, imageID, compress)
+                        except Exception:
+                            # one exposure that cannot be joined does not
+                            # end the night
+                            print 'Failed to join the products of', imageID
+                            traceback.print_exc()
+                if inFlight[lane] is None:
+                    job = nextJob(lane)
+                    if job is not None:
+                        workers[lane][1].send(job)
+                        inFlight[lane] = job
+
+            if arrivals is None and not exposures and inFlight == [None] * len(lanes):
+                break
+            time.sleep(pollInterval)
+    finally:
+        for worker in workers:
+            stopWorker(worker)
+
+    failed = [r for r in results if not r[1]]
+    print '%d of %d CCDs processed successfully' % (len(results)-len(failed), len(results))
+    for (ccdDir, status, message) in failed:
+        print 'Failed:', ccdDir, message
+
+    return results
+
+"""
+Join the D, S, Scorr and Fpsf products of the ccd_XX directories of
+observation directory imageDir into imageDir/imageID_D.fits, etc., with the
+CCDs in the order of their CCDNUM in the index of the image MEF imageID.fits
+(see MEFindex), whose primary and CCD headers are copied into the joined MEFs.
+The products are found where zogy.write_products writes them with the
+settings of telescope: per product (D.fits, or D.fits.fz if tile-compressed)
+or as the extensions of a single products MEF (output_mef).
+"""
+def joinObs(imageDir, imageID, compress=None, telescope='Decam'):
+    index = MEFindex(path.join(path.dirname(imageDir), imageID + '.fits'))
+    primary = pf.Header.fromstring(index['primary'])
+    ctx = zogy.RunContext(telescope)
+
+    for product in joinProducts:
+        ccds = []
+        for ccdnum in sorted(index['ccds']):
+            ctx.output_dir = path.join(imageDir, 'ccd_%d' % ccdnum)
+            productFile = zogy.product_filename(ctx, product)
+            extname = product if ctx.output_mef else None
+            if path.isfile(productFile):
+                ccds.append((productFile, extname,
+                             pf.Header.fromstring(index['ccds'][ccdnum]['header'])))
+        if len(ccds) == 0:
+            print 'No', product, 'products found in', imageDir
+            continue
+        MEFassemble(ccds, path.join(imageDir, imageID + '_' + product + '.fits'), primary,
+                    compress, ctx.output_quantize.get(product, 16.))
+
 def mkdirNoSquawk(dir):
     try:
         os.mkdir(dir)
@@ -162,14 +584,10 @@ def prepMEF(srcDir, imageName, destDir, **kwargs):
         print 'Image file not found'
         return True
     
-    indx = imageName.rindex('.fits')
-    imageRoot = imageName[0:indx]
-    imageFilePat = re.compile(imageRoot + r'_\d+.fits')
-
-    imageList = os.listdir(destDir)
+    # the MEF has been split already if any of its CCD files exists
     matched = False
-    for t in imageList:
-        if imageFilePat.match(t):
+    for ccdnum in MEFindex(imagePath)['ccds']:
+        if path.isfile(ccdFile(destDir, imageName, ccdnum)):
             matched = True
             break
 
@@ -201,17 +619,169 @@ def MEFsplit(MEFname, outputDir, **kwargs):
 
     return
 
+"""
+Return the index of MEF MEFname: a dictionary with the primary header (as a
+string) and, under 'ccds', for each CCDNUM the extension number, the byte
+offsets of its header and data, the size of its data and its header (as a
+string). The index is built in a single pass over the headers and kept in
+index/MEFname.json next to the MEF, which is reused as long as the size and
+modification time of the MEF are unchanged.
+"""
+def MEFindex(MEFname):
+    indexName = path.join(path.dirname(MEFname), 'index', path.basename(MEFname) + '.json')
+    stat = os.stat(MEFname)
+    signature = [stat.st_size, stat.st_mtime]
+
+    if path.isfile(indexName):
+        with open(indexName) as f:
+            index = json.load(f)
+        if index['signature'] == signature:
+            index['ccds'] = dict([(int(ccdnum), entry) for ccdnum, entry in index['ccds'].items()])
+            return index
+
+    index = {'signature': signature, 'ccds': {}}
+    hdulist = pf.open(MEFname, memmap=True)
+    try:
+        index['primary'] = hdulist[0].header.tostring()
+        for ext in range(1, len(hdulist)):
+            header = hdulist[ext].header
+            info = hdulist.fileinfo(ext)
+            index['ccds'][header['CCDNUM']] = {'ext': ext, 'hdrLoc': info['hdrLoc'],
+                                               'datLoc': info['datLoc'],
+                                               'datSpan': info['datSpan'],
+                                               'header': header.tostring()}
+    finally:
+        hdulist.close()
+
+    mkdirNoSquawk(path.dirname(indexName))
+    tmpName = '%s.%d.tmp' % (indexName, os.getpid())
+    with open(tmpName, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmpName, indexName)
+
+    return index
+
+"""
+Write extension ext, with CCDNUM ccdnum, of MEF MEFname to outName, with the
+primary header and the keywords in kwargs added to its header, like MEFsplit
+does for all extensions. The MEF is memory-mapped, so only the data of this
+extension are read. Nothing is done if outName is newer than the MEF. The
+file is written under a temporary name and renamed, so that jobs that need
+the same template CCD at the same time never see a partial file.
+"""
+def MEFextract(MEFname, ccdnum, ext, outName, **kwargs):
+    if path.isfile(outName) and path.getmtime(outName) >= path.getmtime(MEFname):
+        return
+
+    hdulist = pf.open(MEFname, memmap=True)
+    try:
+        priHeader = hdulist[0].header
+        hdu = hdulist[ext]
+        if hdu.header['CCDNUM'] != ccdnum:
+            raise ValueError('extension %d of %s is not CCDNUM %d' % (ext, MEFname, ccdnum))
+        header = hdu.header.copy()
+        header.update(priHeader)
+        for kw, value in kwargs.iteritems():
+            header[kw] = value
+        tmpName = '%s.%d.tmp' % (outName, os.getpid())
+        pf.writeto(tmpName, hdu.data, header=header, clobber=True)
+        os.rename(tmpName, outName)
+    finally:
+        hdulist.close()
+
+    return
+
 def MEFjoin(inputDir, reCCD, outputMEF):
     pat = re.compile(reCCD)
-    fileList = os.listdir(inputDir)
-    hdulist = pf.HDUList()
-    hdulist.append(pf.PrimaryHDU())
-    for f in fileList:
-        if pat.match(f):
-            print f
-            hdu = pf.open(path.join(inputDir,f))
-            hdulist.append(hdu[0])
-    hdulist.writeto(outputMEF)
+    fileList = [f for f in os.listdir(inputDir) if pat.match(f)]
+    # in the order of the CCD number at the end of the file names
+    fileList.sort(key=lambda f: int(re.findall(r'\d+', f)[-1]))
+    MEFjoinFiles([path.join(inputDir,f) for f in fileList], outputMEF)
+    return
+
+def MEFjoinFiles(fileList, outputMEF):
+    MEFassemble([(f, None, None) for f in fileList], outputMEF)
+    return
+
+"""
+Return the header and, if data is True, the float32 data of product file
+productFile: of its extension extname, or else of its last HDU, which is the
+first extension if it is tile-compressed
+"""
+def readProduct(productFile, data=True, extname=None):
+    hdulist = pf.open(productFile, memmap=True)
+    try:
+        hdu = hdulist[extname] if extname is not None else hdulist[-1]
+        header = hdu.header.copy()
+        if data:
+            data = hdu.data.astype('>f4')
+    finally:
+        hdulist.close()
+    return header, data
+
+"""
+Append the cards of header source, except the structural keywords, to header dest
+"""
+def copyCards(source, dest):
+    for card in source.cards:
+        if card.keyword not in structuralKeywords:
+            dest.append(card)
+    return dest
+
+"""
+Build MEF outputMEF from ccds, a list of (productFile, extname, header)
+tuples, one per CCD in the order of the extensions, where the image is read
+from extension extname of productFile (see readProduct) and header (e.g. the
+header of the original CCD) replaces that of the product if it is not None. primary
+is copied into the primary header. The headers are written together with the
+data, so that no headerReplace pass is needed.
+
+Without compression, all headers are written first into a preallocated file
+whose layout follows from the image sizes in the product headers, after which
+the data of one CCD at a time is read and written in place. With compress
+(e.g. 'RICE_1'), each CCD is tile-compressed with quantization level quantize
+and appended to the file. Either way, only one CCD is held in memory. The MEF
+is written under a temporary name and renamed when complete.
+"""
+def MEFassemble(ccds, outputMEF, primary=None, compress=None, quantize=16.):
+    tmpName = '%s.%d.tmp' % (outputMEF, os.getpid())
+    priHeader = pf.PrimaryHDU().header
+    if primary is not None:
+        copyCards(primary, priHeader)
+    priHeader['NEXTEND'] = len(ccds)
+
+    if compress is not None:
+        pf.PrimaryHDU(header=priHeader).writeto(tmpName, clobber=True)
+        for productFile, extname, header in ccds:
+            productHeader, data = readProduct(productFile, extname=extname)
+            hdu = pf.CompImageHDU(data, header=copyCards(header or productHeader, pf.Header()),
+                                  compression_type=compress, quantize_level=quantize)
+            hdulist = pf.open(tmpName, mode='append')
+            hdulist.append(hdu)
+            hdulist.close()
+            del hdu, data
+    else:
+        with open(tmpName, 'wb') as f:
+            f.write(priHeader.tostring())
+            dataLocs = []
+            for productFile, extname, header in ccds:
+                productHeader = readProduct(productFile, data=False, extname=extname)[0]
+                nx, ny = productHeader['NAXIS1'], productHeader['NAXIS2']
+                extHeader = pf.Header([('XTENSION', 'IMAGE'), ('BITPIX', -32), ('NAXIS', 2),
+                                       ('NAXIS1', nx), ('NAXIS2', ny), ('PCOUNT', 0), ('GCOUNT', 1)])
+                f.write(copyCards(header or productHeader, extHeader).tostring())
+                dataLocs.append(f.tell())
+                # skip the data, padded to a multiple of 2880 bytes
+                f.seek((4*nx*ny + 2879) // 2880 * 2880, 1)
+            f.truncate(f.tell())
+
+            for dataLoc, (productFile, extname, header) in zip(dataLocs, ccds):
+                data = readProduct(productFile, extname=extname)[1]
+                f.seek(dataLoc)
+                data.tofile(f)
+                del data
+
+    os.rename(tmpName, outputMEF)
     return
 
 def headerReplace(sourceImage, destImage):
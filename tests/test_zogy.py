@@ -0,0 +1,320 @@
+"""
+Regression tests of the functions of zogy that do not need the external
+programs (SExtractor, PSFex, SWarp, Astrometry.net).
+
+Usage: python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+import zogy
+
+
+def test_warm_cache_evicts_least_recently_used():
+    cache = zogy.WarmCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # 'b' was used least recently
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_warm_cache_byte_budget():
+    array = np.zeros(100)
+    cache = zogy.WarmCache(maxbytes=2*array.nbytes)
+    cache.put('a', (array, 'result'))
+    cache.put('b', {'psf': array.copy()})
+    assert cache.nbytes == 2*array.nbytes
+    cache.put('c', [array.copy()])
+    assert cache.get('a') is None
+    assert cache.nbytes == 2*array.nbytes
+    # replacing an entry does not count it twice
+    cache.put('c', [array.copy()])
+    assert cache.nbytes == 2*array.nbytes
+    # a value larger than the budget is not cached
+    cache.put('d', np.zeros(300))
+    assert cache.get('d') is None
+    assert cache.get('b') is not None
+
+
+def test_find_transients_corner_subimage():
+    ctx = zogy.RunContext(timing=False, transient_nsigma=5)
+    # subimage of 20x20 pixels at the corner of the image, with a
+    # border of 5 pixels that is off the image on two sides
+    cut_ima, cut_ima_fft, cut_fft = [0, 20, 0, 20], [0, 25, 0, 25], [5, 30, 5, 30]
+    data_Scorr = np.zeros((30, 30))
+    data_Scorr[10, 12] = 8.
+    data_Scorr[10, 13] = 6.
+    data_Scorr[20, 8] = -7.
+    # in the part of the border that is off the image
+    data_Scorr[2, 2] = 9.
+    data_Fpsf = np.arange(900.).reshape(30, 30)
+    data_Fpsferr = np.ones((30, 30))
+
+    transients = zogy.find_transients(ctx, data_Scorr, data_Fpsf, data_Fpsferr,
+                                      cut_ima, cut_ima_fft, cut_fft)
+    order = np.argsort(transients['X_PEAK'])
+    assert list(transients['X_PEAK'][order]) == [4, 8]
+    assert list(transients['Y_PEAK'][order]) == [16, 6]
+    assert list(transients['SCORR_PEAK'][order]) == [-7., 8.]
+    assert list(transients['NPIX'][order]) == [1, 2]
+    assert list(transients['FLUX_PSF'][order]) == [data_Fpsf[20, 8], data_Fpsf[10, 12]]
+    # the centroid is weighted by |Scorr|
+    assert np.isclose(transients['X_POS'][order][1], 8 + 6./14)
+    assert np.isclose(transients['Y_POS'][order][1], 6.)
+
+
+def test_find_transients_peak_in_neighbour():
+    ctx = zogy.RunContext(timing=False, transient_nsigma=5)
+    # subimage in the middle of the image, whose border is on the image
+    cut_ima, cut_ima_fft, cut_fft = [20, 40, 20, 40], [15, 45, 15, 45], [0, 30, 0, 30]
+    data_Scorr = np.zeros((30, 30))
+    # peak in the border, which belongs to the neighbouring subimage
+    data_Scorr[2, 15] = 10.
+    data_Scorr[3, 15] = 6.
+    data_Scorr[15, 15] = 6.
+    transients = zogy.find_transients(ctx, data_Scorr, data_Scorr, np.ones((30, 30)),
+                                      cut_ima, cut_ima_fft, cut_fft)
+    assert list(transients['X_PEAK']) == [31]
+    assert list(transients['Y_PEAK']) == [31]
+
+
+def test_find_transients_none():
+    ctx = zogy.RunContext(timing=False)
+    data = np.zeros((30, 30))
+    transients = zogy.find_transients(ctx, data, data, data, [0, 20, 0, 20],
+                                      [0, 25, 0, 25], [5, 30, 5, 30])
+    assert all([len(transients[name]) == 0 for name in zogy.transient_names])
+
+
+def write_file(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def test_run_cached_invalidation(tmpdir):
+    input_file = str(tmpdir.join('input.txt'))
+    output_file = str(tmpdir.join('output.txt'))
+    write_file(input_file, 'a')
+    calls = []
+
+    def step(value):
+        calls.append(value)
+        write_file(output_file, 'result')
+        return value * 2
+
+    ctx = zogy.RunContext(verbose=False)
+    ctx.warm_cache = zogy.WarmCache()
+    run = lambda value: zogy.run_cached(ctx, 'seeing', [input_file], [output_file], step, value)
+
+    assert run(1) == 2
+    assert run(1) == 2
+    assert calls == [1]
+    # a different scalar argument
+    assert run(2) == 4
+    assert calls == [1, 2]
+    # a changed input file
+    write_file(input_file, 'ab')
+    assert run(2) == 4
+    assert calls == [1, 2, 2]
+    # a missing output file
+    os.remove(output_file)
+    assert run(2) == 4
+    assert calls == [1, 2, 2, 2]
+    # a changed setting that affects the stages
+    ctx.update(fwhm_frac=ctx.fwhm_frac/2.)
+    assert run(2) == 4
+    assert calls == [1, 2, 2, 2, 2]
+    # but not a setting that does not
+    ctx.update(verbose=True)
+    assert run(2) == 4
+    assert calls == [1, 2, 2, 2, 2]
+
+
+def test_run_cached_stage_record(tmpdir):
+    input_file = str(tmpdir.join('input.txt'))
+    output_file = str(tmpdir.join('output.txt'))
+    record = str(tmpdir.join('stages.pkl'))
+    write_file(input_file, 'a')
+    calls = []
+
+    def step():
+        calls.append(1)
+        write_file(output_file, 'result')
+        return 'done'
+
+    for nrun in range(2):
+        ctx = zogy.RunContext(verbose=False)
+        ctx.stages = zogy.Stages(record)
+        assert zogy.run_cached(ctx, 'seeing', [input_file], [output_file], step) == 'done'
+        ctx.stages.save()
+    assert len(calls) == 1
+
+    # the output file was rewritten by something else
+    write_file(output_file, 'other result')
+    ctx = zogy.RunContext(verbose=False)
+    ctx.stages = zogy.Stages(record)
+    zogy.run_cached(ctx, 'seeing', [input_file], [output_file], step)
+    assert len(calls) == 2
+
+
+def test_run_cached_fratio_scaling(tmpdir):
+    # the flux ratios are scaled with the gain ratio by the caller, as
+    # in optimal_subtraction; this must not change the cached result
+    input_file = str(tmpdir.join('input.psfexcat'))
+    record = str(tmpdir.join('stages.pkl'))
+    write_file(input_file, 'a')
+    gain_new, gain_ref = 4., 2.
+
+    def get_fratio():
+        return np.zeros(3), np.zeros(3), np.array([1., 2., 3.]), np.zeros(3), np.zeros(3)
+
+    ctx = zogy.RunContext(verbose=False)
+    ctx.warm_cache = zogy.WarmCache()
+    ctx.stages = zogy.Stages(record)
+    for nrun in range(2):
+        x, y, fratio, dra, ddec = zogy.run_cached(ctx, 'fratio', [input_file], [], get_fratio)
+        fratio *= gain_new / gain_ref
+        assert list(fratio) == [2., 4., 6.]
+    ctx.stages.save()
+
+    ctx = zogy.RunContext(verbose=False)
+    ctx.stages = zogy.Stages(record)
+    x, y, fratio, dra, ddec = zogy.run_cached(ctx, 'fratio', [input_file], [], get_fratio)
+    assert list(fratio) == [1., 2., 3.]
+
+
+def test_fits_writer_skips_after_error():
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def write_fails():
+        started.set()
+        release.wait()
+        raise IOError('disk full')
+
+    writer = zogy.FitsWriter()
+    writer.put(write_fails)
+    started.wait()
+    # queued while the write is failing, e.g. the checkpoint of the
+    # same subimage
+    writer.put(done.append, 'checkpoint')
+    release.set()
+    with pytest.raises(IOError):
+        writer.flush()
+    # the error stays in place for the later calls
+    with pytest.raises(IOError):
+        writer.put(done.append, 'next subimage')
+    with pytest.raises(IOError):
+        writer.close()
+    assert done == []
+
+
+def test_seeing_catalog():
+    ctx = zogy.RunContext(fwhm_imafrac=0.25)
+    assert zogy.seeing_catalog(ctx, 'new.sexcat') == 'new.sexcat_fraction'
+    ctx.update(fwhm_imafrac=1.)
+    assert zogy.seeing_catalog(ctx, 'new.sexcat') == 'new.sexcat'
+
+
+def test_stages_journal(tmpdir):
+    record = str(tmpdir.join('stages.pkl'))
+    stages = zogy.Stages(record)
+    stages.store('seeing:new.fits', 'key', [], 1.5)
+    stages.save()
+    stages.append('tile:new:0', 'key0', [], {'transients': None})
+    stages.append('tile:new:1', 'key1', [], {'transients': None})
+    # a run that is killed while appending leaves a truncated entry
+    with open(record+'.journal', 'ab') as f:
+        f.write('\x80\x02(')
+
+    stages = zogy.Stages(record)
+    assert stages.lookup('seeing:new.fits', 'key') == (True, 1.5)
+    assert stages.lookup('tile:new:1', 'key1') == (True, {'transients': None})
+    assert stages.lookup('tile:new:1', 'other key') == (False, None)
+    stages.save()
+    assert not os.path.isfile(record+'.journal')
+    assert zogy.Stages(record).lookup('tile:new:0', 'key0')[0]
+
+
+def test_sex_params_vignet(tmpdir):
+    file_params = str(tmpdir.join('sex.params'))
+    write_file(file_params, 'NUMBER\nVIGNET(9,9)   # Pixel data\n#VIGNET   commented out\nFLAGS\n')
+
+    lines = open(zogy.sex_params(file_params, str(tmpdir.join('lean.params')))).readlines()
+    assert lines == ['NUMBER\n', '#VIGNET   commented out\n', 'FLAGS\n']
+
+    lines = open(zogy.sex_params(file_params, str(tmpdir.join('psf.params')),
+                                 vignet=(45,45))).readlines()
+    assert lines[1] == 'VIGNET(45,45)   # Pixel data\n'
+    assert len(lines) == 4
+
+
+def test_sex_params_config(tmpdir):
+    # of the parameter file of the repository, only the VIGNET column
+    # is left out
+    file_params = os.path.join(repoDir, 'Config', 'sex.params')
+    lines_in = open(file_params).readlines()
+    lines = open(zogy.sex_params(file_params, str(tmpdir.join('lean.params')))).readlines()
+    removed = [line for line in lines_in if line not in lines]
+    assert len(lines) == len(lines_in) - 1
+    assert len(removed) == 1 and removed[0].startswith('VIGNET(9,9)')
+
+
+def source_catalog(nsources):
+    return {'FLUX_AUTO': np.arange(1., nsources+1),
+            'FLUXERR_AUTO': np.ones(nsources),
+            'FLAGS': np.zeros(nsources, dtype=int)}
+
+
+def test_select_sources_cuts():
+    cat = source_catalog(6)
+    cat['FLAGS'][1] = 4
+    cat['FLUXERR_AUTO'][2] = 10.
+    x = np.array([10., 20., 30., 0.2, np.nan, 40.])
+    y = np.array([10., 20., 30., 10., 10., 600.])
+    ctx = zogy.RunContext()
+    index, psf_cell = zogy.select_sources(ctx, cat, x, y, 512, 512)
+    assert list(index) == [0, 1, 2]
+    assert psf_cell is None
+
+    ctx.update(optflux_flags_mask=4, optflux_s2n_min=1.)
+    index, psf_cell = zogy.select_sources(ctx, cat, x, y, 512, 512)
+    assert list(index) == [0]
+
+
+def test_select_sources_density():
+    cat = source_catalog(10)
+    x = y = np.linspace(1., 900., 10)
+    ctx = zogy.RunContext(optflux_max_density=3)
+    index, psf_cell = zogy.select_sources(ctx, cat, x, y, 1000, 1000)
+    # the brightest three, in the order of the catalog
+    assert list(index) == [7, 8, 9]
+
+
+def test_select_sources_time_budget():
+    cat = source_catalog(10)
+    x = y = np.linspace(1., 500., 10)
+    ctx = zogy.RunContext(optflux_cost_psf=0.25, optflux_cost_flux=0.5,
+                          optflux_psf_cell=256, optflux_time_budget=8.)
+    index, psf_cell = zogy.select_sources(ctx, cat, x, y, 512, 512)
+    assert len(index) == 10 and psf_cell is None
+
+    # over budget: a PSF per cell (4 cells of 0.25 s), which leaves
+    # room for the brightest 6 sources of 0.5 s
+    ctx.update(optflux_time_budget=4.)
+    index, psf_cell = zogy.select_sources(ctx, cat, x, y, 512, 512)
+    assert psf_cell == 256
+    assert list(index) == [4, 5, 6, 7, 8, 9]
@@ -0,0 +1,113 @@
+"""
+Regression tests of the MEF handling of the DECam driver.
+
+Usage: python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pyfits as pf
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+sys.path.insert(0, os.path.join(repoDir, 'Driver'))
+import zogyDrive
+
+
+"""
+Write MEF MEFname with an extension per CCD in ccdnums, with CCD number n
+filled with the value n, and return the data of the extensions
+"""
+def writeMEF(MEFname, ccdnums, shape=(20, 30)):
+    primary = pf.PrimaryHDU()
+    primary.header['OBSID'] = 'test'
+    hdus = [primary]
+    data = []
+    for ccdnum in ccdnums:
+        data.append(np.zeros(shape, dtype='float32') + ccdnum)
+        hdu = pf.ImageHDU(data[-1])
+        hdu.header['CCDNUM'] = ccdnum
+        hdu.header['DETPOS'] = 'N%d' % ccdnum
+        hdus.append(hdu)
+    pf.HDUList(hdus).writeto(MEFname)
+    return data
+
+
+def test_MEFindex(tmpdir):
+    MEFname = str(tmpdir.join('image.fits'))
+    writeMEF(MEFname, [3, 1, 2])
+
+    index = zogyDrive.MEFindex(MEFname)
+    assert sorted(index['ccds']) == [1, 2, 3]
+    assert [index['ccds'][n]['ext'] for n in [3, 1, 2]] == [1, 2, 3]
+    assert pf.Header.fromstring(index['ccds'][1]['header'])['DETPOS'] == 'N1'
+    assert pf.Header.fromstring(index['primary'])['OBSID'] == 'test'
+    assert os.path.isfile(str(tmpdir.join('index', 'image.fits.json')))
+
+    # the stored index is read back with the same (integer) CCD numbers
+    assert zogyDrive.MEFindex(MEFname)['ccds'] == index['ccds']
+
+
+def test_MEFextract(tmpdir):
+    MEFname = str(tmpdir.join('image.fits'))
+    data = writeMEF(MEFname, [3, 1, 2])
+    index = zogyDrive.MEFindex(MEFname)['ccds']
+
+    outName = zogyDrive.ccdFile(str(tmpdir), MEFname, 1)
+    zogyDrive.MEFextract(MEFname, 1, index[1]['ext'], outName, GAIN=4.0)
+    hdulist = pf.open(outName)
+    assert np.all(hdulist[0].data == data[1])
+    assert hdulist[0].header['CCDNUM'] == 1
+    assert hdulist[0].header['OBSID'] == 'test'
+    assert hdulist[0].header['GAIN'] == 4.0
+    hdulist.close()
+
+
+def assembleRoundTrip(tmpdir, compress):
+    MEFname = str(tmpdir.join('image.fits'))
+    dataByCcd = dict(zip([3, 1, 2], writeMEF(MEFname, [3, 1, 2])))
+    index = zogyDrive.MEFindex(MEFname)
+
+    # a product per CCD, without the CCD headers
+    ccds = []
+    for ccdnum in sorted(index['ccds']):
+        productFile = str(tmpdir.join('D_%d.fits' % ccdnum))
+        pf.PrimaryHDU(dataByCcd[ccdnum]).writeto(productFile)
+        ccds.append((productFile, None, pf.Header.fromstring(index['ccds'][ccdnum]['header'])))
+
+    outputMEF = str(tmpdir.join('image_D.fits'))
+    zogyDrive.MEFassemble(ccds, outputMEF, pf.Header.fromstring(index['primary']), compress)
+
+    hdulist = pf.open(outputMEF)
+    assert hdulist[0].header['OBSID'] == 'test'
+    assert hdulist[0].header['NEXTEND'] == 3
+    assert len(hdulist) == 4
+    for ext, ccdnum in enumerate(sorted(index['ccds'])):
+        hdu = hdulist[ext+1]
+        assert hdu.header['CCDNUM'] == ccdnum
+        assert hdu.header['DETPOS'] == 'N%d' % ccdnum
+        assert np.allclose(hdu.data, dataByCcd[ccdnum])
+    hdulist.close()
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
+
+
+def test_MEFassemble(tmpdir):
+    assembleRoundTrip(tmpdir, None)
+
+
+def test_MEFassemble_compressed(tmpdir):
+    assembleRoundTrip(tmpdir, 'RICE_1')
+
+
+def test_readProduct_extname(tmpdir):
+    productFile = str(tmpdir.join('products.fits'))
+    pf.HDUList([pf.PrimaryHDU(),
+                pf.ImageHDU(np.ones((4, 5), dtype='float32'), name='D'),
+                pf.ImageHDU(np.zeros((4, 5), dtype='float32'), name='Scorr')]).writeto(productFile)
+    header, data = zogyDrive.readProduct(productFile, extname='D')
+    assert header['EXTNAME'] == 'D'
+    assert np.all(data == 1)
+    header, data = zogyDrive.readProduct(productFile)
+    assert header['EXTNAME'] == 'SCORR'
@@ -1,32 +1,40 @@
 
 import argparse
 import astropy.io.fits as fits
-from astropy.io import ascii
-from astropy.stats import sigma_clipped_stats
 from astropy.wcs import WCS
 import numpy as np
 #import numpy.fft as fft
-import matplotlib.pyplot as plt
 import os
 from subprocess import call
+import subprocess
 from scipy import ndimage
-from scipy import stats
 import time
 import importlib
+import sys
+import copy
+import threading
+import Queue
+import json
+import glob
+import pickle
+import collections
+import traceback
+import functools
+import hashlib
+import shutil
+import re
 # these are important to speed up the FFTs
 import pyfftw
 import pyfftw.interfaces.numpy_fft as fft
 pyfftw.interfaces.cache.enable()
 pyfftw.interfaces.cache.set_keepalive_time(1.)
 
-#from photutils import CircularAperture
-#from photutils import make_source_mask
-from photutils import Background2D, SigmaClip, MedianBackground
-
-# for PSF fitting - see https://lmfit.github.io/lmfit-py/index.html
-from lmfit import minimize, Minimizer, Parameters, Parameter, report_fit
-
-from sip_tpv import *
+# the modules that are only needed by optional parts of the code
+# (matplotlib.pyplot for [make_plots], photutils for [bkg_method]=4,
+# lmfit for PSF fitting, sip_tpv when Astrometry.net is run and
+# astropy.io.ascii for the PSFex catalogs) are imported where they
+# are used, so that they do not add to the startup time of the
+# processes that do not need them; see Bench/startup.py
 
 import resource
 
@@ -55,11 +63,29 @@ bkg_filtersize = 5       # size of filter used for smoothing the above
 fratio_local = False     # determine fratio (Fn/Fr) from subimage (T) or full frame (F)
 dxdy_local = False       # determine dx and dy from subimage (T) or full frame (F)
 transient_nsigma = 5     # required significance in Scorr for transient detection
+transient_extract = True # extract the transient candidates from Scorr
+                         # (see [find_transients]) and write them to
+                         # [base_new]_trans.fits
 
 # optional fake stars
 nfakestars = 1           # number of fake stars to be added to each subimage
                          # if 1: star will be at the center, if > 1: randomly distributed
 fakestar_s2n = 50        # required signal-to-noise ratio of the fake stars    
+fakestar_psfex = False   # if nfakestars > 1: use the PSFex PSF at the position
+                         # of each fake star (shifted to its subpixel
+                         # position) instead of the PSF at the subimage center
+
+# injection-recovery completeness (see [run_completeness])
+completeness = False     # measure the completeness of the transient detection
+                         # in each subimage and write it to
+                         # [base_new]_completeness.fits; nfakestars
+                         # should normally be zero in this mode
+completeness_ntrials = 10 # number of injection trials per subimage
+completeness_nstars = 100 # number of fake stars per subimage and trial
+completeness_dmag = [-1.5, -1.25, -1., -0.75, -0.5, -0.25, 0., 0.25, 0.5,
+                     0.75, 1., 1.25, 1.5]
+                         # grid of magnitudes of the fake stars relative to
+                         # a point source with a S/N of [transient_nsigma]
 
 # switch on/off different functions
 dosex = False            # do extra SExtractor run (already done inside Astrometry.net)
@@ -100,6 +126,24 @@ psf_sampling = 2.0       # sampling factor used in PSFex - if zero, it
                          # ref image (~FWHM/4.5); if non-zero, it is
                          # fixed to the same sampling for both images
 
+# selection of the sources of which the optimal flux is determined
+# (see [select_sources]); sources off the image are always skipped
+optflux_flags_mask = 0   # skip sources with any of these SExtractor FLAGS
+                         # bits set (e.g. 4: saturated); 0 = no cut
+optflux_s2n_min = 0.     # skip sources with FLUX_AUTO/FLUXERR_AUTO below this
+optflux_max_density = None # if not None, maximum number of sources per
+                         # million pixels; the brightest are kept
+optflux_time_budget = None # if not None, the time [s] that the optimal
+                         # photometry of an image may take; if the cost
+                         # predicted from the number of sources exceeds
+                         # it, the PSF is built once per cell of
+                         # [optflux_psf_cell] pixels instead of for each
+                         # source, and if that is still too slow, only
+                         # the brightest sources that fit in are kept
+optflux_psf_cell = 256   # size [pixels] of the cells of the coarse mode
+optflux_cost_psf = 2e-3  # predicted time [s] to build the PSF of a source
+optflux_cost_flux = 1e-3 # predicted time [s] of the optimal flux of a source
+
 # Astrometry.net's tweak order
 astronet_tweak_order = 3
 
@@ -111,6 +155,12 @@ sex_par = cfg_dir+'sex.params'     # SExtractor output parameters definition fil
 sex_par_psffit = cfg_dir+'sex_psffit.params' # same for PSF-fitting version
 sex_mask_par = cfg_dir+'sex_mask.params'     # SExtractor output parameters definition file
 sex_mask_par_psffit = cfg_dir+'sex_mask_psffit.params' # same for PSF-fitting version
+sex_par_lean = True      # leave the VIGNET column out of the catalogs of
+                         # the SExtractor runs that are not used by PSFex
+                         # (seeing estimate and photometry); the PSFex
+                         # input catalog made in [run_wcs] keeps it
+sex_filter = cfg_dir+'default.conv' # SExtractor detection filter
+sex_nnw = cfg_dir+'default.nnw'     # SExtractor star/galaxy neural network
 psfex_cfg = cfg_dir+'psfex.config' # PSFex configuration file
 swarp_cfg = cfg_dir+'swarp.config' # SWarp configuration file
 
@@ -119,6 +169,12 @@ apphot_radii = [0.67, 1, 1.5, 2, 3, 5, 7, 10] # list of radii in units
                                               # aperture photometry in
                                               # SExtractor general
 
+tool_nproc = 2           # maximum number of external programs (SExtractor,
+                         # PSFex, SWarp, Astrometry.net) run at the same
+                         # time by this process, shared by all its runs
+                         # (see [ToolExecutor]); if larger than 1, the new
+                         # and ref images are prepared concurrently
+
 redo = True         # execute functions even if output file exist
 verbose = True          # print out extra info
 timing = True            # (wall-)time the different functions
@@ -127,12 +183,700 @@ make_plots = False        # make diagnostic plots and save them as pdf
 show_plots = False       # show diagnostic plots
 use_existing_wcs = False # Use existing wcs in new and ref images instead of running astrometry.net
 
+# output products D, S, Scorr, Scorr_abs, Fpsf and Fpsferr
+output_compress = None   # tile compression of the output products: None
+                         # (uncompressed float32), 'RICE_1' or 'HCOMPRESS_1'
+output_quantize = {'D': 16, 'S': -0.01, 'Scorr': -0.01, 'Scorr_abs': -0.01,
+                   'Fpsf': 16, 'Fpsferr': 16}
+                         # quantization level per product used with
+                         # compression; if positive, the quantization step
+                         # is the noise in each tile divided by this
+                         # value; if negative, its absolute value is the
+                         # quantization step itself, which is used for S
+                         # and Scorr as they are in units of sigma (a step
+                         # of 0.01 adds a noise of 0.01/sqrt(12) sigma)
+output_mef = False       # write all products as extensions of a single
+                         # file [output_mef_name] instead of separate files
+output_mef_name = 'products.fits'
+output_Scorr_abs = True  # also write Scorr_abs, which is |Scorr|
+
+# instrumentation
+instrument = False       # record the wall time, CPU time, peak memory and
+                         # I/O of the different stages (see [Spans]) and
+                         # write them to [base_new]_spans.json
+instrument_log = None    # if not None, also append the record of each run
+                         # as a single line of JSON to this file
+
+# profiling
+profile = False          # run cProfile over [optimal_subtraction] and write
+                         # the stats to [base_new]_profile.prof and a summary
+                         # of the hot spots to [base_new]_profile.txt
+profile_nsub = None      # if not None, only profile the processing of this
+                         # subimage (the loop over the subimages), which is
+                         # much cheaper for large frames
+profile_hotspots = 'flux_optimal|clipped_stats|get_psf_xycoords|fft'
+                         # regular expression of the functions that are
+                         # listed separately in the profile summary
+
+# incremental processing
+incremental = False      # record the fingerprints and results of the stages
+                         # in [stage_graph] in [base_new]_stages.pkl, and
+                         # only redo the stages (and subimages) whose inputs
+                         # changed since the previous run
+checkpoint = False       # as [incremental], but the record is also saved
+                         # before the loop over the subimages and after each
+                         # finished subimage, so that a run that is killed
+                         # can be restarted without redoing the finished ones
+
+# the settings above that are copied into each [RunContext], and that
+# can be overridden by the settings file (Constants) of a telescope
+settings_keys = ['subimage_size', 'subimage_border', 'bkg_method', 'bkg_nsigma',
+                 'bkg_boxsize', 'bkg_filtersize', 'fratio_local', 'dxdy_local',
+                 'transient_nsigma', 'transient_extract', 'nfakestars', 'fakestar_s2n',
+                 'fakestar_psfex', 'completeness', 'completeness_ntrials',
+                 'completeness_nstars', 'completeness_dmag', 'dosex',
+                 'dosex_psffit', 'key_gain', 'key_ron', 'key_satlevel', 'key_ra',
+                 'key_dec', 'key_pixscale', 'key_exptime', 'key_seeing',
+                 'fwhm_imafrac', 'fwhm_detect_thresh', 'fwhm_class_sort', 'fwhm_frac',
+                 'use_single_psf', 'psf_clean_factor', 'psf_radius', 'psf_sampling',
+                 'optflux_flags_mask', 'optflux_s2n_min', 'optflux_max_density',
+                 'optflux_time_budget', 'optflux_psf_cell', 'optflux_cost_psf',
+                 'optflux_cost_flux',
+                 'astronet_tweak_order', 'cfg_dir', 'sex_cfg', 'sex_cfg_psffit',
+                 'sex_par', 'sex_par_psffit', 'sex_mask_par', 'sex_mask_par_psffit',
+                 'sex_par_lean', 'sex_filter', 'sex_nnw', 'psfex_cfg', 'swarp_cfg', 'apphot_radii',
+                 'tool_nproc', 'redo', 'verbose', 'timing', 'display', 'make_plots', 'show_plots',
+                 'output_compress', 'output_quantize', 'output_mef', 'output_mef_name',
+                 'output_Scorr_abs', 'instrument', 'instrument_log', 'profile',
+                 'profile_nsub', 'profile_hotspots', 'incremental', 'checkpoint']
+
+# the settings that do not affect the results of the stages, which are
+# left out of their fingerprints (see [settings_digest])
+settings_nostage = ['tool_nproc', 'redo', 'verbose', 'timing', 'display', 'make_plots', 'show_plots',
+                    'output_compress', 'output_quantize', 'output_mef', 'output_mef_name',
+                    'output_Scorr_abs', 'instrument', 'instrument_log', 'profile',
+                    'profile_nsub', 'profile_hotspots', 'incremental', 'checkpoint']
+
+# the stages of [optimal_subtraction] that are recorded if
+# [incremental] is True, each with the stages whose output it
+# depends on; a stage is performed for both the new and the ref
+# image, and its fingerprint is derived from the versions of its
+# input files (including the outputs of the earlier stages), the
+# settings and its scalar arguments, so that a change propagates
+# through the graph. The subimages ('tile') are fingerprinted by the
+# data that go into [run_ZOGY].
+stage_graph = collections.OrderedDict([
+    ('seeing', []),                  # SExtractor catalog and seeing estimate
+    ('wcs', []),                     # Astrometry.net or existing WCS solution
+    ('remap', ['wcs']),              # ref image remapped to the new image
+    ('background', ['wcs']),         # background and STD maps
+    ('bkg_remap', ['wcs', 'background']), # ref maps remapped to the new image
+    ('psfex', ['wcs']),              # PSFex run
+    ('psf', ['wcs', 'psfex']),       # PSF at the subimage centers
+    ('optflux', ['remap', 'background', 'bkg_remap', 'psf']), # optimal fluxes
+    ('fratio', ['psf']),             # flux ratio and dx, dy of the PSF stars
+    ('tile', ['remap', 'background', 'bkg_remap', 'psf', 'fratio']), # run_ZOGY
+    ('products', ['tile']),          # output images
+])
+
+
+################################################################################
+
+class RunContext(object):
+
+    """Settings and state of a single run of [optimal_subtraction],
+    which are passed on to the functions that it calls, so that
+    several image pairs can be processed in the same process, also
+    concurrently in different threads, without the runs affecting
+    each other.
+
+    The settings in [settings_keys] start out as (copies of) the
+    module-level values at the top of this file. If [telescope] is
+    not None, those defined in the settings file (Constants) of that
+    telescope replace them, and finally any [settings] keyword
+    arguments are applied, e.g. RunContext('Decam', verbose=False).
+
+    The state of the run - the base names of the new and ref images
+    (base_new and base_ref), their directories (output_dir and
+    template_dir), the size of the new image PSF (psf_size_new), the
+    open fits files (fits_cache) and the recorded stages (spans, if
+    [instrument] is True) - is set during the run.
+
+    If [warm_cache] is not None, it is a [WarmCache] that is shared
+    between the runs performed by a long-lived process (see [serve]),
+    in which the results of the steps that only depend on unchanged
+    input files (e.g. the WCS solution and PSF of a reference image)
+    are kept. Similarly, if [incremental] is True, [stages] is the
+    [Stages] record of the previous run on the same new image.
+
+    """
+
+    def __init__(self, telescope=None, **settings):
+
+        module = sys.modules[__name__]
+        for key in settings_keys:
+            setattr(self, key, copy.deepcopy(getattr(module, key)))
+
+        if telescope is not None:
+            self.load_telescope(telescope)
+
+        self.update(**settings)
+
+        self.base_new = None
+        self.base_ref = None
+        self.output_dir = None
+        self.template_dir = None
+        self.psf_size_new = None
+        self.fits_cache = {}
+        self.warm_cache = None
+        self.spans = None
+        self.stages = None
+
+    def update(self, **settings):
+        for key, value in settings.items():
+            if key not in settings_keys:
+                raise ValueError('unknown setting: {}'.format(key))
+            setattr(self, key, value)
+
+    def load_telescope(self, telescope):
+        Constants = importlib.import_module(telescope)
+        for key in settings_keys:
+            if hasattr(Constants, key):
+                setattr(self, key, copy.deepcopy(getattr(Constants, key)))
+
+    def read_fits(self, filename, **kwargs):
+        return read_fits(filename, cache=self.fits_cache, **kwargs)
+
+    def read_fits_header(self, filename, ext=None):
+        return read_fits_header(filename, ext=ext, cache=self.fits_cache)
+
+    def read_catalog(self, filename, ext=2):
+        return Catalog(filename, ext=ext, cache=self.fits_cache)
+
+    def close_fits(self, filename=None):
+        close_fits(filename, cache=self.fits_cache)
+
+    def span(self, name, **attrs):
+        if self.spans is None:
+            return null_span
+        return Span(self.spans, name, attrs)
+
+################################################################################
+
+def value_nbytes(value):
+
+    """Function that returns the number of bytes held by the numpy
+    arrays in [value], including those in (nested) tuples, lists and
+    dictionaries."""
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(value_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(value_nbytes(item) for item in value.values())
+    return 0
+
+################################################################################
+
+def copy_arrays(value):
+
+    """Function that returns [value] with the numpy arrays in it,
+    including those in (nested) tuples, lists and dictionaries,
+    replaced by copies."""
+
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(copy_arrays(item) for item in value)
+    if isinstance(value, list):
+        return [copy_arrays(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, copy_arrays(item)) for key, item in value.items())
+    return value
+
+################################################################################
+
+class WarmCache(object):
+
+    """Thread-safe cache shared by the runs of a long-lived process,
+    holding up to [maxsize] entries with arrays (see [value_nbytes])
+    of up to [maxbytes] bytes in total; when full, the least recently
+    used entries are removed. A value larger than [maxbytes] is not
+    cached at all."""
+
+    def __init__(self, maxsize=256, maxbytes=1<<30):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        nbytes = value_nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.nbytes -= self.sizes.pop(key)
+            if nbytes > self.maxbytes:
+                return
+            self.entries[key] = value
+            self.sizes[key] = nbytes
+            self.nbytes += nbytes
+            while (len(self.entries) > self.maxsize or
+                   self.nbytes > self.maxbytes):
+                key_old, value_old = self.entries.popitem(last=False)
+                self.nbytes -= self.sizes.pop(key_old)
+
+################################################################################
+
+def file_signature(filename):
+
+    """Function that returns a tuple identifying the current version of
+    [filename]: its absolute path, inode, size and modification time,
+    or None if the file does not exist."""
+
+    key = os.path.abspath(filename)
+    try:
+        stat = os.stat(key)
+    except OSError:
+        return None
+    return (key, stat.st_ino, stat.st_size, stat.st_mtime)
+
+################################################################################
+
+def run_cached(ctx, step, inputs, outputs, func, *args, **kwargs):
+
+    """Function that returns func(*[args], **[kwargs]), where [func]
+    performs [step] on the files [inputs] and writes the files
+    [outputs] (both lists of filenames; None entries are ignored). If
+    [ctx].warm_cache is not None and the same step was already
+    performed on the same version of the input files, with the same
+    settings and scalar arguments, and the output files are still the
+    ones written then, the result of that earlier call is returned
+    instead of calling [func] again. The same applies to the record
+    of the previous run in [ctx].stages for the steps in
+    [stage_graph]. The numpy arrays in the result are copies (see
+    [copy_arrays]), so that the caller can change them without
+    changing the cached result.
+
+    """
+
+    stages = ctx.stages if step in stage_graph else None
+    if ctx.warm_cache is None and stages is None:
+        return func(*args, **kwargs)
+
+    inputs = [f for f in inputs if f]
+    outputs = [f for f in outputs if f]
+    signatures = tuple(file_signature(f) for f in inputs)
+    if None in signatures:
+        return func(*args, **kwargs)
+
+    scalars = (tuple(repr(arg) for arg in args if np.isscalar(arg)) +
+               tuple(repr(item) for item in sorted(kwargs.items())
+                     if item[1] is None or np.isscalar(item[1])))
+    key = (step, settings_digest(ctx), scalars) + signatures
+    name = '{}:{}'.format(step, os.path.abspath(inputs[0]))
+
+    if ctx.warm_cache is not None:
+        entry = ctx.warm_cache.get(key)
+        if (entry is not None and
+            entry[1] == [file_signature(f) for f in outputs]):
+            if ctx.verbose:
+                print 'reusing result of {} on {}'.format(step, inputs[0])
+            if stages is not None:
+                stages.store(name, key, outputs, entry[0], reused=True)
+            return copy_arrays(entry[0])
+
+    if stages is not None:
+        found, result = stages.lookup(name, key)
+        if found:
+            if ctx.verbose:
+                print 'reusing result of {} on {} from previous run'.format(step, inputs[0])
+            return copy_arrays(result)
+
+    result = func(*args, **kwargs)
+    if ctx.warm_cache is not None:
+        ctx.warm_cache.put(key, (result, [file_signature(f) for f in outputs]))
+    if stages is not None:
+        stages.store(name, key, outputs, result)
+    return copy_arrays(result)
+
+################################################################################
+
+def checkpoint_tile(ctx, tile_name, tile_key, result, tile_file=None, tile_products=None):
+
+    """Function that records the subimage [tile_name] with fingerprint
+    [tile_key] and [result] in [ctx].stages, after its products have
+    been written (it is called by the [FitsWriter] thread after the
+    writes of the subimage). If [tile_products] is not None, it is
+    a dictionary with the products of the subimage, which are
+    written to [tile_file] first. The file is written under a
+    temporary name and renamed when complete, so that a run that is
+    killed never leaves a partial subimage file behind. If
+    [ctx].checkpoint is True, the entry is also appended to the
+    journal of the record (see [Stages])."""
+
+    outputs = []
+    if tile_products is not None:
+        with open(tile_file+'.tmp', 'wb') as f:
+            np.savez(f, **tile_products)
+        os.rename(tile_file+'.tmp', tile_file)
+        outputs = [tile_file]
+
+    if ctx.checkpoint:
+        ctx.stages.append(tile_name, tile_key, outputs, result)
+    else:
+        ctx.stages.store(tile_name, tile_key, outputs, result)
+
+################################################################################
+
+def settings_digest(ctx):
+
+    """Function that returns a digest of the settings in [ctx] that
+    affect the results of the stages of the run."""
+
+    items = [(key, getattr(ctx, key)) for key in settings_keys
+             if key not in settings_nostage]
+    return hashlib.sha1(repr(items)).hexdigest()
+
+################################################################################
+
+def array_digest(*arrays):
+
+    """Function that returns a digest of the contents of [arrays]
+    (numpy arrays or scalars)."""
+
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+################################################################################
+
+class Stages(object):
+
+    """Record of the stages performed by a run of
+    [optimal_subtraction] on a new image, kept in the pickle file
+    [filename] for the next run on the same image (see [incremental]
+    and [run_cached]). For each stage, identified by its name, the
+    record holds the fingerprint of its inputs, the signatures of its
+    output files and its result. The entries added with [append]
+    (the finished subimages in [checkpoint] mode) are only appended
+    to the journal [filename].journal, which is read back after the
+    record and merged into it by [save]."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal = filename+'.journal'
+        self.entries = {}
+        self.reused = []
+        self.done = []
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    self.entries = pickle.load(f)
+            except Exception:
+                print 'Warning: ignoring unreadable stage record', filename
+        if os.path.isfile(self.journal):
+            with open(self.journal, 'rb') as f:
+                while True:
+                    try:
+                        name, entry = pickle.load(f)
+                    except Exception:
+                        # end of the journal, or an entry that was
+                        # cut off when the run was killed
+                        break
+                    self.entries[name] = entry
+
+    def lookup(self, name, key, check_outputs=True):
+        """Returns (True, result) if [name] was performed with the
+        fingerprint [key] and (if [check_outputs]) its output files
+        were not changed since, and (False, None) otherwise."""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry['key'] != key:
+            return False, None
+        if (check_outputs and
+            entry['outputs'] != [(f, file_signature(f)) for f, sig in entry['outputs']]):
+            return False, None
+        with self.lock:
+            self.reused.append(name)
+        return True, entry['result']
+
+    def store(self, name, key, outputs, result, reused=False):
+        entry = {'key': key, 'result': result,
+                 'outputs': [(f, file_signature(f)) for f in outputs]}
+        with self.lock:
+            self.entries[name] = entry
+            (self.reused if reused else self.done).append(name)
+
+    def append(self, name, key, outputs, result):
+        """Stores the entry as [store] does, and appends it to the
+        journal instead of rewriting the whole record."""
+        self.store(name, key, outputs, result)
+        with self.lock:
+            with open(self.journal, 'ab') as f:
+                pickle.dump((name, self.entries[name]), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def save(self):
+        """Writes the record, replacing the previous one only when it
+        has been written completely, after which the journal is
+        removed."""
+        with self.lock:
+            with open(self.filename+'.tmp', 'wb') as f:
+                pickle.dump(self.entries, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(self.filename+'.tmp', self.filename)
+            if os.path.isfile(self.journal):
+                os.remove(self.journal)
+
+    def summary(self):
+        """Returns the number of stages that were reused and redone,
+        per stage in [stage_graph]."""
+        lines = []
+        for stage in stage_graph:
+            nreused = len([n for n in self.reused if n.split(':')[0]==stage])
+            ndone = len([n for n in self.done if n.split(':')[0]==stage])
+            if nreused + ndone > 0:
+                lines.append('{:12s} reused: {:3d}  redone: {:3d}'.format(stage, nreused, ndone))
+        return '\n'.join(lines)
+
+################################################################################
+
+def resource_sample():
+
+    """Function that returns a dictionary with the current wall time,
+    the CPU time used by this process and by its finished child
+    processes (e.g. SExtractor), their peak resident memory in MB and
+    the number of bytes read and written by this process, both
+    through system calls (bytes_read, bytes_written) and from/to
+    storage (disk_read, disk_written). The I/O counters are taken from
+    /proc/self/io and are None if it is not available.
+
+    """
+
+    times = os.times()
+    sample = {'wall': time.time(),
+              'cpu': times[0] + times[1],
+              'cpu_children': times[2] + times[3],
+              # ru_maxrss is in kilobytes on Linux
+              'maxrss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+              'maxrss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.}
+
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except (IOError, ValueError):
+        pass
+    sample['bytes_read'] = io.get('rchar')
+    sample['bytes_written'] = io.get('wchar')
+    sample['disk_read'] = io.get('read_bytes')
+    sample['disk_written'] = io.get('write_bytes')
+    return sample
+
+################################################################################
+
+def resource_delta(start, end):
+
+    """Function that returns the resources used between the samples
+    [start] and [end] from [resource_sample]; the peak memory is the
+    value at [end], as it cannot be determined for a time interval."""
+
+    delta = {}
+    for key in start:
+        if key.startswith('maxrss'):
+            delta[key] = end[key]
+        elif start[key] is None or end[key] is None:
+            delta[key] = None
+        else:
+            delta[key] = end[key] - start[key]
+    return delta
+
+################################################################################
+
+class Spans(object):
+
+    """Record of the stages (spans) of a single run, e.g. a call to
+    [run_sextractor] or the [run_ZOGY] call of a single subimage. The
+    spans are nested per thread: each span refers to the span it was
+    started in (parent). For each span the wall time, the CPU time,
+    the peak resident memory and the bytes read and written are
+    recorded (see [resource_sample]). The CPU time and I/O are those
+    of the whole process, so they include the work done by other
+    threads (e.g. [FitsWriter]) in the same time interval.
+
+    """
+
+    def __init__(self):
+        self.start = resource_sample()
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def record(self, **info):
+
+        """Returns the record of the run: the resources used since the
+        start of the run and the list of spans, with [info] added."""
+
+        record = dict(info)
+        record['start'] = self.start['wall']
+        record.update(resource_delta(self.start, resource_sample()))
+        with self.lock:
+            record['spans'] = list(self.records)
+        return record
+
+    def write(self, filename, log=None, **info):
+
+        """Writes the record of the run to the JSON file [filename]
+        and, if [log] is not None, appends it as a single line to the
+        file [log]."""
+
+        record = self.record(**info)
+        with open(filename, 'w') as f:
+            json.dump(record, f, indent=1)
+        if log is not None:
+            with open(log, 'a') as f:
+                f.write(json.dumps(record)+'\n')
+
+################################################################################
+
+class Span(object):
+
+    """Context manager that adds a span with name [name] and the
+    extra items [attrs] (e.g. the subimage number) to [spans]."""
+
+    def __init__(self, spans, name, attrs):
+        self.spans = spans
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = self.spans.stack()
+        with self.spans.lock:
+            self.id = len(self.spans.records)
+            self.spans.records.append(None)
+        self.parent = stack[-1] if stack else None
+        stack.append(self.id)
+        self.start = resource_sample()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        end = resource_sample()
+        self.spans.stack().pop()
+        record = {'name': self.name, 'id': self.id, 'parent': self.parent,
+                  'thread': threading.current_thread().name,
+                  'start': self.start['wall'] - self.spans.start['wall'],
+                  'error': exc_type is not None}
+        record.update(self.attrs)
+        record.update(resource_delta(self.start, end))
+        self.spans.records[self.id] = record
+        return False
+
+################################################################################
+
+class NullSpan(object):
+
+    """Context manager that does nothing, used instead of a [Span] if
+    the instrumentation is switched off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+null_span = NullSpan()
+
+################################################################################
+
+def write_profile(ctx, profiler, nlines=30):
+
+    """Function that writes the stats collected by the cProfile
+    [profiler] to [base_new]_profile.prof, which can be inspected with
+    the pstats module or e.g. snakeviz, and a summary listing the
+    [nlines] functions with the largest cumulative time and the
+    functions matching [profile_hotspots] to [base_new]_profile.txt.
+    The summary is also printed.
+
+    """
+
+    import pstats
+    import StringIO
+
+    base = ctx.base_new+'_profile'
+    profiler.dump_stats(base+'.prof')
+
+    stream = StringIO.StringIO()
+    if ctx.profile_nsub is not None:
+        stream.write('profile of subimage {}\n'.format(ctx.profile_nsub))
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats('cumulative')
+    stream.write('top {} functions by cumulative time:\n'.format(nlines))
+    stats.print_stats(nlines)
+    stream.write('hot spots ({}):\n'.format(ctx.profile_hotspots))
+    stats.print_stats(ctx.profile_hotspots)
+    summary = stream.getvalue()
+
+    with open(base+'.txt', 'w') as f:
+        f.write(summary)
+    print summary
+
+################################################################################
+
+def instrumented(func):
+
+    """Decorator that records each call of [func], which takes the
+    [RunContext] as first argument, as a span with the name of
+    [func]."""
+
+    @functools.wraps(func)
+    def wrapper(ctx, *args, **kwargs):
+        with ctx.span(func.__name__):
+            return func(ctx, *args, **kwargs)
+    return wrapper
+
+################################################################################
+
+def read_wcs(ctx, wcsfile):
+
+    """Function that returns the astropy WCS defined by the header in
+    [wcsfile], which is kept in [ctx].warm_cache (if not None) as long
+    as the file does not change."""
+
+    return run_cached(ctx, 'read_wcs', [wcsfile], [], WCS, wcsfile)
 
 ################################################################################
 
 def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
                         telescope=None, log=None, use_existing_wcs = False,
-                        new_mask=None, ref_mask=None, new_wt=None, ref_wt=None):
+                        new_mask=None, ref_mask=None, new_wt=None, ref_wt=None,
+                        ctx=None, settings=None):
     
     """Function that accepts a new and a reference fits image, finds their
     WCS solution using Astrometry.net, runs SExtractor (inside
@@ -152,6 +896,14 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
       https://github.com/stargaser/sip_tpv/blob/master/sip_to_pv.py
     - pyfftw to speed up the many FFTs performed
     - the other modules imported at the top
+
+    The settings and the state of the run are kept in [ctx], a
+    [RunContext]. If [ctx] is None, a new one is created from the
+    settings at the top of this file and, if [telescope] is not
+    None, the settings file of [telescope], updated with the
+    dictionary [settings] (e.g. {'profile': True}); [telescope],
+    [use_existing_wcs] and [settings] only apply to such a new run
+    context.
  
     Written by Paul Vreeswijk (pmvreeswijk@gmail.com) with vital input
     from Barak Zackay and Eran Ofek. Adapted by Kerry Paterson for
@@ -161,121 +913,109 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
 
     start_time1 = os.times()
 
-    if use_existing_wcs:
-        dosex = True
-        
-    if telescope is not None:
-
-        # If telescope is defined), all
-        # the global parameters below are taken from the 
-        # settings file (Constants) for a particular telescope rather
-        # than their definitions at the top of this file. For the
-        # parameter descriptions, see above.
-
-        Constants = importlib.import_module(telescope)
-
-#        reload(Constants)
-        
-        # make these global parameters
-        global subimage_size, subimage_border, bkg_method, bkg_nsigma, bkg_boxsize, bkg_filtersize, fratio_local, dxdy_local, transient_nsigma, nfakestars, fakestar_s2n, dosex, dosex_psffit, pixelscale, fwhm_imafrac, fwhm_detect_thresh, fwhm_class_sort, fwhm_frac, use_single_psf, psf_clean_factor, psf_radius, psf_sampling, cfg_dir, sex_cfg, sex_cfg_psffit, sex_par, sex_par_psffit, sex_mask_par, sex_mask_par_psffit, sex_filter, sex_nnw, psfex_cfg, swarp_cfg, apphot_radii, redo, verbose, timing, display, make_plots, show_plots
-
-
-        subimage_size = Constants.subimage_size
-        subimage_border = Constants.subimage_border
-
-        bkg_method = Constants.bkg_method
-        bkg_nsigma = Constants.bkg_nsigma
-        bkg_boxsize = Constants.bkg_boxsize
-        bkg_filtersize = Constants.bkg_filtersize
+    if ctx is None:
+        ctx = RunContext()
+        if use_existing_wcs:
+            ctx.dosex = True
+        if telescope is not None:
+            # If telescope is defined, the settings are taken from
+            # the settings file (Constants) for a particular telescope
+            # rather than their definitions at the top of this file.
+            # For the parameter descriptions, see above.
+            ctx.load_telescope(telescope)
+            print 'sex_mask_par: ', ctx.sex_mask_par
+        if settings is not None:
+            ctx.update(**settings)
+
+    if ctx.instrument:
+        ctx.spans = Spans()
+
+    profiler = None
+    if ctx.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        if ctx.profile_nsub is None:
+            profiler.enable()
 
-        fratio_local  = Constants.fratio_local
-        dxdy_local = Constants.dxdy_local
-        transient_nsigma = Constants.transient_nsigma
-
-        nfakestars = Constants.nfakestars
-        fakestar_s2n = Constants.fakestar_s2n
-
-        dosex = Constants.dosex
-        dosex_psffit = Constants.dosex_psffit
-
-        # pixelscale - this parameter is not used anywhere below
-        #pixelscale = Constants.pixel_scale
-
-        fwhm_imafrac = Constants.fwhm_imafrac
-        fwhm_detect_thresh = Constants.fwhm_detect_thresh
-        fwhm_class_sort = Constants.fwhm_class_sort
-        fwhm_frac = Constants.fwhm_frac
-        
-        use_single_psf = Constants.use_single_psf
-        psf_clean_factor = Constants.psf_clean_factor        
-        psf_radius = Constants.psf_radius
-        psf_sampling = Constants.psf_sampling
-
-        cfg_dir = Constants.cfg_dir
-        sex_cfg = Constants.sex_cfg
-        sex_cfg_psffit = Constants.sex_cfg_psffit
-        sex_par = Constants.sex_par
-        sex_par_psffit = Constants.sex_par_psffit
-        sex_mask_par = Constants.sex_mask_par
-        sex_mask_par_psffit = Constants.sex_mask_par_psffit
-        sex_filter = Constants.sex_filter
-        sex_nnw = Constants.sex_nnw
-        psfex_cfg = Constants.psfex_cfg
-        swarp_cfg = Constants.swarp_cfg
-
-        apphot_radii = Constants.apphot_radii
-
-        redo = Constants.redo
-        verbose = Constants.verbose
-        timing = Constants.timing
-        display = Constants.display
-        make_plots = Constants.make_plots
-        show_plots = Constants.show_plots
-
-        print 'sex_mask_par: ', sex_mask_par
-
-        
     # define the base names of input fits files, base_new and
-    # base_ref, as global so they can be used in any function in this
-    # module
-    global base_new, base_ref, output_dir, template_dir
+    # base_ref, in the run context so they can be used in any function
+    # in this module
+    ctx.base_new = new_fits.split('.fits')[0]
+    ctx.base_ref = ref_fits.split('.fits')[0]
 
-    base_new = new_fits.split('.fits')[0]
-    base_ref = ref_fits.split('.fits')[0]
+    (ctx.output_dir, base_unused) = os.path.split(new_fits)
 
-    (output_dir, base_unused) = os.path.split(new_fits)
+    (ctx.template_dir, base_unused) = os.path.split(ref_fits)
 
-    (template_dir, base_unused) = os.path.split(ref_fits)
+    if ctx.incremental or ctx.checkpoint:
+        ctx.stages = Stages(ctx.base_new+'_stages.pkl')
         
     # read in header of new_fits
     t = time.time()
-    with fits.open(new_fits) as hdulist:
-        header_new = hdulist[0].header
-    keywords = ['NAXIS2', 'NAXIS1', key_gain, key_ron, key_satlevel,
-                key_ra, key_dec, key_pixscale]
-    ysize_new, xsize_new, gain_new, readnoise_new, satlevel_new, ra_new, dec_new, pixscale_new = read_header(header_new, keywords)
-    if verbose:
+    header_new = ctx.read_fits_header(new_fits)
+    keywords = ['NAXIS2', 'NAXIS1', ctx.key_gain, ctx.key_ron, ctx.key_satlevel,
+                ctx.key_ra, ctx.key_dec, ctx.key_pixscale]
+    ysize_new, xsize_new, gain_new, readnoise_new, satlevel_new, ra_new, dec_new, pixscale_new = read_header(header_new, keywords, verbose=ctx.verbose)
+    if ctx.verbose:
         print keywords
-        print read_header(header_new, keywords)
+        print read_header(header_new, keywords, verbose=ctx.verbose)
 
     # read in header of ref_fits
-    with fits.open(ref_fits) as hdulist:
-        header_ref = hdulist[0].header
-    ysize_ref, xsize_ref, gain_ref, readnoise_ref, satlevel_ref, ra_ref, dec_ref, pixscale_ref = read_header(header_ref, keywords)
-    if verbose:
+    header_ref = ctx.read_fits_header(ref_fits)
+    ysize_ref, xsize_ref, gain_ref, readnoise_ref, satlevel_ref, ra_ref, dec_ref, pixscale_ref = read_header(header_ref, keywords, verbose=ctx.verbose)
+    if ctx.verbose:
         print keywords
-        print read_header(header_ref, keywords)
+        print read_header(header_ref, keywords, verbose=ctx.verbose)
+
 
+    # the seeing estimate and WCS solution of ref_fits; with
+    # [ctx].tool_nproc > 1, they are determined in the background while
+    # those of new_fits are determined below
+    def prepare_ref():
+        # run SExtractor for seeing estimate of ref_fits:
+        if ref_mask:
+            sex_par_arg = ctx.sex_mask_par
+        else:
+            sex_par_arg = ctx.sex_par
+        sexcat_ref = ctx.base_ref+'.sexcat'
+        fwhm_ref, fwhm_std_ref = run_cached(ctx, 'seeing', [ctx.base_ref+'.fits', ref_mask, ref_wt],
+                                            [seeing_catalog(ctx, sexcat_ref)], run_sextractor, ctx, ctx.base_ref+'.fits',
+                                            sexcat_ref, ctx.sex_cfg, sex_par_arg, pixscale_ref,
+                                            fraction=ctx.fwhm_imafrac, mask_file=ref_mask,
+                                            wt_file=ref_wt)
+        print 'fwhm_ref, fwhm_std_ref', fwhm_ref, fwhm_std_ref
+        print 'fwhm from header', header_ref['SEEING']
+
+        # write seeing (in arcseconds) to header
+        #seeing_ref = fwhm_ref * pixscale_ref
+        #seeing_ref_str = str('{:.2f}'.format(seeing_ref))
+        #header_ref[key_seeing] = (seeing_ref_str, '[arcsec] seeing estimated from central '+str(fwhm_imafrac))
+
+        # determine WCS solution of ref_fits
+        ref_fits_wcs = ctx.base_ref+'_wcs.fits'
+        if not os.path.isfile(ref_fits_wcs) or ctx.redo:
+            result = run_cached(ctx, 'wcs', [ctx.base_ref+'.fits'],
+                                [ref_fits_wcs, ctx.base_ref+'.wcs',
+                                 ref_fits_wcs.replace('.fits','.sexcat')],
+                                run_wcs, ctx, ctx.base_ref+'.fits', ref_fits_wcs, ra_ref,
+                                dec_ref, gain_ref, readnoise_ref, fwhm_ref, pixscale_ref,
+                                use_existing_wcs)
+        return fwhm_ref, fwhm_std_ref
+
+    if ctx.tool_nproc > 1:
+        ref_future = run_async(prepare_ref)
 
     # run SExtractor for seeing estimate of new_fits:
-    sexcat_new = base_new+'.sexcat'
+    sexcat_new = ctx.base_new+'.sexcat'
     if new_mask:
-        sex_par_arg = sex_mask_par
+        sex_par_arg = ctx.sex_mask_par
     else:
-        sex_par_arg = sex_par
-    fwhm_new, fwhm_std_new = run_sextractor(base_new+'.fits', sexcat_new, sex_cfg,
-                                            sex_par_arg, pixscale_new, fraction=fwhm_imafrac, mask_file=new_mask,
-                                            wt_file=new_wt)
+        sex_par_arg = ctx.sex_par
+    fwhm_new, fwhm_std_new = run_cached(ctx, 'seeing', [ctx.base_new+'.fits', new_mask, new_wt],
+                                        [seeing_catalog(ctx, sexcat_new)], run_sextractor, ctx, ctx.base_new+'.fits',
+                                        sexcat_new, ctx.sex_cfg, sex_par_arg, pixscale_new,
+                                        fraction=ctx.fwhm_imafrac, mask_file=new_mask,
+                                        wt_file=new_wt)
     print 'fwhm_new, fwhm_std_new', fwhm_new, fwhm_std_new
     print 'fwhm from header', header_new['SEEING']
 
@@ -285,60 +1025,112 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
     #header_new[key_seeing] = (seeing_new_str, '[arcsec] seeing estimated from central '+str(fwhm_imafrac))
 
     # determine WCS solution of new_fits
-    new_fits_wcs = base_new+'_wcs.fits'
-    if not os.path.isfile(new_fits_wcs) or redo:
-        result = run_wcs(base_new+'.fits', new_fits_wcs, ra_new, dec_new,
-                         gain_new, readnoise_new, fwhm_new, pixscale_new, use_existing_wcs)
-
-    # run SExtractor for seeing estimate of ref_fits:
-    if ref_mask:
-        sex_par_arg = sex_mask_par
+    new_fits_wcs = ctx.base_new+'_wcs.fits'
+    if not os.path.isfile(new_fits_wcs) or ctx.redo:
+        result = run_cached(ctx, 'wcs', [ctx.base_new+'.fits'],
+                            [new_fits_wcs, ctx.base_new+'.wcs',
+                             new_fits_wcs.replace('.fits','.sexcat')],
+                            run_wcs, ctx, ctx.base_new+'.fits', new_fits_wcs, ra_new,
+                            dec_new, gain_new, readnoise_new, fwhm_new, pixscale_new,
+                            use_existing_wcs)
+
+
+    if ctx.tool_nproc > 1:
+        fwhm_ref, fwhm_std_ref = ref_future.result()
     else:
-        sex_par_arg = sex_par
-    sexcat_ref = base_ref+'.sexcat'
-    fwhm_ref, fwhm_std_ref = run_sextractor(base_ref+'.fits', sexcat_ref, sex_cfg,
-                                            sex_par_arg, pixscale_ref, fraction=fwhm_imafrac, mask_file=ref_mask,
-                                            wt_file=ref_wt)
-    print 'fwhm_ref, fwhm_std_ref', fwhm_ref, fwhm_std_ref
-    print 'fwhm from header', header_ref['SEEING']
-
-    # write seeing (in arcseconds) to header
-    #seeing_ref = fwhm_ref * pixscale_ref
-    #seeing_ref_str = str('{:.2f}'.format(seeing_ref))
-    #header_ref[key_seeing] = (seeing_ref_str, '[arcsec] seeing estimated from central '+str(fwhm_imafrac))
-
-    # determine WCS solution of ref_fits
-    ref_fits_wcs = base_ref+'_wcs.fits'
-    if not os.path.isfile(ref_fits_wcs) or redo:
-        result = run_wcs(base_ref+'.fits', ref_fits_wcs, ra_ref, dec_ref,
-                         gain_ref, readnoise_ref, fwhm_ref, pixscale_ref, use_existing_wcs)
-
+        fwhm_ref, fwhm_std_ref = prepare_ref()
 
     # remap ref to new
-    ref_fits_remap = base_ref+'_wcs_remap.fits'
+    ref_fits_remap = ctx.base_ref+'_wcs_remap.fits'
     #if not os.path.isfile(ref_fits_remap) or redo:
-    result = run_remap(base_new+'_wcs.fits', base_ref+'_wcs.fits', ref_fits_remap,
-                       [ysize_new, xsize_new], gain=gain_new, config=swarp_cfg)
-
+    result = run_cached(ctx, 'remap', [ctx.base_ref+'_wcs.fits', ctx.base_new+'_wcs.fits'],
+                        [ref_fits_remap], run_remap, ctx, ctx.base_new+'_wcs.fits',
+                        ctx.base_ref+'_wcs.fits', ref_fits_remap, [ysize_new, xsize_new],
+                        gain=gain_new, config=ctx.swarp_cfg)
+
+
+    # start background thread that writes the output while the
+    # subimages are being processed
+    writer = FitsWriter()
+
+    # names of the output products
+    product_names = ['D', 'S', 'Scorr']
+    if ctx.output_Scorr_abs:
+        product_names.append('Scorr_abs')
+    product_names += ['Fpsf', 'Fpsferr']
+
+    # if the products are written as separate uncompressed images,
+    # the output files are created beforehand and each finished
+    # subimage is written into them by [writer]; otherwise the full
+    # output images are built in memory and written at the end. In
+    # case of [display], the subimage products are written to the
+    # same filenames, so the output cannot be streamed.
+    stream_products = (ctx.output_compress is None and not ctx.output_mef and not ctx.display)
+
+    # in incremental and checkpoint mode, the subimages whose inputs
+    # did not change since the previous run are skipped, provided
+    # their products are still in the (streamed) output files of that
+    # run, or in the subimage files in [tile_dir] if the products are
+    # not streamed (see [checkpoint_tile]). A single fake star is
+    # placed at the center of each subimage, so such subimages can be
+    # reused (with the fake star measurements), but several fake stars
+    # are placed at random, and the completeness trials as well.
+    reuse_tiles = ctx.stages is not None
+    if reuse_tiles:
+        if ctx.nfakestars > 1:
+            reason = 'fake stars are placed at random (nfakestars > 1)'
+        elif ctx.completeness:
+            reason = 'completeness trials are placed at random'
+        elif ctx.display:
+            reason = 'display is set'
+        else:
+            reason = None
+        if reason is not None:
+            print 'Warning: the subimages are not reused or checkpointed, as {}'.format(reason)
+            reuse_tiles = False
+    tile_dir = ctx.base_new+'_tiles'
+    products_name = 'products:{}'.format(ctx.base_new)
+    products_key = ('products', settings_digest(ctx), ysize_new, xsize_new, tuple(product_names))
+    product_files = [product_filename(ctx, name) for name in product_names]
+    products_found = False
+    if reuse_tiles and stream_products:
+        if ctx.checkpoint:
+            # the output files of a run that was killed are changed
+            # after the record was last saved, so only check that
+            # they exist; the record of the subimages that were
+            # written is saved after they were written
+            products_found, result = ctx.stages.lookup(products_name, products_key,
+                                                       check_outputs=False)
+            products_found = products_found and all([os.path.isfile(f) for f in product_files])
+        else:
+            products_found, result = ctx.stages.lookup(products_name, products_key)
+    if reuse_tiles and not stream_products and not os.path.isdir(tile_dir):
+        os.makedirs(tile_dir)
+
+    data_full = {}
+    for name in product_names:
+        if stream_products:
+            if not products_found:
+                create_fits(product_filename(ctx, name), (ysize_new, xsize_new))
+        else:
+            data_full[name] = np.zeros((ysize_new, xsize_new), dtype='float32')
 
-    # initialize full output images
-    data_D_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
-    data_S_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
-    data_Scorr_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
-    data_Fpsf_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
-    data_Fpsferr_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
-    if nfakestars>0:
+    if reuse_tiles and ctx.checkpoint:
+        if stream_products and not products_found:
+            ctx.stages.store(products_name, products_key, product_files, None)
+        ctx.stages.save()
+    if ctx.nfakestars>0:
         data_new_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
         data_ref_full = np.ndarray((ysize_new, xsize_new), dtype='float32')
         
     # determine cutouts
     centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = \
-        centers_cutouts(subimage_size, ysize_new, xsize_new)
+        centers_cutouts(ctx.subimage_size, ysize_new, xsize_new, border=ctx.subimage_border)
 
-    ysize_fft = subimage_size + 2*subimage_border
-    xsize_fft = subimage_size + 2*subimage_border
+    ysize_fft = ctx.subimage_size + 2*ctx.subimage_border
+    xsize_fft = ctx.subimage_size + 2*ctx.subimage_border
     nsubs = centers.shape[0]
-    if verbose:
+    if ctx.verbose:
         print 'nsubs', nsubs
         for i in range(nsubs):
             print 'i', i
@@ -350,34 +1142,35 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
     # ref, psf and background images
 
     data_new, psf_new, psf_orig_new, data_new_bkg, data_new_bkg_std = \
-        prep_optimal_subtraction(base_new+'_wcs.fits', nsubs, 'new', fwhm_new, input_mask=new_mask)
+        prep_optimal_subtraction(ctx, ctx.base_new+'_wcs.fits', nsubs, 'new', fwhm_new, input_mask=new_mask)
     data_ref, psf_ref, psf_orig_ref, data_ref_bkg, data_ref_bkg_std = \
-        prep_optimal_subtraction(base_ref+'_wcs.fits', nsubs, 'ref', fwhm_ref,
+        prep_optimal_subtraction(ctx, ctx.base_ref+'_wcs.fits', nsubs, 'ref', fwhm_ref,
                                  remap=ref_fits_remap, input_mask=ref_mask)
 
 
     # get x, y and fratios from matching PSFex stars across entire frame
-    x_fratio, y_fratio, fratio, dra, ddec = get_fratio_radec(base_new+'_wcs.psfexcat',
-                                                             base_ref+'_wcs.psfexcat',
-                                                             base_new+'_wcs.sexcat',
-                                                             base_ref+'_wcs.sexcat')
+    fratio_inputs = [ctx.base_new+'_wcs.psfexcat', ctx.base_ref+'_wcs.psfexcat',
+                     ctx.base_new+'_wcs.sexcat', ctx.base_ref+'_wcs.sexcat',
+                     ctx.base_new+'.wcs', ctx.base_ref+'.wcs']
+    x_fratio, y_fratio, fratio, dra, ddec = run_cached(ctx, 'fratio', fratio_inputs, [],
+                                                       get_fratio_radec, ctx, *fratio_inputs[:4])
     
     dx = dra / pixscale_new
     dy = ddec / pixscale_new 
 
     # fratio is in counts, convert to electrons, in case gains of new
     # and ref images are not identical
-    fratio *= gain_new / gain_ref
+    fratio = fratio * (gain_new / gain_ref)
     
     dr = np.sqrt(dx**2 + dy**2)
-    if verbose: print 'standard deviation dr over the full frame:', np.std(dr) 
+    if ctx.verbose: print 'standard deviation dr over the full frame:', np.std(dr) 
     dr_full = np.sqrt(np.median(dr)**2 + np.std(dr)**2)
     dx_full = np.sqrt(np.median(dx)**2 + np.std(dx)**2)
     dy_full = np.sqrt(np.median(dy)**2 + np.std(dy)**2)
     #dr_full = np.std(dr)
     #dx_full = np.std(dx)
     #dy_full = np.sdata_new, psf_new, psf_orig_new, data_new_bkg, data_new_bkg_stdtd(dy)
-    if verbose:
+    if ctx.verbose:
         print 'np.median(dr), np.std(dr)', np.median(dr), np.std(dr)
         print 'np.median(dx), np.std(dx)', np.median(dx), np.std(dx)
         print 'np.median(dy), np.std(dy)', np.median(dy), np.std(dy)
@@ -385,21 +1178,22 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
     
     #fratio_median, fratio_std = np.median(fratio), np.std(fratio)
     fratio_mean_full, fratio_std_full, fratio_median_full = clipped_stats(fratio, nsigma=2)
-    if verbose:
+    if ctx.verbose:
         print 'fratio_mean_full, fratio_std_full, fratio_median_full', \
             fratio_mean_full, fratio_std_full, fratio_median_full
     
     make_plots = False
 
     if make_plots:
+        import matplotlib.pyplot as plt
         # plot y vs x
         plt.axis((0,xsize_new,0,ysize_new))
         plt.plot(x_fratio, y_fratio, 'go') 
         plt.xlabel('x (pixels)')
         plt.ylabel('y (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'dxdy.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'dxdy.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         # plot dy vs dx
@@ -408,8 +1202,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('dx (pixels)')
         plt.ylabel('dy (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'dxdy.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'dxdy.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
         
         # plot dr vs x_fratio
@@ -418,8 +1212,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('x (pixels)')
         plt.ylabel('dr (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'drx.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'drx.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         # plot dr vs y_fratio
@@ -428,8 +1222,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('y (pixels)')
         plt.ylabel('dr (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'dry.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'dry.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         # plot dr as function of distance from the image center
@@ -441,8 +1235,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('distance from image center (pixels)')
         plt.ylabel('dr (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'drdist.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'drdist.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
                 
         # plot dx vs x_fratio
@@ -451,8 +1245,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('x (pixels)')
         plt.ylabel('dx (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'dxx.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'dxx.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         # plot dy vs y_fratio
@@ -461,17 +1255,25 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('y (pixels)')
         plt.ylabel('dy (pixels)')
         plt.title(new_fits+'\n vs '+ref_fits, fontsize=12)
-        plt.savefig(os.path.join(output_dir,'dyy.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'dyy.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
     # initialize fakestar flux arrays if fake star(s) are being added
     # - this is to make a comparison plot of the input and output flux
-    if nfakestars>0:
+    if ctx.nfakestars>0:
         fakestar_flux_input = np.ndarray(nsubs)
         fakestar_flux_output = np.ndarray(nsubs)
         fakestar_fluxerr_output = np.ndarray(nsubs)        
         fakestar_s2n_output = np.ndarray(nsubs)
+        # true positions and fluxes of all fake stars, and the
+        # corresponding Fpsf and Scorr values, per subimage
+        fakestars = []
+
+    # transient candidates found in the subimages
+    transients = []
+    # fake stars injected and recovered in completeness mode
+    completeness_trials = []
         
     start_time2 = os.times()
             
@@ -479,9 +1281,12 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
 
     for nsub in range(nsubs):
 
-        if timing: tloop = time.time()
+        if profiler is not None and nsub == ctx.profile_nsub:
+            profiler.enable()
+
+        if ctx.timing: tloop = time.time()
         
-        if verbose:
+        if ctx.verbose:
             print '\nNsub:', nsub+1
             print '----------'
             
@@ -510,13 +1315,13 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         #var_new = data_new[nsub] - bkg_new + std_new**2
         #var_ref = data_ref[nsub] - bkg_ref + std_ref**2
         
-        if nfakestars>0:
+        if ctx.nfakestars>0:
             # add fake star(s) to new image
-            if nfakestars==1:
+            if ctx.nfakestars==1:
                 # place it at the center of the new subimage
                 xpos = xsize_fft/2
                 ypos = ysize_fft/2
-                psf_hsize = psf_size_new/2
+                psf_hsize = ctx.psf_size_new/2
                 index_temp = [slice(ypos-psf_hsize, ypos+psf_hsize+1),
                               slice(xpos-psf_hsize, xpos+psf_hsize+1)]
                 # Use function [flux_optimal_s2n] to estimate flux needed
@@ -524,7 +1329,7 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
                 fakestar_flux, fakestar_data = flux_optimal_s2n (psf_orig_new[nsub],
                                                                  data_new[nsub][index_temp],
                                                                  bkg_new[index_temp], readnoise_new,
-                                                                 fakestar_s2n, fwhm=fwhm_new)
+                                                                 ctx.fakestar_s2n, fwhm=fwhm_new)
                 # multiply psf_orig_new to contain fakestar_flux
                 psf_fakestar = psf_orig_new[nsub] * fakestar_flux
                 # add fake star to new image
@@ -532,7 +1337,7 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
                 # and variance image
                 var_new[index_temp] += psf_fakestar
                 
-                if verbose:
+                if ctx.verbose:
                     print 'fakestar_flux: {} e-'.format(fakestar_flux)
                     flux, fluxerr, mask = flux_optimal(psf_orig_new[nsub], psf_orig_new[nsub],
                                                        fakestar_data, bkg_new[index_temp],
@@ -548,28 +1353,26 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
                                                        bkg_new[index_temp],
                                                        fakestar_data+readnoise_new**2)
                     print 'Naylor recovered flux, fluxerr, S/N', flux, fluxerr, flux/fluxerr
-            
+
+                x_fake, y_fake = np.array([xpos]), np.array([ypos])
+                x_index, y_index = x_fake, y_fake
+                flux_fake = np.array([fakestar_flux])
 
             else:
                 # place stars in random positions across the subimage,
                 # keeping subimage_border + psf_size_new/2 pixels off
                 # each edge
-                edge = subimage_border + psf_size_new/2 + 1
-                xpos_rand = np.random.rand(nfakestars)*(xsize_fft-2*edge) + edge
-                ypos_rand = np.random.rand(nfakestars)*(ysize_fft-2*edge) + edge
-                for nstar in range(nfakestars):
-                    xpos = np.int(xpos_rand[nstar])
-                    ypos = np.int(ypos_rand[nstar])
-                    psf_hsize = psf_size_new/2
-                    index_temp = [slice(ypos-psf_hsize, ypos+psf_hsize+1),
-                                  slice(xpos-psf_hsize, xpos+psf_hsize+1)]
-                    fakestar_flux, fakestar_data = flux_optimal_s2n (psf_orig_new[nsub],
-                                                                     data_new[nsub][index_temp],
-                                                                     bkg_new[index_temp], readnoise_new,
-                                                                     fakestar_s2n, fwhm=fwhm_new)
-                    psf_fakestar = psf_orig_new[nsub] * fakestar_flux
-                    data_new[nsub][index_temp] += psf_fakestar                
-                    var_new[index_temp] += psf_fakestar
+                edge = ctx.subimage_border + ctx.psf_size_new/2 + 1
+                xpos_rand = np.random.rand(ctx.nfakestars)*(xsize_fft-2*edge) + edge
+                ypos_rand = np.random.rand(ctx.nfakestars)*(ysize_fft-2*edge) + edge
+                x_fake, y_fake, x_index, y_index, flux_fake = \
+                    add_fakestars(ctx, data_new[nsub], var_new, bkg_new, xpos_rand, ypos_rand,
+                                  readnoise_new, fwhm_new, psf=psf_orig_new[nsub],
+                                  psfex_bintable=ctx.base_new+'_wcs.psf',
+                                  offset=(cuts_ima_fft[nsub][0]-cuts_fft[nsub][0],
+                                          cuts_ima_fft[nsub][2]-cuts_fft[nsub][2]))
+                xpos, ypos = x_index[-1], y_index[-1]
+                fakestar_flux = flux_fake[-1]
                 
             # for plot of input vs. output flux; in case nfakestars >
             # 1, only the flux from the last one is recorded
@@ -585,7 +1388,7 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
 
         # start with full-frame values
         fratio_mean, fratio_std, fratio_median = fratio_mean_full, fratio_std_full, fratio_median_full
-        if fratio_local:
+        if ctx.fratio_local:
             # get median fratio from PSFex stars across subimage
             subcut = cuts_ima[nsub]
             # convert x,y_fratio pixel coordinates to indices
@@ -598,20 +1401,20 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
             if np.sum(mask_sub_fratio) >= 10:
                 # determine local fratios
                 fratio_mean, fratio_std, fratio_median = clipped_stats(fratio[mask_sub_fratio], nsigma=2)
-                if verbose:
+                if ctx.verbose:
                     print 'sub image fratios:', fratio[mask_sub_fratio]
                     
         # adopt full-frame values, also if local fratio_median is more
         # than 2 sigma (full frame) away from the full-frame value
-        if not fratio_local or (np.abs(fratio_median-fratio_median_full)/fratio_std_full > 2.):
+        if not ctx.fratio_local or (np.abs(fratio_median-fratio_median_full)/fratio_std_full > 2.):
             fratio_mean, fratio_std, fratio_median = fratio_mean_full, fratio_std_full, fratio_median_full
 
-        if verbose:
+        if ctx.verbose:
             print 'np.abs(fratio_median-fratio_median_full)/fratio_std_full', np.abs(fratio_median-fratio_median_full)/fratio_std_full
             print 'adopted fratio_mean, fratio_std, fratio_median', fratio_mean, fratio_std, fratio_median            
             
         # and the same for dx and dy
-        if dxdy_local and any(mask_sub_fratio):
+        if ctx.dxdy_local and any(mask_sub_fratio):
             dx_sub = np.sqrt(np.median(dx[mask_sub_fratio])**2 + np.std(dx[mask_sub_fratio])**2)
             dy_sub = np.sqrt(np.median(dy[mask_sub_fratio])**2 + np.std(dy[mask_sub_fratio])**2)
             if dx_sub > 2.*dx_full or not np.isfinite(dx_sub):
@@ -628,7 +1431,7 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         # option 2: set f_new to unity
         f_new = 1.
         f_ref = f_new / fratio_median
-        if verbose:
+        if ctx.verbose:
             print 'f_new, f_ref', f_new, f_ref
             print 'dx_sub, dy_sub', dx_sub, dy_sub
 
@@ -637,27 +1440,95 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         if do_test:
             data_ref[nsub][:] = 0.
             data_new[nsub][:] = 0.
-            data_new[nsub][xpos-1, ypos-1] = 1.
-            data_new[nsub][xpos-1, ypos] = 1.
-            data_new[nsub][xpos-1, ypos+1] = 1.
-            data_new[nsub][xpos, ypos-1] = 1.
-            data_new[nsub][xpos, ypos] = 3.
-            data_new[nsub][xpos, ypos+1] = 1.
-            data_new[nsub][xpos+1, ypos-1] = 1.
-            data_new[nsub][xpos+1, ypos] = 1.
-            data_new[nsub][xpos+1, ypos+1] = 1.
+            data_new[nsub][ypos-1, xpos-1] = 1.
+            data_new[nsub][ypos, xpos-1] = 1.
+            data_new[nsub][ypos+1, xpos-1] = 1.
+            data_new[nsub][ypos-1, xpos] = 1.
+            data_new[nsub][ypos, xpos] = 3.
+            data_new[nsub][ypos+1, xpos] = 1.
+            data_new[nsub][ypos-1, xpos+1] = 1.
+            data_new[nsub][ypos, xpos+1] = 1.
+            data_new[nsub][ypos+1, xpos+1] = 1.
         
+        # the part of the subimage without the borders, and where it
+        # goes in the output frames
+        subcut = cuts_ima[nsub]
+        index_subcut = [slice(subcut[0],subcut[1]), slice(subcut[2],subcut[3])]
+        x1, y1 = ctx.subimage_border, ctx.subimage_border
+        x2, y2 = x1+ctx.subimage_size, y1+ctx.subimage_size
+        index_extract = [slice(y1,y2), slice(x1,x2)]
+
+        if ctx.nfakestars>0:
+            data_new_full[index_subcut] = (data_new[nsub][index_extract] +
+                                           bkg_new[index_extract]) / gain_new
+            data_ref_full[index_subcut] = (data_ref[nsub][index_extract] +
+                                           bkg_ref[index_extract]) / gain_ref
+
+        # skip the subimage if its inputs are the same as in the
+        # previous run, and its products are still in the output files
+        # or in its subimage file
+        if reuse_tiles:
+            tile_name = 'tile:{}:{}'.format(ctx.base_new, nsub)
+            # the result of a subimage is a dictionary (version 2)
+            tile_key = ('tile', 2, settings_digest(ctx), nsub,
+                        array_digest(data_new[nsub], data_ref[nsub], psf_new[nsub], psf_ref[nsub],
+                                     var_new, var_ref, np.median(std_new), np.median(std_ref),
+                                     f_new, f_ref, dx_sub, dy_sub, gain_new))
+            tile_file = None
+            if not stream_products:
+                tile_file = os.path.join(tile_dir, 'tile_{:03d}.npz'.format(nsub))
+            if products_found or not stream_products:
+                found, tile_result = ctx.stages.lookup(tile_name, tile_key)
+                if found:
+                    if ctx.verbose:
+                        print 'reusing subimage {} from previous run'.format(nsub)
+                    if not stream_products:
+                        tile_data = np.load(tile_file)
+                        for name in product_names:
+                            data_full[name][index_subcut] = tile_data[name]
+                        tile_data.close()
+                    if ctx.transient_extract:
+                        transients.append(tile_result['transients'])
+                    if ctx.nfakestars>0:
+                        fakestars.append(tile_result['fakestars'])
+                        (fakestar_flux_output[nsub], fakestar_fluxerr_output[nsub],
+                         fakestar_s2n_output[nsub]) = tile_result['fakestar_output']
+                    if profiler is not None and nsub == ctx.profile_nsub:
+                        profiler.disable()
+                    continue
+
         # call Barak's function
-        data_D, data_S, data_Scorr, data_Fpsf, data_Fpsferr = run_ZOGY(data_ref[nsub], data_new[nsub], 
-                                                                       psf_ref[nsub], psf_new[nsub], 
-                                                                       np.median(std_ref),
-                                                                       np.median(std_new), 
-                                                                       f_ref, f_new,
-                                                                       var_ref, var_new,
-                                                                       dx_sub, dy_sub)
+        with ctx.span('run_ZOGY', nsub=nsub):
+            if ctx.completeness:
+                # keep the part that only depends on the ref image for
+                # the completeness trials below
+                zogy_ref = run_ZOGY_ref(ctx, data_ref[nsub], psf_ref[nsub], psf_new[nsub],
+                                        np.median(std_ref), np.median(std_new), f_ref, f_new,
+                                        var_ref, dx_sub, dy_sub)
+                data_D, data_S, data_Scorr, data_Fpsf, data_Fpsferr = run_ZOGY_new(ctx, zogy_ref,
+                                                                                   data_new[nsub],
+                                                                                   var_new)
+            else:
+                data_D, data_S, data_Scorr, data_Fpsf, data_Fpsferr = run_ZOGY(ctx, data_ref[nsub], data_new[nsub], 
+                                                                               psf_ref[nsub], psf_new[nsub], 
+                                                                               np.median(std_ref),
+                                                                               np.median(std_new), 
+                                                                               f_ref, f_new,
+                                                                               var_ref, var_new,
+                                                                               dx_sub, dy_sub)
+
+        if ctx.completeness:
+            with ctx.span('run_completeness', nsub=nsub):
+                trials = run_completeness(ctx, zogy_ref, data_new[nsub], var_new, psf_orig_new[nsub],
+                                          bkg_new, readnoise_new, fwhm_new)
+            trials['NSUB'] = np.zeros(len(trials['FLUX_IN']), dtype=int) + nsub
+            trials['X_POS'] += cuts_ima_fft[nsub][2]-cuts_fft[nsub][2] + 1
+            trials['Y_POS'] += cuts_ima_fft[nsub][0]-cuts_fft[nsub][0] + 1
+            completeness_trials.append(trials)
+            del zogy_ref
 
         # check that robust std of Scorr is around unity
-        if verbose:
+        if ctx.verbose:
             mean_Scorr, std_Scorr, median_Scorr = clipped_stats(data_Scorr, clip_zeros=False)
             print 'mean_Scorr, median_Scorr, std_Scorr', mean_Scorr, median_Scorr, std_Scorr
             mean_S, std_S, median_S = clipped_stats(data_S, clip_zeros=False)
@@ -667,54 +1538,83 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         # the input flux (the same for the entire subimage) with the
         # PSF flux determined by run_ZOGY. If multiple stars were
         # added, then this comparison is done for the last of them.
-        if nfakestars>0:
-            fakestar_flux_output[nsub] = data_Fpsf[xpos, ypos]
-            fakestar_fluxerr_output[nsub] = data_Fpsferr[xpos, ypos]
+        if ctx.nfakestars>0:
+            fakestar_flux_output[nsub] = data_Fpsf[ypos, xpos]
+            fakestar_fluxerr_output[nsub] = data_Fpsferr[ypos, xpos]
             # and S/N from Scorr
-            fakestar_s2n_output[nsub] = data_Scorr[xpos, ypos]
+            fakestar_s2n_output[nsub] = data_Scorr[ypos, xpos]
+            # record all fake stars in (1-based) pixel coordinates of
+            # the full image
+            fakestars.append({'NSUB': np.zeros(len(flux_fake), dtype=int) + nsub,
+                              'X_POS': x_fake + cuts_ima_fft[nsub][2]-cuts_fft[nsub][2] + 1,
+                              'Y_POS': y_fake + cuts_ima_fft[nsub][0]-cuts_fft[nsub][0] + 1,
+                              'FLUX_IN': flux_fake,
+                              'FLUX_PSF': data_Fpsf[y_index, x_index],
+                              'FLUXERR_PSF': data_Fpsferr[y_index, x_index],
+                              'SCORR': data_Scorr[y_index, x_index]})
+
+        # find the transient candidates in this subimage while its
+        # Scorr is at hand, rather than reading back the full Scorr
+        if ctx.transient_extract:
+            with ctx.span('find_transients', nsub=nsub):
+                transients.append(find_transients(ctx, data_Scorr, data_Fpsf, data_Fpsferr,
+                                                  cuts_ima[nsub], cuts_ima_fft[nsub],
+                                                  cuts_fft[nsub]))
+
             
         # put sub images without the borders into output frames
-        subcut = cuts_ima[nsub]
-        index_subcut = [slice(subcut[0],subcut[1]), slice(subcut[2],subcut[3])]
-        x1, y1 = subimage_border, subimage_border
-        x2, y2 = x1+subimage_size, y1+subimage_size
-        index_extract = [slice(y1,y2), slice(x1,x2)]
-
-        data_D_full[index_subcut] = data_D[index_extract] / gain_new
-        data_S_full[index_subcut] = data_S[index_extract]
-        data_Scorr_full[index_subcut] = data_Scorr[index_extract]
-        data_Fpsf_full[index_subcut] = data_Fpsf[index_extract]
-        data_Fpsferr_full[index_subcut] = data_Fpsferr[index_extract]
-        if nfakestars>0:
-            data_new_full[index_subcut] = (data_new[nsub][index_extract] +
-                                           bkg_new[index_extract]) / gain_new
-            data_ref_full[index_subcut] = (data_ref[nsub][index_extract] +
-                                           bkg_ref[index_extract]) / gain_ref
+        data_sub = {'D': data_D[index_extract] / gain_new,
+                    'S': data_S[index_extract],
+                    'Scorr': data_Scorr[index_extract],
+                    'Scorr_abs': np.abs(data_Scorr[index_extract]),
+                    'Fpsf': data_Fpsf[index_extract],
+                    'Fpsferr': data_Fpsferr[index_extract]}
+        for name in product_names:
+            if stream_products:
+                writer.put(write_fits_section, product_filename(ctx, name), index_subcut,
+                           data_sub[name].astype(np.float32))
+            else:
+                data_full[name][index_subcut] = data_sub[name]
+
+        # record the subimage once its products have been written
+        if reuse_tiles:
+            tile_products = None
+            if not stream_products:
+                tile_products = dict([(name, data_sub[name].astype(np.float32))
+                                      for name in product_names])
+            tile_result = {'transients': transients[-1] if ctx.transient_extract else None}
+            if ctx.nfakestars>0:
+                tile_result['fakestars'] = fakestars[-1]
+                tile_result['fakestar_output'] = (fakestar_flux_output[nsub],
+                                                  fakestar_fluxerr_output[nsub],
+                                                  fakestar_s2n_output[nsub])
+            writer.put(checkpoint_tile, ctx, tile_name, tile_key, tile_result,
+                       tile_file=tile_file, tile_products=tile_products)
         
 
-        if display and (nsub==0 or nsub==44 or nsub == nsubs/2 or nsub==nsubs-1):
+        if ctx.display and (nsub==0 or nsub==44 or nsub == nsubs/2 or nsub==nsubs-1):
 
             # just for displaying purpose:
-            fits.writeto(os.path.join(output_dir,'D.fits'), data_D.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'S.fits'), data_S.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'Scorr.fits'), data_Scorr.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'Scorr_abs.fits'), np.abs(data_Scorr).astype(np.float32), clobber=True)
-            #fits.writeto('Scorr_1sigma.fits', data_Scorr_1sigma, clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'D.fits'), data_D.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'S.fits'), data_S.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'Scorr.fits'), data_Scorr.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'Scorr_abs.fits'), np.abs(data_Scorr).astype(np.float32), clobber=True)
+            #writer.put(fits.writeto, 'Scorr_1sigma.fits', data_Scorr_1sigma, clobber=True)
         
             # write new and ref subimages to fits
             subname = '_sub'+str(nsub)
-            newname = base_new+'_wcs'+subname+'.fits'
-            #fits.writeto(newname, ((data_new[nsub]+bkg_new)/gain_new).astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,newname), data_new[nsub].astype(np.float32), clobber=True)
-            refname = base_ref+'_wcs'+subname+'.fits'
-            #fits.writeto(refname, ((data_ref[nsub]+bkg_ref)/gain_ref).astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,refname), data_ref[nsub].astype(np.float32), clobber=True)
+            newname = ctx.base_new+'_wcs'+subname+'.fits'
+            #writer.put(fits.writeto, newname, ((data_new[nsub]+bkg_new)/gain_new).astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,newname), data_new[nsub].astype(np.float32), clobber=True)
+            refname = ctx.base_ref+'_wcs'+subname+'.fits'
+            #writer.put(fits.writeto, refname, ((data_ref[nsub]+bkg_ref)/gain_ref).astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,refname), data_ref[nsub].astype(np.float32), clobber=True)
             # variance images
-            fits.writeto(os.path.join(output_dir,'Vnew.fits'), var_new.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'Vref.fits'), var_ref.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'Vnew.fits'), var_new.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'Vref.fits'), var_ref.astype(np.float32), clobber=True)
             # background images
-            fits.writeto(os.path.join(output_dir,'bkg_new.fits'), bkg_new.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'bkg_ref.fits'), bkg_ref.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'bkg_new.fits'), bkg_new.astype(np.float32), clobber=True)
+            writer.put(fits.writeto, os.path.join(ctx.output_dir,'bkg_ref.fits'), bkg_ref.astype(np.float32), clobber=True)
             
             
             # and display
@@ -730,18 +1630,19 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
 
 #            result = call(cmd)
 
-        if timing: print 'wall-time spent in nsub loop', time.time()-tloop
+        if ctx.timing: print 'wall-time spent in nsub loop', time.time()-tloop
+
+        if profiler is not None and nsub == ctx.profile_nsub:
+            profiler.disable()
+
+    # write the completeness curve
+    if ctx.completeness:
+        writer.put(write_completeness, ctx, completeness_trials, ctx.base_new+'_completeness.fits')
 
-    # find transient sources in Scorr
-    #Scorr_peaks = ndimage.filters.maximum_filter(data_Scorr_full)
-    #transient_nsigma = 5     # required significance in Scorr for transient detection
-    #Scorr_peaks = Scorr_peaks[Scorr_peaks > transient_nsigma]
-    #Scorr_peaks_mask = (data_Scorr_full == Scorr_peaks)
-    # alternavitvely, use SExtractor:
-    #fits.writeto('Scorr.fits', data_Scorr_full, clobber=True)
-    #sex_trans_cfg = cfg_dir+'sex_trans.config'     # SExtractor configuration file
-    #result = run_sextractor('Scorr.fits', 'trans.cat', sex_trans_cfg, sex_par, pixscale_new,
-    #                        fwhm=fwhm_new)
+    # write the transient candidates found in Scorr to a single table
+    if ctx.transient_extract:
+        writer.put(write_transients, ctx, transients, ctx.base_new+'_trans.fits',
+                   header=header_new)
     
     end_time = os.times()
     dt_usr  = end_time[2] - start_time2[2]
@@ -761,21 +1662,50 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
     print "Elapsed wall time in {0}:  {1:.3f} sec".format("total", dt_wall)
 
     # write full new, ref, D and S images to fits
-    if nfakestars>0:
-        fits.writeto(os.path.join(output_dir,'new.fits'), data_new_full, header_new, clobber=True)
-        fits.writeto(os.path.join(output_dir,'ref.fits'), data_ref_full, header_ref, clobber=True)
-
-    fits.writeto(os.path.join(output_dir,'D.fits'), data_D_full, clobber=True)
-    fits.writeto(os.path.join(output_dir,'S.fits'), data_S_full, clobber=True)
-    fits.writeto(os.path.join(output_dir,'Scorr.fits'), data_Scorr_full, clobber=True)
-    fits.writeto(os.path.join(output_dir,'Scorr_abs.fits'), np.abs(data_Scorr_full), clobber=True)
-    fits.writeto(os.path.join(output_dir,'Fpsf.fits'), data_Fpsf_full, clobber=True)
-    fits.writeto(os.path.join(output_dir,'Fpsferr.fits'), data_Fpsferr_full, clobber=True)
+    if ctx.nfakestars>0:
+        writer.put(write_fakestars, ctx, fakestars, ctx.base_new+'_fakestars.fits')
+        writer.put(fits.writeto, os.path.join(ctx.output_dir,'new.fits'), data_new_full,
+                   header_new, clobber=True)
+        writer.put(fits.writeto, os.path.join(ctx.output_dir,'ref.fits'), data_ref_full,
+                   header_ref, clobber=True)
+
+    if not stream_products:
+        writer.put(write_products, ctx, [(name, data_full[name]) for name in product_names])
+
+    # wait until all output has been written; this raises any error
+    # that occurred in the writer thread
+    with ctx.span('write_output'):
+        writer.close()
+
+    # record the stages of this run for the next one
+    if ctx.stages is not None:
+        if reuse_tiles and stream_products:
+            ctx.stages.store(products_name, products_key, product_files, None)
+        ctx.stages.save()
+        # the subimage files are only kept for the next run in
+        # incremental mode
+        if not ctx.incremental and os.path.isdir(tile_dir):
+            shutil.rmtree(tile_dir)
+        if ctx.verbose:
+            print '\nstages reused from the previous run and redone:'
+            print ctx.stages.summary()
+
+    if ctx.spans is not None:
+        ctx.spans.write(ctx.base_new+'_spans.json', log=ctx.instrument_log,
+                        new_fits=new_fits, ref_fits=ref_fits)
+
+    if profiler is not None:
+        profiler.disable()
+        write_profile(ctx, profiler)
+
+    # close the memory-mapped input images
+    ctx.close_fits()
                 
     # make comparison plot of flux input and output
     make_plots = False
     
-    if make_plots and nfakestars>0:
+    if make_plots and ctx.nfakestars>0:
+        import matplotlib.pyplot as plt
 
         x = np.arange(nsubs)+1
         y = fakestar_flux_input
@@ -783,8 +1713,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('subimage number')
         plt.ylabel('true flux (e-)')
         plt.title('fake stars true input flux')
-        plt.savefig(os.path.join(output_dir,'fakestar_flux_input.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'fakestar_flux_input.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         #plt.axis((0,nsubs,0,2))
@@ -795,8 +1725,8 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('subimage number')
         plt.ylabel('(true flux - ZOGY flux) / true flux')
         plt.title('fake stars true input flux vs. ZOGY Fpsf output flux')
-        plt.savefig(os.path.join(output_dir,'fakestar_flux_input_vs_ZOGYoutput.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'fakestar_flux_input_vs_ZOGYoutput.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         # same for S/N as determined by Scorr
@@ -805,12 +1735,12 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
         plt.xlabel('subimage number')
         plt.ylabel('S/N from Scorr')
         plt.title('signal-to-noise ratio from Scorr')
-        plt.savefig(os.path.join(output_dir,'fakestar_S2N_ZOGYoutput.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'fakestar_S2N_ZOGYoutput.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
         
     # and display
-    if nfakestars>0:
+    if ctx.nfakestars>0:
         cmd = ['ds9','-zscale','new.fits','ref.fits','D.fits','S.fits','Scorr.fits',
                'Fpsf.fits', 'Fpsferr.fits']
     else:
@@ -821,9 +1751,504 @@ def optimal_subtraction(new_fits, ref_fits, ref_fits_remap=None, sub=None,
 
 ################################################################################
 
-def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
+transient_names = ['X_PEAK', 'Y_PEAK', 'X_POS', 'Y_POS', 'SCORR_PEAK', 'FLUX_PSF',
+                   'FLUXERR_PSF', 'NPIX']
+
+def find_transients(ctx, data_Scorr, data_Fpsf, data_Fpsferr, cut_ima, cut_ima_fft, cut_fft):
+
+    """Function that finds the transient candidates in the Scorr
+    subimage [data_Scorr] (including its border) as the connected
+    regions of pixels with |Scorr| >= [ctx].transient_nsigma. For
+    each region, the peak position, the |Scorr|-weighted centroid,
+    the peak Scorr (negative for a source that faded), the PSF flux
+    and its error at the peak, and the number of pixels are returned
+    as a dictionary of arrays (see [transient_names]), with the
+    positions in (1-based) pixel coordinates of the full
+    image. [cut_ima], [cut_ima_fft] and [cut_fft] are the subimage
+    cutouts as returned by [centers_cutouts].
+
+    The subimages overlap by their borders, so a region near the edge
+    of a subimage is also seen by its neighbour. It is only kept by
+    the subimage that contains its peak in the part without the
+    border, so that each candidate appears once in the merged table,
+    with its full extent as long as it is smaller than the border."""
+
+    if ctx.timing: t = time.time()
+
+    Scorr_abs = np.abs(data_Scorr)
+    mask_det = (Scorr_abs >= ctx.transient_nsigma)
+    # only consider the part of the subimage that is in the image
+    mask_det[:cut_fft[0]] = False
+    mask_det[cut_fft[1]:] = False
+    mask_det[:,:cut_fft[2]] = False
+    mask_det[:,cut_fft[3]:] = False
+
+    labels, nlabels = ndimage.label(mask_det, structure=np.ones((3,3)))
+    if nlabels == 0:
+        return dict([(name, np.zeros(0)) for name in transient_names])
+    index = np.arange(1, nlabels+1)
+
+    # peak and centroid of each region, in indices of the subimage
+    peaks = np.array(ndimage.maximum_position(Scorr_abs, labels, index)).reshape(-1,2)
+    centroids = np.array(ndimage.center_of_mass(Scorr_abs, labels, index)).reshape(-1,2)
+    npix = ndimage.sum(mask_det, labels, index)
+
+    # offset of the subimage indices with respect to the full image
+    offset = np.array([cut_ima_fft[0]-cut_fft[0], cut_ima_fft[2]-cut_fft[2]])
+    peaks_ima = peaks + offset
+
+    # keep the regions with their peak in this subimage
+    mask_keep = ((peaks_ima[:,0] >= cut_ima[0]) & (peaks_ima[:,0] < cut_ima[1]) &
+                 (peaks_ima[:,1] >= cut_ima[2]) & (peaks_ima[:,1] < cut_ima[3]))
+    iy, ix = peaks[mask_keep,0], peaks[mask_keep,1]
+
+    transients = {'X_PEAK': peaks_ima[mask_keep,1] + 1,
+                  'Y_PEAK': peaks_ima[mask_keep,0] + 1,
+                  'X_POS': centroids[mask_keep,1] + offset[1] + 1.,
+                  'Y_POS': centroids[mask_keep,0] + offset[0] + 1.,
+                  'SCORR_PEAK': data_Scorr[iy, ix],
+                  'FLUX_PSF': data_Fpsf[iy, ix],
+                  'FLUXERR_PSF': data_Fpsferr[iy, ix],
+                  'NPIX': npix[mask_keep]}
+
+    if ctx.timing: print 'wall-time spent in find_transients', time.time()-t
+
+    return transients
+
+################################################################################
+
+def write_transients(ctx, transients, filename, header=None):
+
+    """Function that merges the transient candidates found in the
+    subimages, [transients] being the list of dictionaries returned
+    by [find_transients], and writes them to the binary fits table
+    [filename], sorted by decreasing |Scorr|. The RA and DEC of the
+    candidates are determined from the WCS of the new image. The
+    non-structural keywords of [header] are copied to the header of
+    the table."""
+
+    if ctx.timing: t = time.time()
+
+    data = dict([(name, np.concatenate([np.zeros(0)]+[trans[name] for trans in transients]))
+                 for name in transient_names])
+    index_sort = np.argsort(-np.abs(data['SCORR_PEAK']))
+    for name in transient_names:
+        data[name] = data[name][index_sort]
+    ntrans = len(index_sort)
+
+    if ntrans > 0:
+        wcs = read_wcs(ctx, ctx.base_new+'.wcs')
+        ra, dec = wcs.all_pix2world(data['X_POS'], data['Y_POS'], 1)
+    else:
+        ra, dec = np.zeros(0), np.zeros(0)
+
+    cols = [fits.Column(name='NUMBER', format='J', array=np.arange(1, ntrans+1)),
+            fits.Column(name='X_POS', format='D', unit='pixel', array=data['X_POS']),
+            fits.Column(name='Y_POS', format='D', unit='pixel', array=data['Y_POS']),
+            fits.Column(name='X_PEAK', format='J', unit='pixel', array=data['X_PEAK']),
+            fits.Column(name='Y_PEAK', format='J', unit='pixel', array=data['Y_PEAK']),
+            fits.Column(name='RA', format='D', unit='deg', array=ra),
+            fits.Column(name='DEC', format='D', unit='deg', array=dec),
+            fits.Column(name='SCORR_PEAK', format='E', unit='sigma', array=data['SCORR_PEAK']),
+            fits.Column(name='FLUX_PSF', format='E', array=data['FLUX_PSF']),
+            fits.Column(name='FLUXERR_PSF', format='E', array=data['FLUXERR_PSF']),
+            fits.Column(name='NPIX', format='J', array=data['NPIX'])]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    if header is not None:
+        for card in header.cards:
+            if (card.keyword not in hdu.header and not card.keyword.startswith('NAXIS') and
+                card.keyword not in ['', 'COMMENT', 'HISTORY', 'SIMPLE', 'BITPIX', 'EXTEND',
+                                     'BSCALE', 'BZERO', 'PCOUNT', 'GCOUNT']):
+                hdu.header.append(card)
+    hdu.header['TRANSSIG'] = (ctx.transient_nsigma, '[sigma] Scorr threshold of transient candidates')
+    hdu.header['NTRANS'] = (ntrans, 'number of transient candidates')
+    hdu.writeto(filename, clobber=True)
+
+    if ctx.verbose:
+        print 'number of transient candidates:', ntrans
+    if ctx.timing: print 'wall-time spent in write_transients', time.time()-t
+
+################################################################################
+
+def write_fakestars(ctx, fakestars, filename):
+
+    """Function that writes the fake stars added to the subimages,
+    [fakestars] being a list with a dictionary of arrays for each
+    subimage, to the binary fits table [filename]: their true
+    positions and fluxes, and the Fpsf, Fpsferr and Scorr values
+    at their pixel positions."""
+
+    names = ['NSUB', 'X_POS', 'Y_POS', 'FLUX_IN', 'FLUX_PSF', 'FLUXERR_PSF', 'SCORR']
+    formats = ['J', 'D', 'D', 'E', 'E', 'E', 'E']
+    cols = [fits.Column(name=name, format=fmt,
+                        array=np.concatenate([fake[name] for fake in fakestars]))
+            for name, fmt in zip(names, formats)]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    hdu.header['FAKES2N'] = (ctx.fakestar_s2n, 'required S/N of the fake stars')
+    hdu.writeto(filename, clobber=True)
+
+################################################################################
+
+def write_completeness(ctx, completeness_trials, filename):
+
+    """Function that determines the completeness curve of the transient
+    detection from the fake stars injected in the subimages by
+    [run_completeness] ([completeness_trials] is the list of
+    dictionaries it returned), and writes it to the first extension
+    of the binary fits table [filename]: for each magnitude offset,
+    the median instrumental magnitude (-2.5 log10 of the flux in e-),
+    the number of injected and recovered stars, the completeness and
+    the median ratio of the recovered PSF flux and the input flux. The
+    individual fake stars are written to the second extension."""
+
+    names = ['NSUB', 'TRIAL', 'X_POS', 'Y_POS', 'DMAG', 'FLUX_IN', 'FLUX_PSF',
+             'FLUXERR_PSF', 'SCORR', 'SCORR_PEAK', 'RECOVERED']
+    formats = ['J', 'J', 'D', 'D', 'E', 'E', 'E', 'E', 'E', 'E', 'L']
+    data = dict([(name, np.concatenate([trials[name] for trials in completeness_trials]))
+                 for name in names])
+
+    dmag_grid = np.array(ctx.completeness_dmag, dtype=float)
+    ngrid = len(dmag_grid)
+    mag_inst = np.zeros(ngrid)
+    ninj = np.zeros(ngrid, dtype=int)
+    nrec = np.zeros(ngrid, dtype=int)
+    fratio = np.zeros(ngrid)
+    for i, dmag in enumerate(dmag_grid):
+        mask = (data['DMAG'] == dmag)
+        mask_rec = mask & data['RECOVERED']
+        ninj[i] = np.sum(mask)
+        nrec[i] = np.sum(mask_rec)
+        if ninj[i] > 0:
+            mag_inst[i] = np.median(-2.5*np.log10(data['FLUX_IN'][mask]))
+        if nrec[i] > 0:
+            fratio[i] = np.median(data['FLUX_PSF'][mask_rec] / data['FLUX_IN'][mask_rec])
+    frac = nrec / np.maximum(ninj, 1).astype(float)
+
+    if ctx.verbose:
+        print '\ncompleteness of the transient detection:'
+        print '{:>6s} {:>8s} {:>6s} {:>6s} {:>6s}'.format('dmag', 'mag_inst', 'ninj', 'nrec', 'frac')
+        for i in range(ngrid):
+            print '{:6.2f} {:8.3f} {:6d} {:6d} {:6.3f}'.format(dmag_grid[i], mag_inst[i], ninj[i],
+                                                                nrec[i], frac[i])
+
+    cols = [fits.Column(name='DMAG', format='E', array=dmag_grid),
+            fits.Column(name='MAG_INST', format='E', array=mag_inst),
+            fits.Column(name='NINJ', format='J', array=ninj),
+            fits.Column(name='NREC', format='J', array=nrec),
+            fits.Column(name='COMPLETENESS', format='E', array=frac),
+            fits.Column(name='FRATIO_MEDIAN', format='E', array=fratio)]
+    hdu_curve = fits.BinTableHDU.from_columns(cols)
+    hdu_curve.header['EXTNAME'] = 'COMPLETENESS'
+    hdu_curve.header['TRANSSIG'] = (ctx.transient_nsigma, '[sigma] Scorr threshold of transient candidates')
+    hdu_curve.header['NTRIALS'] = (ctx.completeness_ntrials, 'number of trials per subimage')
+    hdu_curve.header['NSTARS'] = (ctx.completeness_nstars, 'number of fake stars per subimage and trial')
+
+    cols = [fits.Column(name=name, format=fmt, array=data[name])
+            for name, fmt in zip(names, formats)]
+    hdu_stars = fits.BinTableHDU.from_columns(cols)
+    hdu_stars.header['EXTNAME'] = 'FAKESTARS'
+
+    fits.HDUList([fits.PrimaryHDU(), hdu_curve, hdu_stars]).writeto(filename, clobber=True)
+
+################################################################################
+
+class FitsWriter(object):
+
+    """Background thread that performs the write operations queued with
+    [put], so that the output is written while the main thread
+    continues with the next subimage. The queue is bounded by
+    [maxsize], so that [put] blocks if the writing falls behind,
+    limiting the memory held by pending output. [flush] waits until
+    all queued operations are done and [close] also stops the
+    thread; both raise the first exception that occurred in the
+    writer thread, after which any remaining operations are
+    skipped.
+
+    """
+
+    def __init__(self, maxsize=8):
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self.run, name='FitsWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                if self.exc_info is None:
+                    func, args, kwargs = job
+                    func(*args, **kwargs)
+            except Exception:
+                self.exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        # the error is kept, so that the operations that are still
+        # queued (e.g. the [checkpoint_tile] of a subimage whose
+        # products were not written) are skipped as well
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def put(self, func, *args, **kwargs):
+        self.raise_error()
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+################################################################################
+
+# the outcome of an external program run by [ToolExecutor]
+ToolResult = collections.namedtuple('ToolResult', ['cmd', 'returncode', 'log', 'wall_time'])
+
+class ToolFuture(object):
+
+    """Result of a job that runs in the background (see
+    [ToolExecutor] and [run_async]). [result] waits until the job is
+    done and returns its return value, or raises the exception that
+    it raised."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def set(self, value=None, exc_info=None):
+        self.value = value
+        self.exc_info = exc_info
+        self.event.set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise RuntimeError('job not done within {} s'.format(timeout))
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
+        return self.value
+
+class ToolExecutor(object):
+
+    """Queue of external program runs, executed by [nproc] threads so
+    that at most [nproc] programs run at the same time. [submit]
+    queues the command [cmd] (a list, as for subprocess) and returns
+    a [ToolFuture] whose result is a [ToolResult] with the exit code
+    of the program. The stdout and stderr of the program are written
+    to its own log file [log], so that the output of programs that
+    run at the same time is not mixed, and is not kept in memory.
+    The threads only wait for the programs, so that runs for the new
+    and ref images, or for different images processed by [serve],
+    overlap."""
+
+    def __init__(self, nproc=1):
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.grow(nproc)
+
+    def grow(self, nproc):
+        # start threads until there are [nproc]
+        while len(self.threads) < max(nproc, 1):
+            thread = threading.Thread(target=self.run,
+                                      name='ToolExecutor{}'.format(len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            future, cmd, log, cwd = self.queue.get()
+            try:
+                t = time.time()
+                with open(log, 'w') as f:
+                    proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT, cwd=cwd)
+                    proc.wait()
+                future.set(ToolResult(cmd, proc.returncode, log, time.time()-t))
+            except Exception:
+                future.set(exc_info=sys.exc_info())
+
+    def submit(self, cmd, log, cwd=None):
+        future = ToolFuture()
+        self.queue.put((future, cmd, log, cwd))
+        return future
+
+tool_executor = None
+tool_executor_lock = threading.Lock()
+
+def get_tool_executor(nproc):
+
+    """Function that returns the [ToolExecutor] of this process, which
+    is shared by all its runs; it is started at the first call, and
+    grows to [nproc] threads if a run asks for more than before."""
+
+    global tool_executor
+    with tool_executor_lock:
+        if tool_executor is None:
+            tool_executor = ToolExecutor(nproc)
+        else:
+            tool_executor.grow(nproc)
+    return tool_executor
+
+def run_tool(ctx, cmd, log, cwd=None, ntail=20):
+
+    """Function that runs the external program [cmd] through the
+    [ToolExecutor] of this process and waits for it, with its output
+    written to the file [log] (by convention the name of its main
+    output file with .log appended). Its exit code (zero) is
+    returned. If it fails, the last [ntail] lines of [log] are
+    printed and a subprocess.CalledProcessError is raised: all the
+    programs run by zogy (including solve-field and wcs-xy2rd) write
+    files that the next step needs, which would otherwise fail later
+    with a less clear error."""
+
+    result = get_tool_executor(ctx.tool_nproc).submit(cmd, log, cwd=cwd).result()
+    if ctx.timing:
+        print 'wall-time spent in {}'.format(os.path.basename(cmd[0])), result.wall_time
+    if result.returncode != 0:
+        with open(result.log) as f:
+            tail = collections.deque(f, maxlen=ntail)
+        print 'Error: {} exited with status {}; last lines of {}:'.format(cmd[0], result.returncode,
+                                                                     result.log)
+        print ''.join(tail)
+        raise subprocess.CalledProcessError(result.returncode, ' '.join(cmd))
+    return result.returncode
+
+def run_async(func, *args, **kwargs):
+
+    """Function that runs [func] with [args] and [kwargs] in a new
+    thread and returns a [ToolFuture] for its return value. Unlike
+    the jobs of [ToolExecutor], [func] can run external programs
+    itself through [run_tool]."""
+
+    future = ToolFuture()
+    def target():
+        try:
+            future.set(func(*args, **kwargs))
+        except Exception:
+            future.set(exc_info=sys.exc_info())
+    thread = threading.Thread(target=target, name=getattr(func, '__name__', 'run_async'))
+    thread.daemon = True
+    thread.start()
+    return future
+
+################################################################################
+
+def create_fits(filename, shape, header=None):
+
+    """Function that creates the float32 fits image [filename] with
+    shape [shape] (and optional [header]) without building the data
+    array in memory: the header is written and the file is extended
+    to its full size, so that the data part reads as zeros. Sections
+    of the image can then be filled with [write_fits_section].
+
+    """
+
+    hdu = fits.PrimaryHDU(np.zeros((1,1), dtype='float32'), header=header)
+    hdu.header['NAXIS1'] = shape[1]
+    hdu.header['NAXIS2'] = shape[0]
+    header_str = hdu.header.tostring()
+    # the size of the data part is padded to a multiple of 2880 bytes
+    nbytes = shape[0] * shape[1] * 4
+    nbytes = ((nbytes + 2879) / 2880) * 2880
+    with open(filename, 'wb') as f:
+        f.write(header_str)
+        f.seek(len(header_str) + nbytes - 1)
+        f.write('\0')
+
+################################################################################
+
+def write_fits_section(filename, index, data):
+
+    """Function that writes [data] into section [index] (a tuple of
+    slices) of the existing fits image [filename], through a
+    memory map, so that the rest of the image is not read or
+    written."""
+
+    hdulist = fits.open(filename, mode='update', memmap=True)
+    hdulist[0].data[tuple(index)] = data
+    hdulist.close()
+
+################################################################################
+
+def product_filename(ctx, name):
+
+    """Function that returns the name of the file to which output
+    product [name] (e.g. 'D' or 'Scorr') is written by
+    [write_products], depending on the [output_mef] and
+    [output_compress] settings."""
+
+    if ctx.output_mef:
+        return os.path.join(ctx.output_dir, ctx.output_mef_name)
+    elif ctx.output_compress is not None:
+        return os.path.join(ctx.output_dir, name+'.fits.fz')
+    else:
+        return os.path.join(ctx.output_dir, name+'.fits')
+
+################################################################################
+
+@instrumented
+def write_products(ctx, products, header=None):
+
+    """Function that writes the list of output products [products],
+    consisting of (name, data) tuples, to [output_dir]. Depending on
+    [output_mef], each product is written to a separate fits file or
+    as an extension (with EXTNAME equal to its name) of the single
+    file [output_mef_name]. If [output_compress] is set, the products
+    are tile-compressed with that algorithm, using the quantization
+    level defined for each product in [output_quantize].
+
+    """
+
+    if ctx.timing: t = time.time()
+    print '\nexecuting write_products ...'
+
+    hdus = []
+    for name, data in products:
+
+        if ctx.output_compress is not None:
+            hdu = fits.CompImageHDU(data.astype(np.float32), header=header, name=name,
+                                    compression_type=ctx.output_compress,
+                                    quantize_level=ctx.output_quantize.get(name, 16.))
+        elif ctx.output_mef:
+            hdu = fits.ImageHDU(data.astype(np.float32), header=header, name=name)
+        else:
+            hdu = fits.PrimaryHDU(data.astype(np.float32), header=header)
+
+        if ctx.output_mef:
+            hdus.append(hdu)
+        else:
+            if ctx.output_compress is not None:
+                # a compressed image is a binary table extension
+                hdulist = fits.HDUList([fits.PrimaryHDU(), hdu])
+            else:
+                hdulist = fits.HDUList([hdu])
+            hdulist.writeto(product_filename(ctx, name), clobber=True)
+
+    if ctx.output_mef:
+        hdulist = fits.HDUList([fits.PrimaryHDU()] + hdus)
+        hdulist.writeto(product_filename(ctx, None), clobber=True)
+
+    if ctx.timing: print 'wall-time spent in write_products', time.time()-t
+
+################################################################################
+
+@instrumented
+def get_optflux_xycoords (ctx, psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
                           dx2, dy2, dxy, satlevel=50000,
-                          psf_oddsized=False, psffit=False):
+                          psf_oddsized=False, psffit=False, psf_cell=None):
     
     """Function that returns the optimal flux and its error (using the
        function [flux_optimal] of a source at pixel positions
@@ -842,6 +2267,10 @@ def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
        coordinates that are being processed is replaced by the
        expected flux according to the PSF.
 
+       If [psf_cell] is not None, the sources share the PSF of the
+       cell of [psf_cell] x [psf_cell] pixels that they are in (see
+       [get_psf_xycoords]).
+
     """
         
     print '\nexecuting get_optflux_xycoords ...'
@@ -872,7 +2301,8 @@ def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
     # get PSF images at x- and y-coordinates using function
     # [get_psf_xycoords]
     Pcube_noshift, Pcube_shift, xshift_array, yshift_array =\
-        get_psf_xycoords (psfex_bintable, xcoords, ycoords, psf_oddsized=psf_oddsized)    
+        get_psf_xycoords (ctx, psfex_bintable, xcoords, ycoords, psf_oddsized=psf_oddsized,
+                          cell=psf_cell)
 
     # get psf_size from Pcube
     psf_size = np.shape(Pcube_noshift)[1]
@@ -1006,6 +2436,7 @@ def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
     make_plots = False
     
     if psffit and make_plots:
+        import matplotlib.pyplot as plt
         # compare xshift/yshift_array with psf xy shifts
         dx = xshift_array - x_psf
         dy = yshift_array - y_psf
@@ -1018,7 +2449,7 @@ def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
         plt.show()
         plt.close()
 
-    if timing: print 'wall-time spent in get_optflux_xycoords', time.time()-t
+    if ctx.timing: print 'wall-time spent in get_optflux_xycoords', time.time()-t
 
     if psffit:
         return flux_opt, fluxerr_opt, D_replaced, flux_psf, fluxerr_psf
@@ -1030,6 +2461,9 @@ def get_optflux_xycoords (psfex_bintable, D, S, S_std, RON, xcoords, ycoords,
 
 def flux_psffit(P, D, S, RON, flux_opt, xshift, yshift, mask_in=None):
 
+    # for PSF fitting - see https://lmfit.github.io/lmfit-py/index.html
+    from lmfit import Minimizer, Parameters
+
     # if S is a scalar, expand it to 2D array
     if np.isscalar(S):
         S = np.ndarray(P.shape).fill(S)
@@ -1326,9 +2760,99 @@ def flux_optimal_s2n (P, D, S, RON, s2n, fwhm=5., max_iters=10, epsilon=1e-6):
 
 ################################################################################
 
+def flux_optimal_s2n_batch (P, S, RON, s2n, fwhm=5., max_iters=10, epsilon=1e-6):
+
+    """Vectorized version of function [flux_optimal_s2n] that returns
+    the array of fluxes required for a number of point sources to
+    have a signal-to-noise ratio [s2n]. [S] is the cube of sky images
+    with shape (nstars, psf_size, psf_size) around the point sources
+    and [P] is the corresponding cube of PSFs, or a single PSF image
+    that is used for all of them. The iterations are done for all
+    sources at once; a source keeps its flux once it has converged.
+
+    """
+
+    nstars = S.shape[0]
+
+    # initial estimate of variance and flux (see Eq. 13 of Naylor 1998)
+    V = RON**2 + S
+    flux_opt = (s2n * fwhm * np.sqrt(np.median(V.reshape(nstars,-1), axis=1)) /
+                np.sqrt(2*np.log(2)/np.pi))
+
+    for i in range(max_iters):
+        if i>0:
+            # estimate new flux based on fluxerr_opt of previous iteration
+            flux_opt = np.where(converged, flux_opt, s2n * fluxerr_opt)
+            # improved estimate of variance
+            V = RON**2 + S + flux_opt[:,None,None] * P
+
+        # optimal flux error (see [get_optflux]); the optimal flux
+        # itself is equal to [flux_opt] for the model D = S + flux_opt * P
+        fluxerr_opt = 1./np.sqrt(np.sum(P**2/V, axis=(1,2)))
+
+        # break out of loop if S/N sufficiently close for all sources
+        converged = (np.abs(flux_opt/fluxerr_opt - s2n) / s2n < epsilon)
+        if np.all(converged):
+            break
+        
+    return flux_opt
+
+################################################################################
+
+def add_fakestars (ctx, data, var, bkg, xpos, ypos, RON, fwhm, psf=None,
+                   psfex_bintable=None, offset=(0,0)):
+
+    """Function that adds fake stars with a S/N of [ctx].fakestar_s2n at
+    the subimage indices [xpos], [ypos] (float arrays) to the
+    subimage [data] and its variance [var], with [bkg] the
+    background subimage. The fluxes of all stars are determined at
+    once with [flux_optimal_s2n_batch] and all PSF stamps are added
+    with a single scatter-add, so that overlapping stars add up. If
+    [ctx].fakestar_psfex is True, the PSF at the position of each
+    star is built from the PSFex model [psfex_bintable], shifted to
+    the subpixel position of the star; [offset] is the (y, x) index
+    of the first pixel of the subimage in the full image. Otherwise
+    the single PSF [psf] is added at the integer pixel positions.
+
+    Returns the true positions and the pixel indices of the stars in
+    the subimage, and their fluxes.
+
+    """
+
+    if ctx.timing: t = time.time()
+
+    if ctx.fakestar_psfex:
+        # PSFex coordinates are 1-based pixel coordinates of the full image
+        psf_noshift, psf, xshift, yshift = get_psf_xycoords(ctx, psfex_bintable, xpos+offset[1]+1,
+                                                            ypos+offset[0]+1, psf_oddsized=True)
+        x_index = np.round(xpos).astype(int)
+        y_index = np.round(ypos).astype(int)
+    else:
+        x_index = xpos.astype(int)
+        y_index = ypos.astype(int)
+        xpos, ypos = x_index, y_index
+
+    # indices of the PSF stamps, with shape (nstars, psf_size, psf_size)
+    # after broadcasting
+    psf_hsize = psf.shape[-1]/2
+    steps = np.arange(-psf_hsize, psf_hsize+1)
+    index_y = y_index[:,None,None] + steps[None,:,None]
+    index_x = x_index[:,None,None] + steps[None,None,:]
+
+    flux = flux_optimal_s2n_batch(psf, bkg[index_y, index_x], RON, ctx.fakestar_s2n, fwhm=fwhm)
+    stamps = flux[:,None,None] * psf
+    np.add.at(data, (index_y, index_x), stamps)
+    np.add.at(var, (index_y, index_x), stamps)
+
+    if ctx.timing: print 'wall-time spent in add_fakestars', time.time() - t
+
+    return xpos, ypos, x_index, y_index, flux
+
+################################################################################
+
 def clipped_stats(array, nsigma=3, max_iters=10, epsilon=1e-6, clip_upper10=False,
                   clip_zeros=True, get_median=True, get_mode=False, mode_binsize=0.1,
-                  verbose=False, show_hist=False):
+                  verbose=False, show_hist=False, show_plots=False):
     
     # remove zeros
     if clip_zeros:
@@ -1366,6 +2890,7 @@ def clipped_stats(array, nsigma=3, max_iters=10, epsilon=1e-6, clip_upper10=Fals
             print 'Warning: mean and mode in clipped_stats differ by more than 10%'
 
     if show_hist:
+        import matplotlib.pyplot as plt
         bins = np.arange(np.int(np.amin(array)), np.int(np.amax(array)), 0.5)
         hist, bin_edges = np.histogram(array, bins)
         plt.hist(array, bins, color='green')
@@ -1394,7 +2919,7 @@ def clipped_stats(array, nsigma=3, max_iters=10, epsilon=1e-6, clip_upper10=Fals
         
 ################################################################################
 
-def read_header(header, keywords):
+def read_header(header, keywords, verbose=False):
 
     values = []
     for i in range(len(keywords)):
@@ -1408,34 +2933,277 @@ def read_header(header, keywords):
     return values
 
 ################################################################################
+
+# dictionary with the memory-mapped HDULists opened by [open_fits],
+# with the absolute filename as key; the handles are kept open for
+# the lifetime of a run and closed by [close_fits]. This is the
+# default cache; each [RunContext] keeps its own. The caches are
+# guarded by [fits_cache_lock], as the new and ref images of a run
+# can be prepared in different threads (see [run_async]).
+fits_cache = {}
+fits_cache_lock = threading.RLock()
+
+def open_fits(filename, cache=None):
+
+    """Function that returns the HDUList of [filename], opened with
+    memory mapping and without applying any BSCALE/BZERO scaling, so
+    that pixels are only read from disk when they are accessed. The
+    HDUList is cached so that the different stages reading the same
+    frame share a single open handle. If [filename] has been
+    rewritten since it was opened, it is reopened. The HDUList is
+    kept in the dictionary [cache], or in the module-level
+    [fits_cache] if [cache] is None.
+
+    """
+
+    if cache is None:
+        cache = fits_cache
+
+    key = os.path.abspath(filename)
+    signature = file_signature(key)
+    if signature is None:
+        raise IOError('file {} does not exist'.format(filename))
+
+    with fits_cache_lock:
+        if key in cache:
+            hdulist, signature_cache = cache[key]
+            if signature_cache == signature:
+                return hdulist
+            hdulist.close()
+
+        hdulist = fits.open(key, memmap=True, do_not_scale_image_data=True)
+        cache[key] = (hdulist, signature)
+        return hdulist
+
+################################################################################
+
+def close_fits(filename=None, cache=None):
+
+    """Function that closes the cached HDUList of [filename], or all
+    cached HDULists if [filename] is None."""
+
+    if cache is None:
+        cache = fits_cache
+
+    with fits_cache_lock:
+        if filename is None:
+            keys = cache.keys()
+        else:
+            keys = [os.path.abspath(filename)]
+
+        for key in keys:
+            if key in cache:
+                hdulist, signature = cache.pop(key)
+                hdulist.close()
+
+################################################################################
+
+def read_fits_header(filename, ext=None, cache=None):
+
+    """Function that returns a copy of the header of extension [ext] of
+    [filename] (by default the first extension with an image, see
+    [image_hdu], so that it goes with the data returned by
+    [read_fits]), read through [open_fits]. The BSCALE and BZERO
+    keywords are removed, as these are applied by [read_fits] to the
+    data that it returns.
+
+    """
+
+    header = image_hdu(open_fits(filename, cache=cache), ext).header.copy()
+    for key in ['BSCALE', 'BZERO']:
+        if key in header:
+            del header[key]
+    return header
+
+################################################################################
+
+def image_hdu(hdulist, ext=None):
+
+    """Function that returns extension [ext] of [hdulist], or if [ext]
+    is None its first HDU that contains an image, e.g. extension 1 of
+    a tile-compressed (.fz) file, whose primary HDU is empty. If no
+    HDU contains an image, the primary HDU is returned."""
+
+    if ext is not None:
+        return hdulist[ext]
+    for hdu in hdulist:
+        if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and
+            hdu.header.get('NAXIS', 0) > 0):
+            return hdu
+    return hdulist[0]
+
+################################################################################
+
+def read_fits(filename, ext=None, index=None, scale=1., dtype='float32', copy=False,
+              cache=None):
+
+    """Function that returns the data of extension [ext] of [filename]
+    (by default the first extension with an image, see [image_hdu]),
+    or only the section defined by [index] (a tuple of slices), from
+    the memory-mapped HDUList provided by [open_fits]. The BSCALE and
+    BZERO scaling and the multiplication with [scale] (e.g. the gain
+    to convert counts to electrons) are only applied to the pixels
+    that are read, and the result is converted to [dtype].
+
+    If no scaling or conversion is needed and [copy] is False, the
+    returned array is a (copy-on-write) view of the memory-mapped
+    file; any changes made to it are visible to other stages reading
+    the same file, so use [copy]=True if the array is modified.
+
+    """
+
+    hdu = image_hdu(open_fits(filename, cache=cache), ext)
+    bscale = hdu.header.get('BSCALE', 1.)
+    bzero = hdu.header.get('BZERO', 0.)
+
+    if index is None:
+        data = hdu.data
+    else:
+        data = read_section(hdu, index)
+
+    if bscale != 1. or bzero != 0. or scale != 1.:
+        # conversion creates a new array with only these pixels
+        data = data.astype(dtype)
+        data *= bscale * scale
+        if bzero != 0.:
+            data += bzero * scale
+    elif dtype is not None and data.dtype.newbyteorder('=') != np.dtype(dtype):
+        # FITS data are big-endian; only convert if the type differs
+        data = data.astype(dtype)
+    elif copy:
+        data = np.array(data)
+
+    return data
+
+################################################################################
+
+# whether the installed astropy decompresses sections of a
+# tile-compressed image (CompImageHDU.section, astropy 5.0 and later);
+# in older versions CompImageHDU inherits the section of ImageHDU,
+# which would read the compressed bytes as pixels
+compimage_section = 'section' in vars(fits.CompImageHDU)
+
+def read_section(hdu, index):
+
+    """Function that returns the unscaled pixel values of image HDU
+    [hdu] inside the section [index] (a tuple of slices) without
+    reading the rest of the image. For an uncompressed image this
+    reads only the rows and columns of the section from disk; for a
+    tile-compressed image (CompImageHDU) only the compression tiles
+    that overlap with the section are decompressed if the installed
+    astropy supports it (see [compimage_section]). Otherwise the full
+    image is decompressed once and kept in the HDU, so that
+    subsequent sections are cheap.
+
+    """
+
+    index = tuple(index)
+    if isinstance(hdu, fits.CompImageHDU):
+        if compimage_section:
+            return hdu.section[index]
+        return hdu.data[index]
+    return hdu.section[index]
+
+################################################################################
+
+def read_fits_tile(ctx, filename, cut_ima_fft, cut_fft, ext=None, scale=1., dtype='float32'):
+
+    """Function that returns a single subimage of [filename] (of
+    extension [ext], by default the first with an image) including
+    its border, i.e. an array with shape ([subimage_size] +
+    2*[subimage_border]) squared, with the pixel values multiplied by
+    [scale] (e.g. the gain). Only the section of the image defined by
+    [cut_ima_fft] is read (see [read_section]), and it is placed at
+    the position defined by [cut_fft], so that the parts of the
+    border that are off the image are zero-padded exactly as in the
+    subimage cubes built by [prep_optimal_subtraction]. [cut_ima_fft]
+    and [cut_fft] are the corresponding rows of the cuts_ima_fft and
+    cuts_fft arrays returned by [centers_cutouts], which allows a
+    process to read its own subimages directly from disk.
+
+    """
+
+    ysize_fft = ctx.subimage_size + 2*ctx.subimage_border
+    xsize_fft = ctx.subimage_size + 2*ctx.subimage_border
+
+    index_fft = [slice(cut_fft[0],cut_fft[1]), slice(cut_fft[2],cut_fft[3])]
+    index_data = [slice(cut_ima_fft[0],cut_ima_fft[1]), slice(cut_ima_fft[2],cut_ima_fft[3])]
+
+    data_tile = np.zeros((ysize_fft, xsize_fft), dtype=dtype)
+    data_tile[index_fft] = ctx.read_fits(filename, ext=ext, index=index_data, scale=scale,
+                                     dtype=dtype)
+    return data_tile
+
+################################################################################
+
+class Catalog(object):
+
+    """SExtractor catalog [filename] in FITS_LDAC format, of which the
+    table in extension [ext] is read through [open_fits]: memory
+    mapped, with the file handle shared by all stages that read the
+    same catalog (see [RunContext].read_catalog), so that only the
+    columns that are used are read from disk, and the large VIGNET
+    column not at all if it is not needed. A column is returned by
+    indexing the catalog with its name. [add_column] adds a column
+    in memory, without copying the table, and [write] writes the
+    catalog including the added columns to a new file, leaving out
+    the columns in [skip]."""
+
+    def __init__(self, filename, ext=2, cache=None):
+        self.filename = filename
+        self.table = open_fits(filename, cache=cache)[ext].data
+        self.added = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, name):
+        if name in self.added:
+            return self.added[name][0]
+        return self.table[name]
+
+    def names(self):
+        return list(self.table.columns.names) + self.added.keys()
+
+    def add_column(self, name, array, format='D'):
+        if len(array) != len(self):
+            raise ValueError('column {} has {} rows instead of {}'
+                             .format(name, len(array), len(self)))
+        self.added[name] = (np.asarray(array), format)
+
+    def write(self, filename, skip=['VIGNET']):
+        cols = [col for col in self.table.columns if col.name not in skip]
+        cols += [fits.Column(name=name, format=format, array=array)
+                 for name, (array, format) in self.added.items()]
+        fits.BinTableHDU.from_columns(cols).writeto(filename, clobber=True)
+
+################################################################################
     
-def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_mask=None):
+@instrumented
+def prep_optimal_subtraction(ctx, input_fits, nsubs, imtype, fwhm, remap=None, input_mask=None):
     
     print '\nexecuting prep_optimal_subtraction ...'
     t = time.time()
     
-    # read in input_fits
-    with fits.open(input_fits) as hdulist:
-        header_wcs = hdulist[0].header
-        data_wcs = hdulist[0].data
-    # if remapped image is provided, read that also
+    # read in header of input_fits; the pixel values are read through
+    # the memory-mapped file by [read_fits] only when a stage needs
+    # them, and converted from counts to electrons at that point
+    header_wcs = ctx.read_fits_header(input_fits)
+    # if remapped image is provided, the data are read from that
+    # image instead
     if remap is not None:
-        with fits.open(remap) as hdulist:
-            header_remap = hdulist[0].header
-            data_remap = hdulist[0].data
+        data_fits = remap
+    else:
+        data_fits = input_fits
             
     # replace NANs with zero, and +-infinity with large +-numbers
     # data = np.nan_to_num(data)
     # get gain, readnoise and pixscale from header_wcs
-    gain = header_wcs[key_gain]
-    readnoise = header_wcs[key_ron]
-    pixscale = header_wcs[key_pixscale]
-    satlevel = header_wcs[key_satlevel]
-    ysize, xsize = np.shape(data_wcs)
-    # convert counts to electrons
-    data_wcs *= gain
-    if remap is not None:
-        data_remap *= gain
+    gain = header_wcs[ctx.key_gain]
+    readnoise = header_wcs[ctx.key_ron]
+    pixscale = header_wcs[ctx.key_pixscale]
+    satlevel = header_wcs[ctx.key_satlevel]
+    ysize, xsize = header_wcs['NAXIS2'], header_wcs['NAXIS1']
 
     # ------------------------------
     # construction of background map
@@ -1445,9 +3213,9 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
     # as produced by SExtractor (i.e. in the case of the ref image
     # before remapping)
     if imtype=='new':
-        base = base_new
+        base = ctx.base_new
     else:
-        base = base_ref
+        base = ctx.base_ref
 
     # in case of the reference image for subpipe, these parameters
     # should point to the images that have already been created at the
@@ -1457,29 +3225,25 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
     objmask_fits = base+'_objmask.fits'
 
     # read in SExtractor's object mask to use in background
-    # estimation for methods 1,3 and 4.
-    with fits.open(objmask_fits) as hdulist:
-        data_objmask = hdulist[0].data
+    # estimation for methods 1,3 and 4; this is only compared to
+    # zero, so the memory-mapped data can be used directly
+    data_objmask = ctx.read_fits(objmask_fits, dtype=None)
     
     # read in SExtractor's background and RMS/std maps which have
     # already been produced
-    if bkg_method==2:
-        with fits.open(bkg_fits) as hdulist:
-            data_bkg = hdulist[0].data * gain
-        with fits.open(bkg_std_fits) as hdulist:
-            data_bkg_std = hdulist[0].data * gain
-
-    # construct background image using [get_back]; in the case of
-    # the reference image these data need to refer to the image
-    # before remapping
-    if bkg_method==3:
-        data_bkg, data_bkg_std = get_back(data_wcs, data_objmask)
-
-    # similar as above, but now photutils' Background2D is used
-    # inside [get_back]
-    if bkg_method==4:
-        data_bkg, data_bkg_std = get_back(data_wcs, data_objmask,
-                                          use_photutils=True)
+    if ctx.bkg_method==2:
+        data_bkg = ctx.read_fits(bkg_fits, scale=gain)
+        data_bkg_std = ctx.read_fits(bkg_std_fits, scale=gain)
+
+    # construct background image using [get_back] (see
+    # [write_back]); in the case of the reference image these data
+    # need to refer to the image before remapping. The maps are
+    # written in counts and read back in electrons.
+    if ctx.bkg_method==3 or ctx.bkg_method==4:
+        run_cached(ctx, 'background', [input_fits, objmask_fits], [bkg_fits, bkg_std_fits],
+                   write_back, ctx, input_fits, objmask_fits, bkg_fits, bkg_std_fits, header_wcs)
+        data_bkg = ctx.read_fits(bkg_fits, scale=gain)
+        data_bkg_std = ctx.read_fits(bkg_std_fits, scale=gain)
 
     if imtype=='ref':
         # in case of the reference image, the background maps
@@ -1490,43 +3254,49 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
 
         # update headers of the background and std/RMS fits image
         # with that of the original wcs-corrected reference image
-        # for all background methods except 1
-        if bkg_method!=1:
-            fits.writeto(bkg_fits, (data_bkg/gain).astype(np.float32),
-                         header=header_wcs, clobber=True)
-            fits.writeto(bkg_std_fits, (data_bkg_std/gain).astype(np.float32),
-                         header=header_wcs, clobber=True)
+        # for all background methods except 1; for methods 3 and 4
+        # this was already done by [write_back]
+        if ctx.bkg_method!=1:
+            if ctx.bkg_method==2:
+                fits.writeto(bkg_fits, (data_bkg/gain).astype(np.float32),
+                             header=header_wcs, clobber=True)
+                fits.writeto(bkg_std_fits, (data_bkg_std/gain).astype(np.float32),
+                             header=header_wcs, clobber=True)
             # project ref image background maps to new image
-            bkg_fits_remap = base_ref+'_bkg_remap.fits'
-            result = run_remap(base_new+'_wcs.fits', bkg_fits, bkg_fits_remap,
-                               [ysize, xsize], gain=gain, config=swarp_cfg,
-                               resampling_type='NEAREST')
-            bkg_std_fits_remap = base_ref+'_bkg_std_remap.fits'
-            result = run_remap(base_new+'_wcs.fits', bkg_std_fits, bkg_std_fits_remap,
-                               [ysize, xsize], gain=gain, config=swarp_cfg,
-                               resampling_type='NEAREST')
+            bkg_fits_remap = ctx.base_ref+'_bkg_remap.fits'
+            result = run_cached(ctx, 'bkg_remap', [bkg_fits, ctx.base_new+'_wcs.fits'],
+                                [bkg_fits_remap], run_remap, ctx, ctx.base_new+'_wcs.fits',
+                                bkg_fits, bkg_fits_remap, [ysize, xsize], gain=gain,
+                                config=ctx.swarp_cfg, resampling_type='NEAREST')
+            bkg_std_fits_remap = ctx.base_ref+'_bkg_std_remap.fits'
+            result = run_cached(ctx, 'bkg_remap', [bkg_std_fits, ctx.base_new+'_wcs.fits'],
+                                [bkg_std_fits_remap], run_remap, ctx, ctx.base_new+'_wcs.fits',
+                                bkg_std_fits, bkg_std_fits_remap, [ysize, xsize], gain=gain,
+                                config=ctx.swarp_cfg, resampling_type='NEAREST')
             # and read back into array, replacing the previous arrays
-            with fits.open(bkg_fits_remap) as hdulist:
-                data_bkg = hdulist[0].data * gain
-            with fits.open(bkg_std_fits_remap) as hdulist:
-                data_bkg_std = hdulist[0].data * gain
+            data_bkg = ctx.read_fits(bkg_fits_remap, scale=gain)
+            data_bkg_std = ctx.read_fits(bkg_std_fits_remap, scale=gain)
         # only for method 1 the objmask needs to be projected
         else:
             fits.writeto(objmask_fits, data_objmask.astype(np.float32),
                          header=header_wcs, clobber=True)
-            objmask_fits_remap = base_ref+'_objmask_remap.fits' ### NEEDS work
-            result = run_remap(base_new+'_wcs.fits', objmask_fits, objmask_fits_remap,
-                               [ysize, xsize], gain=gain, config=swarp_cfg,
+            objmask_fits_remap = ctx.base_ref+'_objmask_remap.fits' ### NEEDS work
+            result = run_remap(ctx, ctx.base_new+'_wcs.fits', objmask_fits, objmask_fits_remap,
+                               [ysize, xsize], gain=gain, config=ctx.swarp_cfg,
                                resampling_type='NEAREST')
-            with fits.open(objmask_fits_remap) as hdulist:
-                data_objmask = hdulist[0].data
+            data_objmask = ctx.read_fits(objmask_fits_remap, dtype=None)
 
-    # let data refer to data_remap in case of ref image
-    # and the original wcs-corrected image otherwise
-    if remap is not None:
-        data = data_remap
+    # the files from which the background maps are taken (for
+    # method 1, the object mask; the data themselves are also used)
+    if ctx.bkg_method==1:
+        if imtype=='ref':
+            bkg_inputs = [objmask_fits_remap]
+        else:
+            bkg_inputs = [objmask_fits]
+    elif imtype=='ref':
+        bkg_inputs = [bkg_fits_remap, bkg_std_fits_remap]
     else:
-        data = data_wcs
+        bkg_inputs = [bkg_fits, bkg_std_fits]
 
     # If [bkg_method]==1 (median) then make it down below when looping
     # over the subimages, but initialize arrays to be filled here. For
@@ -1534,24 +3304,41 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
     # STD/RMS maps are determined from the remapped image
     # directly. For the other methods, they are determined from the
     # original ref image and subsequently mapped to the new image.
-    if bkg_method==1:
-        data_bkg = np.zeros(data.shape)
-        data_bkg_std = np.zeros(data.shape)
+    if ctx.bkg_method==1:
+        # memory-mapped data in counts; the sign of the pixel values
+        # does not depend on the gain
+        data_counts = ctx.read_fits(data_fits, dtype=None)
+        data_bkg = np.zeros(data_counts.shape)
+        data_bkg_std = np.zeros(data_counts.shape)
         # and prepare mask_use based on data_objmask image built by
         # SExtractor, and remapped to the new image if needed
-        mask_reject = ((data_objmask==0) | (data<=0))
+        mask_reject = ((data_objmask==0) | (data_counts<=0))
+        del data_counts
         mask_use = ~mask_reject
-        if verbose:
+        if ctx.verbose:
             print 'np.sum(mask_reject)', np.sum(mask_reject)
         
-    # determine psf of input image with get_psf function
-    psf, psf_orig = get_psf(input_fits, header_wcs, nsubs, imtype, fwhm, pixscale, image_mask=input_mask)
+    # determine psf of input image with get_psf function; for the
+    # reference image, the PSF is determined at the subimage centers
+    # of the new image
+    psf_inputs = [input_fits, input_fits.replace('.fits', '.sexcat'), input_mask,
+                  ctx.base_new+'.wcs']
+    if imtype=='ref':
+        psf_inputs.append(ctx.base_ref+'.wcs')
+    # the PSF cube is kept in a file rather than in the stage record
+    psf_file = input_fits.replace('.fits', '_psf.npy')
+    run_cached(ctx, 'psf', psf_inputs, [input_fits.replace('.fits', '.psf'), psf_file],
+               save_psf, ctx, psf_file, input_fits, header_wcs, nsubs, imtype, fwhm,
+               pixscale, image_mask=input_mask)
+    psf_orig = np.load(psf_file)
+    if imtype=='new': ctx.psf_size_new = psf_orig.shape[-1]
 
     # split full image into subimages
     # determine cutouts
-    centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(subimage_size, ysize, xsize)
-    ysize_fft = subimage_size + 2*subimage_border
-    xsize_fft = subimage_size + 2*subimage_border
+    centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(ctx.subimage_size, ysize, xsize, border=ctx.subimage_border)
+    ysize_fft = ctx.subimage_size + 2*ctx.subimage_border
+    xsize_fft = ctx.subimage_size + 2*ctx.subimage_border
+    psf = shift_psf(psf_orig, ysize_fft, xsize_fft)
     
     fftdata = np.zeros((nsubs, ysize_fft, xsize_fft), dtype='float32')
     fftdata_bkg = np.zeros((nsubs, ysize_fft, xsize_fft), dtype='float32')
@@ -1561,54 +3348,140 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
         index_fft = [slice(fftcut[0],fftcut[1]), slice(fftcut[2],fftcut[3])]
         subcutfft = cuts_ima_fft[nsub]
         index_data = [slice(subcutfft[0],subcutfft[1]), slice(subcutfft[2],subcutfft[3])]
+
+        # read the pixels of this subimage only, converted to
+        # electrons and zero-padded where the border is off the image
+        fftdata[nsub] = read_fits_tile(ctx, data_fits, cuts_ima_fft[nsub], cuts_fft[nsub],
+                                       scale=gain)
+        data_sub = fftdata[nsub][index_fft]
         
         # now determine background for method 1, where clipped median
         # of each subimage is used; best done here in the loop over
         # the subimages
-        if bkg_method==1:
+        if ctx.bkg_method==1:
             # determine clipped mean, median and std
             mask_use_sub = mask_use[index_data]
-            mean, std, median = clipped_stats(data[index_data], nsigma=bkg_nsigma)
-            if verbose:
+            mean, std, median = clipped_stats(data_sub, nsigma=ctx.bkg_nsigma)
+            if ctx.verbose:
                 print 'nsub+1, mean, std, median', nsub+1, mean, std, median
-            mean, std, median = clipped_stats(data[index_data][mask_use_sub], nsigma=bkg_nsigma)
-            if verbose:
+            mean, std, median = clipped_stats(data_sub[mask_use_sub], nsigma=ctx.bkg_nsigma)
+            if ctx.verbose:
                 print 'masked: nsub+1, mean, std, median', nsub+1, mean, std, median
             data_bkg[index_data] = median
             data_bkg_std[index_data] = std
                                 
-        fftdata[nsub][index_fft] = data[index_data]
         fftdata_bkg[nsub][index_fft] = data_bkg[index_data]
         fftdata_bkg_std[nsub][index_fft] = data_bkg_std[index_data]
         
-    # In case of new image and background method other than 2, or
-    # reference and background methods 3 and 4, write the background
-    # and its RMS/STD arrays to fits. The units in these images are
-    # ADU.
-    # For subpipe this needs to be implemented such that the original
-    # reference image background maps are not overwritten.
-    if (imtype=='new' and bkg_method!=2) or (imtype=='ref' and bkg_method>2):  ### NEEDS work
+    # In case of new image and background method 1, write the
+    # background and its RMS/STD arrays to fits; for methods 3 and 4
+    # this was already done by [write_back], for both the new and the
+    # reference image. The units in these images are ADU.
+    if imtype=='new' and ctx.bkg_method==1:
         bkg_fits = input_fits.replace('_wcs.fits', '_bkg.fits')
         fits.writeto(bkg_fits, (data_bkg/gain).astype(np.float32), clobber=True)
         bkg_std_fits = input_fits.replace('_wcs.fits', '_bkg_std.fits')
         fits.writeto(bkg_std_fits, (data_bkg_std/gain).astype(np.float32), clobber=True)
 
     # Get estimate of optimal flux for all sources in the new
-    # image. For the reference image this should already have been
-    # done when it was prepared.
+    # image, and add them to the SExtractor catalog
+    optflux_inputs = [data_fits, input_fits.replace('.fits', '.sexcat'),
+                      input_fits.replace('.fits', '.psf'), ctx.base_new+'.wcs'] + bkg_inputs
+    if imtype=='ref':
+        optflux_inputs.append(ctx.base_ref+'.wcs')
+    run_cached(ctx, 'optflux', optflux_inputs, [input_fits.replace('.fits', '.sexcat_fluxopt')],
+               get_optflux_cat, ctx, input_fits, data_fits, imtype, data_bkg, data_bkg_std,
+               gain, readnoise, satlevel)
+
+    if ctx.timing: print 'wall-time spent in prep_optimal_subtraction', time.time()-t
+
+    return fftdata, psf, psf_orig, fftdata_bkg, fftdata_bkg_std
+    
+
+################################################################################
+
+def select_sources(ctx, cat, xcoords, ycoords, xsize, ysize):
+
+    """Function that selects the sources in SExtractor catalog [cat],
+    at pixel positions [xcoords], [ycoords] in an image of [xsize] x
+    [ysize] pixels, of which the optimal flux is determined: those on
+    the image, passing the cuts [optflux_flags_mask] and
+    [optflux_s2n_min], and at most [optflux_max_density] per million
+    pixels (the brightest in FLUX_AUTO). If the time of the optimal
+    photometry, predicted with [optflux_cost_psf] and
+    [optflux_cost_flux], exceeds [optflux_time_budget], the coarse
+    mode is used, with a PSF per cell of [optflux_psf_cell] pixels,
+    and if needed only the brightest sources that fit in the budget
+    are kept. Returns the sorted indices of the selected sources and
+    the PSF cell size ([psf_cell] of [get_optflux_xycoords]), which is
+    None if each source gets its own PSF."""
+
+    xcoords = np.asarray(xcoords)
+    ycoords = np.asarray(ycoords)
+    mask = (np.isfinite(xcoords) & np.isfinite(ycoords) &
+            (xcoords >= 0.5) & (xcoords < xsize+0.5) &
+            (ycoords >= 0.5) & (ycoords < ysize+0.5))
+    if ctx.optflux_flags_mask:
+        mask &= ((cat['FLAGS'] & ctx.optflux_flags_mask) == 0)
+    if ctx.optflux_s2n_min > 0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s2n = cat['FLUX_AUTO'] / cat['FLUXERR_AUTO']
+        mask &= (s2n >= ctx.optflux_s2n_min)
+    index = np.nonzero(mask)[0]
+
+    def brightest(index, nmax):
+        order = np.argsort(cat['FLUX_AUTO'][index])[::-1]
+        return np.sort(index[order[:max(nmax, 0)]])
+
+    if ctx.optflux_max_density is not None:
+        nmax = int(ctx.optflux_max_density * xsize * ysize / 1e6)
+        if len(index) > nmax:
+            index = brightest(index, nmax)
+
+    psf_cell = None
+    if ctx.optflux_time_budget is not None:
+        cost = len(index) * (ctx.optflux_cost_psf + ctx.optflux_cost_flux)
+        if cost > ctx.optflux_time_budget:
+            psf_cell = ctx.optflux_psf_cell
+            ncells = (int(np.ceil(float(xsize)/psf_cell)) *
+                      int(np.ceil(float(ysize)/psf_cell)))
+            print ('Warning: predicted time of optimal photometry {:.1f}s exceeds budget of '
+                   '{:.1f}s; using a PSF per {} pixel cell'.format(cost, ctx.optflux_time_budget,
+                                                                  psf_cell))
+            nmax = int((ctx.optflux_time_budget - ncells*ctx.optflux_cost_psf) /
+                       ctx.optflux_cost_flux)
+            if len(index) > nmax:
+                print 'Warning: only the {} brightest sources fit in the budget'.format(max(nmax, 0))
+                index = brightest(index, nmax)
+
+    print 'selected {} of {} sources for optimal photometry'.format(len(index), len(cat))
+    return index, psf_cell
+
+################################################################################
+
+def get_optflux_cat(ctx, input_fits, data_fits, imtype, data_bkg, data_bkg_std,
+                    gain, readnoise, satlevel):
+
+    """Function that determines the optimal fluxes of the sources in the
+    SExtractor catalog of [input_fits], with the data read from
+    [data_fits] (the remapped image in case of the reference image)
+    and the background [data_bkg] and its STD [data_bkg_std] in
+    electrons, and writes the catalog with the columns FLUX_OPT and
+    FLUXERR_OPT added (and without the VIGNET column) to [input_fits]
+    with the extension .sexcat_fluxopt. Only the sources selected by
+    [select_sources] are measured; the others get zero fluxes."""
 
     # For the reference image the [data] is read from the remapped
     # image, while the coordinates are from the original image, so to
     # make it work below temporarily, transform the coordinates
     # from the original reference image to the remapped image.
 
-    if timing: t1 = time.time()
+    if ctx.timing: t1 = time.time()
     print 'deriving optimal fluxes ...'
     
     # first read SExtractor fits table
     sexcat = input_fits.replace('.fits', '.sexcat')
-    with fits.open(sexcat) as hdulist:
-        data_sex = hdulist[2].data
+    data_sex = ctx.read_catalog(sexcat)
     # read in positions and their errors
     xwin = data_sex['XWIN_IMAGE']
     ywin = data_sex['YWIN_IMAGE']    
@@ -1624,32 +3497,47 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
         # first infer ra, dec corresponding to x, y pixel positions in
         # the original ref image, using the .wcs file from
         # Astrometry.net
-        wcs = WCS(base_ref+'.wcs')
+        wcs = read_wcs(ctx, ctx.base_ref+'.wcs')
         ra_temp, dec_temp = wcs.all_pix2world(xwin, ywin, 1)
         # then convert ra, dec back to x, y in the coordinate
         # frame of the new or remapped reference image
-        wcs = WCS(base_new+'.wcs')
+        wcs = read_wcs(ctx, ctx.base_new+'.wcs')
         xwin, ywin = wcs.all_world2pix(ra_temp, dec_temp, 1,
                                        tolerance=1e-3, adaptive=True,
                                        quiet=True)
         
     psfex_bintable = input_fits.replace('.fits', '.psf')
 
+    # select the sources to measure
+    header = ctx.read_fits_header(data_fits)
+    index_sel, psf_cell = select_sources(ctx, data_sex, xwin, ywin,
+                                         header['NAXIS1'], header['NAXIS2'])
+    sel_coords = [np.asarray(a)[index_sel] for a in [xwin, ywin, errx2win, erry2win, errxywin]]
+
+    # the optimal photometry below needs the full frame in electrons;
+    # this is the only stage where such a full-frame copy is made
+    data = ctx.read_fits(data_fits, scale=gain, copy=True)
+
     fitpsf = False
+    flux_opt = np.zeros(len(data_sex))
+    fluxerr_opt = np.zeros(len(data_sex))
     if fitpsf:
-        flux_opt, fluxerr_opt, data_replaced, flux_psf, fluxerr_psf =\
-            get_optflux_xycoords (psfex_bintable, data, data_bkg, data_bkg_std, readnoise,
-                                  xwin, ywin, errx2win, erry2win, errxywin,
-                                  satlevel=satlevel*gain, psffit=fitpsf)
+        flux_psf = np.zeros(len(data_sex))
+        fluxerr_psf = np.zeros(len(data_sex))
+        flux_opt[index_sel], fluxerr_opt[index_sel], data_replaced, \
+            flux_psf[index_sel], fluxerr_psf[index_sel] =\
+            get_optflux_xycoords (ctx, psfex_bintable, data, data_bkg, data_bkg_std, readnoise,
+                                  *sel_coords, satlevel=satlevel*gain, psffit=fitpsf,
+                                  psf_cell=psf_cell)
     else:
-        flux_opt, fluxerr_opt, data_replaced =\
-            get_optflux_xycoords (psfex_bintable, data, data_bkg, data_bkg_std, readnoise,
-                                  xwin, ywin, errx2win, erry2win, errxywin,
-                                  satlevel=satlevel*gain)
+        flux_opt[index_sel], fluxerr_opt[index_sel], data_replaced =\
+            get_optflux_xycoords (ctx, psfex_bintable, data, data_bkg, data_bkg_std, readnoise,
+                                  *sel_coords, satlevel=satlevel*gain, psf_cell=psf_cell)
         
     # uncomment this line to use image with saturated stars replaced
     # with psf estimate
     #data = data_replaced
+    del data, data_replaced
             
     # flux_opt is in e-, while flux_auto and flux_psf from
     # SExtractor catalog are in counts
@@ -1660,17 +3548,13 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
         fluxerr_psf /= gain
         
     # merge these two columns with sextractor catalog
-    cols = [] 
-    cols.append(fits.Column(name='FLUX_OPT', format='D', array=flux_opt))
-    cols.append(fits.Column(name='FLUXERR_OPT', format='D', array=fluxerr_opt))
+    data_sex.add_column('FLUX_OPT', flux_opt)
+    data_sex.add_column('FLUXERR_OPT', fluxerr_opt)
     if fitpsf:
-        cols.append(fits.Column(name='FLUX_PSF', format='D', array=flux_psf))
-        cols.append(fits.Column(name='FLUXERR_PSF', format='D', array=fluxerr_psf))
-    orig_cols = data_sex.columns
-    new_cols = fits.ColDefs(cols)
-    hdu = fits.BinTableHDU.from_columns(orig_cols + new_cols)
+        data_sex.add_column('FLUX_PSF', flux_psf)
+        data_sex.add_column('FLUXERR_PSF', fluxerr_psf)
     newcat = input_fits.replace('.fits', '.sexcat_fluxopt')
-    hdu.writeto(newcat, clobber=True)
+    data_sex.write(newcat)
     make_plots = False
     
     if make_plots:
@@ -1691,8 +3575,8 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
         limits = (1,2*np.amax(s2n_auto),-0.2,0.2)
         plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                       xlabel='S/N (AUTO)', ylabel='(FLUX_OPT - FLUX_AUTO) / FLUX_AUTO', 
-                      filename=os.path.join(output_dir,'fluxopt_vs_fluxauto_'+imtype+'.pdf'),
-                      title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                      filename=os.path.join(ctx.output_dir,'fluxopt_vs_fluxauto_'+imtype+'.pdf'),
+                      title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
         if fitpsf:
             # compare flux_mypsf with flux_auto
@@ -1700,20 +3584,20 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
             fluxerr_diff = fluxerr_mypsf / flux_auto
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_MYPSF - FLUX_AUTO) / FLUX_AUTO', 
-                          filename=os.path.join(output_dir,'fluxmypsf_vs_fluxauto_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxmypsf_vs_fluxauto_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
         
             # compare flux_opt with flux_mypsf
             flux_diff = (flux_opt - flux_mypsf) / flux_mypsf
             fluxerr_diff = fluxerr_opt / flux_mypsf
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_OPT - FLUX_MYPSF) / FLUX_MYPSF', 
-                          filename=os.path.join(output_dir,'fluxopt_vs_fluxmypsf_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxopt_vs_fluxmypsf_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
         # compare flux_opt with flux_aper 2xFWHM
         for i in range(0,8):
-            aper_str = str(apphot_radii[i])
+            aper_str = str(ctx.apphot_radii[i])
 
             flux_aper = data_sex['FLUX_APER'][index,i]
             fluxerr_aper = data_sex['FLUXERR_APER'][index,i]
@@ -1721,31 +3605,30 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
             fluxerr_diff = fluxerr_opt / flux_aper
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_OPT - FLUX_APER ('+aper_str+'xFWHM)) / FLUX_APER ('+aper_str+'xFWHM)', 
-                          filename=os.path.join(output_dir,'fluxopt_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxopt_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
             flux_diff = (flux_auto - flux_aper) / flux_aper
             fluxerr_diff = fluxerr_auto / flux_aper
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_AUTO - FLUX_APER ('+aper_str+'xFWHM)) / FLUX_APER ('+aper_str+'xFWHM)', 
-                          filename=os.path.join(output_dir,'fluxauto_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxauto_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
             if fitpsf:
                 flux_diff = (flux_mypsf - flux_aper) / flux_aper
                 fluxerr_diff = fluxerr_mypsf / flux_aper
                 plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                               xlabel='S/N (AUTO)', ylabel='(FLUX_MYPSF - FLUX_APER ('+aper_str+'xFWHM)) / FLUX_APER ('+aper_str+'xFWHM)', 
-                              filename=os.path.join(output_dir,'fluxmypsf_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
-                              title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                              filename=os.path.join(ctx.output_dir,'fluxmypsf_vs_fluxaper'+aper_str+'xFWHM_'+imtype+'.pdf'),
+                              title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
             
 
         # compare with flux_psf if psffit catalog available
         if os.path.isfile(sexcat+'_psffit'):
             # read SExtractor psffit fits table
-            with fits.open(sexcat+'_psffit') as hdulist:
-                data_sex = hdulist[2].data
-                
+            data_sex = ctx.read_catalog(sexcat+'_psffit')
+
             flux_sexpsf = data_sex['FLUX_PSF'][index]
             fluxerr_sexpsf = data_sex['FLUXERR_PSF'][index]
             s2n_sexpsf = data_sex['FLUX_PSF'][index] / data_sex['FLUXERR_PSF'][index]
@@ -1754,8 +3637,8 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
             fluxerr_diff = fluxerr_sexpsf / flux_opt
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_SEXPSF - FLUX_OPT) / FLUX_OPT', 
-                          filename=os.path.join(output_dir,'fluxsexpsf_vs_fluxopt_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxsexpsf_vs_fluxopt_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
             if fitpsf:
                 # and compare 'my' psf with SExtractor psf
@@ -1763,27 +3646,44 @@ def prep_optimal_subtraction(input_fits, nsubs, imtype, fwhm, remap=None, input_
                 fluxerr_diff = fluxerr_sexpsf / flux_mypsf
                 plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                               xlabel='S/N (AUTO)', ylabel='(FLUX_SEXPSF - FLUX_MYPSF) / FLUX_MYPSF', 
-                              filename=os.path.join(output_dir,'fluxsexpsf_vs_fluxmypsf_'+imtype+'.pdf'),
-                              title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                              filename=os.path.join(ctx.output_dir,'fluxsexpsf_vs_fluxmypsf_'+imtype+'.pdf'),
+                              title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
             
             # and compare auto with psf
             flux_diff = (flux_sexpsf - flux_auto) / flux_auto
             fluxerr_diff = fluxerr_sexpsf / flux_auto
             plot_scatter (s2n_auto, flux_diff, fluxerr_diff, limits, class_star,
                           xlabel='S/N (AUTO)', ylabel='(FLUX_SEXPSF - FLUX_AUTO) / FLUX_AUTO', 
-                          filename=os.path.join(output_dir,'fluxsexpsf_vs_fluxauto_'+imtype+'.pdf'),
-                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)')
+                          filename=os.path.join(ctx.output_dir,'fluxsexpsf_vs_fluxauto_'+imtype+'.pdf'),
+                          title='rainbow color coding follows CLASS_STAR: from purple (star) to red (galaxy)', show_plots=ctx.show_plots)
 
         
-    if timing: print 'wall-time spent deriving optimal fluxes', time.time()-t1
-    if timing: print 'wall-time spent in prep_optimal_subtraction', time.time()-t
+    if ctx.timing: print 'wall-time spent deriving optimal fluxes', time.time()-t1
 
-    return fftdata, psf, psf_orig, fftdata_bkg, fftdata_bkg_std
-    
+################################################################################
+
+def write_back(ctx, input_fits, objmask_fits, bkg_fits, bkg_std_fits, header):
+
+    """Function that determines the background and its STD of
+    [input_fits] with [get_back], using the object mask
+    [objmask_fits], and writes them in counts to [bkg_fits] and
+    [bkg_std_fits] with the header [header]."""
+
+    # the background is determined from the memory-mapped data in
+    # counts, avoiding a full-frame copy in electrons
+    data_wcs = ctx.read_fits(input_fits, dtype=None)
+    data_objmask = ctx.read_fits(objmask_fits, dtype=None)
+    data_bkg, data_bkg_std = get_back(ctx, data_wcs, data_objmask,
+                                      use_photutils=(ctx.bkg_method==4))
+    del data_wcs, data_objmask
+
+    fits.writeto(bkg_fits, data_bkg.astype(np.float32), header=header, clobber=True)
+    fits.writeto(bkg_std_fits, data_bkg_std.astype(np.float32), header=header, clobber=True)
 
 ################################################################################
 
-def get_back (data, data_objmask, use_photutils=False, clip=True):
+@instrumented
+def get_back (ctx, data, data_objmask, use_photutils=False, clip=True):
     
     """Function that returns the background of the image [data].  If
     use_photutils is True then apply the photutils' Background2D,
@@ -1792,7 +3692,7 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
     [data_objmask]. The subimages (with size: [bkg_boxsize]) are then
     median filtered and resized to the size of the input image."""
 
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting get_back ...'
 
     # masking using photutils
@@ -1808,15 +3708,16 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
     mask_reject = ((data_objmask==0) | (data<=0))
 
     if use_photutils:
+        from photutils import Background2D, SigmaClip, MedianBackground
         t1 = time.time()
         # use the photutils Background2D function
-        sigma_clip = SigmaClip(sigma=bkg_nsigma, iters=10)
+        sigma_clip = SigmaClip(sigma=ctx.bkg_nsigma, iters=10)
         bkg_estimator = MedianBackground()
         # if bkg_boxsize does not fit integer times into the x- or
         # y-dimension of the shape, Background2D below fails if
         # edge_method='pad', which is the recommended method.  Use
         # edge_method='crop' instead.
-        bkg = Background2D(data, bkg_boxsize, filter_size=bkg_filtersize,
+        bkg = Background2D(data, ctx.bkg_boxsize, filter_size=ctx.bkg_filtersize,
                            sigma_clip=sigma_clip, bkg_estimator=bkg_estimator,
                            mask=mask_reject, edge_method='crop')
         background, background_std = bkg.background, bkg.background_rms
@@ -1834,26 +3735,26 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
         else:
             median_full = np.median(data[mask_use])
             std_full = np.std(data[mask_use])
-        if verbose:
+        if ctx.verbose:
             print 'Background median and std/RMS in object-masked image', median_full, std_full
 
         # loop through subimages the size of bkg_boxsize, and
         # determine median from the masked data
         ysize, xsize = data.shape
-        centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(bkg_boxsize,
-                                                                           ysize, xsize)        
+        centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(ctx.bkg_boxsize,
+                                                                           ysize, xsize, border=ctx.subimage_border)        
 
         # loop subimages
-        if ysize % bkg_boxsize != 0 or xsize % bkg_boxsize !=0:
+        if ysize % ctx.bkg_boxsize != 0 or xsize % ctx.bkg_boxsize !=0:
             print 'Warning: [bkg_boxsize] does not fit integer times in image'
             print '         remaining pixels will be edge-padded'
-        nysubs = ysize / bkg_boxsize
-        nxsubs = xsize / bkg_boxsize
+        nysubs = ysize / ctx.bkg_boxsize
+        nxsubs = xsize / ctx.bkg_boxsize
         # prepare output median and std output arrays
         mesh_median = np.ndarray((nysubs, nxsubs))
         mesh_std = np.ndarray((nysubs, nxsubs))
         nsub = -1
-        mask_minsize = 0.5*bkg_boxsize**2
+        mask_minsize = 0.5*ctx.bkg_boxsize**2
         for i in range(nxsubs):
             for j in range(nysubs):
                 nsub += 1
@@ -1871,24 +3772,24 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
                     # if less than half of the elements of mask_sub
                     # are True, use values from entire masked image
                     median, std = median_full, std_full
-                    if verbose:
+                    if ctx.verbose:
                         print 'Warning: using median and std of entire masked image for this background patch'
                         print '  nsub', nsub
                         print '  subcut', subcut
-                        print '  np.sum(mask_sub) / bkg_boxsize**2', np.float(np.sum(mask_sub)) / bkg_boxsize**2
+                        print '  np.sum(mask_sub) / bkg_boxsize**2', np.float(np.sum(mask_sub)) / ctx.bkg_boxsize**2
                         
                 # fill median and std arrays
                 mesh_median[j,i] = median
                 mesh_std[j,i] = std
 
         # median filter the meshes with filter of size [bkg_filtersize]
-        shape_filter = (bkg_filtersize, bkg_filtersize)
+        shape_filter = (ctx.bkg_filtersize, ctx.bkg_filtersize)
         mesh_median_filt = ndimage.filters.median_filter(mesh_median, shape_filter)
         mesh_std_filt = ndimage.filters.median_filter(mesh_std, shape_filter)
 
         # resize low-resolution meshes
-        background = ndimage.zoom(mesh_median_filt, bkg_boxsize)
-        background_std = ndimage.zoom(mesh_std_filt, bkg_boxsize)
+        background = ndimage.zoom(mesh_median_filt, ctx.bkg_boxsize)
+        background_std = ndimage.zoom(mesh_std_filt, ctx.bkg_boxsize)
 
         #ds9_arrays(data_objmask=data_objmask, mesh_median=mesh_median, mesh_median_filt=mesh_median_filt,
         #           background=background, background_std=background_std)
@@ -1911,7 +3812,7 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
             # these now include the remaining patches
                         
             
-    if timing: print 'wall-time spent in get_back', time.time() - t
+    if ctx.timing: print 'wall-time spent in get_back', time.time() - t
 
     return background, background_std
     
@@ -1920,8 +3821,9 @@ def get_back (data, data_objmask, use_photutils=False, clip=True):
 
 def plot_scatter (x, y, yerr, limits, corder, cmap='rainbow_r', symbol='o',
                   xlabel='', ylabel='', legendlabel='', title='', filename='',
-                  simple=False):
+                  simple=False, show_plots=False):
 
+    import matplotlib.pyplot as plt
     plt.axis(limits)
     #xplt.errorbar(x, y, yerr=yerr, linestyle="None", color='k')
     plt.scatter(x, y, c=corder, cmap=cmap, alpha=0.75, label=legendlabel)
@@ -1938,7 +3840,8 @@ def plot_scatter (x, y, yerr, limits, corder, cmap='rainbow_r', symbol='o',
 
 ################################################################################
 
-def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, image_wt=None):
+@instrumented
+def get_psf(ctx, image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, image_wt=None):
 
     """Function that takes in [image] and determines the actual Point
     Spread Function as a function of position from the full frame, and
@@ -1947,52 +3850,53 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
 
     """
 
-    global psf_size_new
     
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting get_psf ...'
 
     # determine image size from header
     xsize, ysize = ima_header['NAXIS1'], ima_header['NAXIS2']
 
     if image_mask:
-        sex_par_arg = sex_mask_par
+        sex_par_arg = ctx.sex_mask_par
     else:
-        sex_par_arg = sex_par
+        sex_par_arg = ctx.sex_par
 
     # run sextractor on image; this step is no longer needed as it is
     # done inside Astrometry.net, producing the same catalog as an
     # independent SExtractor run would.
     sexcat = image.replace('.fits', '.sexcat')
-    if (not os.path.isfile(sexcat) or redo) and dosex:
-        result = run_sextractor(image, sexcat+'_alt', sex_cfg, sex_par_arg, pixscale, fwhm=fwhm, mask_file=image_mask, wt_file=image_wt)
+    if (not os.path.isfile(sexcat) or ctx.redo) and ctx.dosex:
+        result = run_sextractor(ctx, image, sexcat+'_alt', ctx.sex_cfg, sex_par_arg, pixscale, fwhm=fwhm, mask_file=image_mask, wt_file=image_wt)
     # ---------
     # FILTER sexcat here to include only good psf candidates
     #----------
 
     # run psfex on SExtractor output catalog
     psfexcat = image.replace('.fits', '.psfexcat')
-    if not os.path.isfile(psfexcat) or redo:
+    psfex_bintable = image.replace('.fits', '.psf')
+    if not os.path.isfile(psfexcat) or ctx.redo:
         print 'sexcat', sexcat
         print 'psfexcat', psfexcat
         if imtype=='ref':
-            result = run_psfex(sexcat, psfex_cfg, psfexcat, dir_override=template_dir)
+            dir_override = ctx.template_dir
         else:
-            result = run_psfex(sexcat, psfex_cfg, psfexcat)
+            dir_override = None
+        result = run_cached(ctx, 'psfex', [image, sexcat], [psfexcat, psfex_bintable],
+                            run_psfex, ctx, sexcat, ctx.psfex_cfg, psfexcat,
+                            dir_override=dir_override)
 
     # again run SExtractor, but now using output PSF from PSFex, so
     # that PSF-fitting can be performed for all objects. The output
     # columns defined in [sex_par_psffit] include several new columns
     # related to the PSF fitting.
-    if (not os.path.isfile(sexcat+'_psffit') or redo) and dosex_psffit:
-        result = run_sextractor(image, sexcat+'_psffit', sex_cfg_psffit,
-                                sex_mask_par_psffit, pixscale, fitpsf=True, fwhm=fwhm, mask_file=image_mask, wt_file=image_wt)
+    if (not os.path.isfile(sexcat+'_psffit') or ctx.redo) and ctx.dosex_psffit:
+        result = run_sextractor(ctx, image, sexcat+'_psffit', ctx.sex_cfg_psffit,
+                                ctx.sex_mask_par_psffit, pixscale, fitpsf=True, fwhm=fwhm, mask_file=image_mask, wt_file=image_wt)
         
     # read in PSF output binary table from psfex
-    psfex_bintable = image.replace('.fits', '.psf')
-    with fits.open(psfex_bintable) as hdulist:
-        header = hdulist[1].header
-        data = hdulist[1].data[0][0][:]
+    header, data = run_cached(ctx, 'read_psfex', [psfex_bintable], [],
+                              read_psfex, psfex_bintable)
 
     # read in some header keyword values
     polzero1 = header['POLZERO1']
@@ -2006,7 +3910,7 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
     # configuration file ([PSF_SIZE] parameter), which is the same as
     # the size of the [data] array
     psf_size_config = header['PSFAXIS1']
-    if verbose:
+    if ctx.verbose:
         print 'polzero1                   ', polzero1
         print 'polscal1                   ', polscal1
         print 'polzero2                   ', polzero2
@@ -2018,9 +3922,9 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
         
     # call centers_cutouts to determine centers
     # and cutout regions of the full image
-    centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(subimage_size, ysize, xsize)
-    ysize_fft = subimage_size + 2*subimage_border
-    xsize_fft = subimage_size + 2*subimage_border
+    centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes = centers_cutouts(ctx.subimage_size, ysize, xsize, border=ctx.subimage_border)
+    ysize_fft = ctx.subimage_size + 2*ctx.subimage_border
+    xsize_fft = ctx.subimage_size + 2*ctx.subimage_border
 
     if imtype == 'ref':
 
@@ -2035,10 +3939,10 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
         # first infer ra, dec corresponding to x, y pixel positions
         # (centers[:,1] and centers[:,0], respectively, using the
         # [new].wcs file from Astrometry.net
-        wcs = WCS(base_new+'.wcs')
+        wcs = read_wcs(ctx, ctx.base_new+'.wcs')
         ra_temp, dec_temp = wcs.all_pix2world(centers[:,1], centers[:,0], 1)
         # then convert ra, dec back to x, y in the original ref image
-        wcs = WCS(base_ref+'.wcs')
+        wcs = read_wcs(ctx, ctx.base_ref+'.wcs')
         centers[:,1], centers[:,0] = wcs.all_world2pix(ra_temp, dec_temp, 1)
         
     # initialize output PSF array
@@ -2053,15 +3957,9 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
         psf_size += 1
     # now change psf_samp slightly:
     psf_samp_update = float(psf_size) / float(psf_size_config)
-    if imtype == 'new': psf_size_new = psf_size
+    if imtype == 'new': ctx.psf_size_new = psf_size
     # [psf_ima] is the corresponding cube of PSF subimages
     psf_ima = np.zeros((nsubs,psf_size,psf_size), dtype='float32')
-    # [psf_ima_center] is [psf_ima] broadcast into images of xsize_fft
-    # x ysize_fft
-    psf_ima_center = np.zeros((nsubs,ysize_fft,xsize_fft), dtype='float32')
-    # [psf_ima_shift] is [psf_ima_center] shifted - this is
-    # the input PSF image needed in the zogy function
-    psf_ima_shift = np.zeros((nsubs,ysize_fft,xsize_fft), dtype='float32')
     
     # loop through nsubs and construct psf at the center of each
     # subimage, using the output from PSFex that was run on the full
@@ -2071,7 +3969,7 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
         x = (centers[nsub,1] - polzero1) / polscal1
         y = (centers[nsub,0] - polzero2) / polscal2
 
-        if nsubs==1 or use_single_psf:
+        if nsubs==1 or ctx.use_single_psf:
             psf_ima_config = data[0]
         else:
             if poldeg==2:
@@ -2085,59 +3983,105 @@ def get_psf(image, ima_header, nsubs, imtype, fwhm, pixscale, image_mask=None, i
         # resample PSF image at image pixel scale
         psf_ima_resized = ndimage.zoom(psf_ima_config, psf_samp_update)
         # clean from low values
-        if psf_clean_factor!=0:
-            psf_ima_resized = clean_psf(psf_ima_resized, psf_clean_factor)
+        if ctx.psf_clean_factor!=0:
+            psf_ima_resized = clean_psf(psf_ima_resized, ctx.psf_clean_factor)
         # normalize to unity
         psf_ima_resized_norm = psf_ima_resized / np.sum(psf_ima_resized)
         psf_ima[nsub] = psf_ima_resized_norm
-        if verbose and nsub==1:
+        if ctx.verbose and nsub==1:
             print 'psf_samp, psf_samp_update', psf_samp, psf_samp_update
             print 'np.shape(psf_ima_config)', np.shape(psf_ima_config)
             print 'np.shape(psf_ima)', np.shape(psf_ima)
             print 'np.shape(psf_ima_resized)', np.shape(psf_ima_resized)
             print 'psf_size ', psf_size
             
-        # now place this resized and normalized PSF image at the
-        # center of an image with the same size as the fftimage
-        if ysize_fft % 2 != 0 or xsize_fft % 2 != 0:
-            print 'WARNING: image not even in one or both dimensions!'
-            
-        xcenter_fft, ycenter_fft = xsize_fft/2, ysize_fft/2
-        if verbose and nsub==0:
-            print 'xcenter_fft, ycenter_fft ', xcenter_fft, ycenter_fft
-
-        psf_hsize = psf_size/2
-        index = [slice(ycenter_fft-psf_hsize, ycenter_fft+psf_hsize+1), 
-                 slice(xcenter_fft-psf_hsize, xcenter_fft+psf_hsize+1)]
-        psf_ima_center[nsub][index] = psf_ima_resized_norm
+        if ctx.display:
+            fits.writeto(os.path.join(ctx.output_dir,'psf_ima_config_'+imtype+'_sub.fits'), psf_ima_config, clobber=True)
+            fits.writeto(os.path.join(ctx.output_dir,'psf_ima_resized_norm_'+imtype+'_sub.fits'),
+                         psf_ima_resized_norm.astype(np.float32), clobber=True)
 
-        # perform fft shift
-        psf_ima_shift[nsub] = fft.fftshift(psf_ima_center[nsub])
+    # [psf_ima_shift] is [psf_ima] placed in images of xsize_fft x
+    # ysize_fft and shifted - this is the input PSF image needed in
+    # the zogy function
+    psf_ima_shift = shift_psf(psf_ima, ysize_fft, xsize_fft)
 
-        if display:
-            fits.writeto(os.path.join(output_dir,'psf_ima_config_'+imtype+'_sub.fits'), psf_ima_config, clobber=True)
-            fits.writeto(os.path.join(output_dir,'psf_ima_resized_norm_'+imtype+'_sub.fits'),
-                         psf_ima_resized_norm.astype(np.float32), clobber=True)
-            fits.writeto(os.path.join(output_dir,'psf_ima_center_'+imtype+'_sub.fits'),
-                         psf_ima_center[nsub].astype(np.float32), clobber=True)            
-            fits.writeto(os.path.join(output_dir,'psf_ima_shift_'+imtype+'_sub.fits'),
-                         psf_ima_shift[nsub].astype(np.float32), clobber=True)            
+    if ctx.display:
+        fits.writeto(os.path.join(ctx.output_dir,'psf_ima_center_'+imtype+'_sub.fits'),
+                     fft.ifftshift(psf_ima_shift[-1]).astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'psf_ima_shift_'+imtype+'_sub.fits'),
+                     psf_ima_shift[-1].astype(np.float32), clobber=True)
 
-    if timing: print 'wall-time spent in get_psf', time.time() - t
+    if ctx.timing: print 'wall-time spent in get_psf', time.time() - t
 
     return psf_ima_shift, psf_ima
 
 ################################################################################
 
-def get_psf_xycoords(psfex_bintable, xcoords, ycoords, psf_oddsized=False, order=3):
+def shift_psf(psf_ima, ysize_fft, xsize_fft):
+
+    """Function that places the odd-sized PSF images in the cube
+    [psf_ima] at the center of images of [ysize_fft] x [xsize_fft]
+    pixels and shifts them with fft.fftshift, as needed in
+    [run_ZOGY]."""
+
+    if ysize_fft % 2 != 0 or xsize_fft % 2 != 0:
+        print 'WARNING: image not even in one or both dimensions!'
+
+    nsubs, psf_size = psf_ima.shape[0], psf_ima.shape[-1]
+    xcenter_fft, ycenter_fft = xsize_fft/2, ysize_fft/2
+    psf_hsize = psf_size/2
+    index = [slice(None),
+             slice(ycenter_fft-psf_hsize, ycenter_fft+psf_hsize+1), 
+             slice(xcenter_fft-psf_hsize, xcenter_fft+psf_hsize+1)]
+
+    psf_ima_center = np.zeros((nsubs,ysize_fft,xsize_fft), dtype='float32')
+    psf_ima_center[index] = psf_ima
+    return fft.fftshift(psf_ima_center, axes=(-2,-1))
+
+################################################################################
+
+def save_psf(ctx, psf_file, *args, **kwargs):
+
+    """Function that runs [get_psf] with the arguments [args] and
+    [kwargs], and saves the cube with the PSF at the subimage centers
+    to the numpy file [psf_file], so that the shifted cube can be
+    derived from it with [shift_psf] without keeping it in the stage
+    record (see [run_cached])."""
+
+    psf_ima_shift, psf_ima = get_psf(ctx, *args, **kwargs)
+    with open(psf_file+'.tmp', 'wb') as f:
+        np.save(f, psf_ima)
+    os.rename(psf_file+'.tmp', psf_file)
+
+################################################################################
+
+def read_psfex(psfex_bintable):
+
+    """Function that returns the header and the PSF polynomial
+    components (array with shape (ncomponents, psf_size_config,
+    psf_size_config)) of the PSFex output file [psfex_bintable]."""
+
+    with fits.open(psfex_bintable) as hdulist:
+        header = hdulist[1].header
+        data = np.array(hdulist[1].data[0][0][:])
+    return header, data
+
+################################################################################
+
+def get_psf_xycoords(ctx, psfex_bintable, xcoords, ycoords, psf_oddsized=False, order=3,
+                     cell=None):
 
     """Function that takes in .psf file produced by PSFex and returns a
     cube containing the original PSF and the shifted PSF at the
     coordinate arrays [x], [y]
 
+    If [cell] is not None, the PSF is only built once for each cell of
+    [cell] x [cell] pixels, at the center of the cell and without the
+    subpixel shift, and shared by the coordinates within that cell.
+
     """
 
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting get_psf_xycoords ...'
 
     # number of coordinates
@@ -2159,7 +4103,7 @@ def get_psf_xycoords(psfex_bintable, xcoords, ycoords, psf_oddsized=False, order
     # [psf_size_config] is the size of the PSF grid as defined in the
     # PSFex configuration file ([PSF_SIZE] parameter)
     psf_size_config = header['PSFAXIS1']
-    if verbose:
+    if ctx.verbose:
         print 'polzero1                   ', polzero1
         print 'polscal1                   ', polscal1
         print 'polzero2                   ', polzero2
@@ -2191,14 +4135,25 @@ def get_psf_xycoords(psfex_bintable, xcoords, ycoords, psf_oddsized=False, order
     psf_cube_noshift = np.ndarray((ncoords,psf_size,psf_size), dtype='float32')
     xshift_array = np.zeros(ncoords)
     yshift_array = np.zeros(ncoords)
+    # the PSFs per cell if [cell] is not None
+    cell_psfs = {}
     
     # loop through coordinates and construct psf
     for i in range(ncoords):
 
-        x = (int(xcoords[i]) - polzero1) / polscal1
-        y = (int(ycoords[i]) - polzero2) / polscal2
+        if cell is not None:
+            key = (int(xcoords[i])/cell, int(ycoords[i])/cell)
+            if key in cell_psfs:
+                psf_cube_noshift[i], psf_cube_shift[i] = cell_psfs[key]
+                continue
+            xpsf, ypsf = (key[0]+0.5)*cell, (key[1]+0.5)*cell
+        else:
+            xpsf, ypsf = xcoords[i], ycoords[i]
+
+        x = (int(xpsf) - polzero1) / polscal1
+        y = (int(ypsf) - polzero2) / polscal2
         
-        if ncoords==1 or use_single_psf:
+        if ncoords==1 or ctx.use_single_psf:
             psf_ima_config = data[0]
         else:
             if poldeg==2:
@@ -2212,7 +4167,9 @@ def get_psf_xycoords(psfex_bintable, xcoords, ycoords, psf_oddsized=False, order
         # shift to the subpixel center of the object (object at
         # fractional pixel position 0.5,0.5 doesn't need the PSF to
         # shift as the PSF image is constructed to be even
-        if psf_oddsized:
+        if cell is not None:
+            xshift, yshift = 0., 0.
+        elif psf_oddsized:
             xshift = xcoords[i]-np.round(xcoords[i])
             yshift = ycoords[i]-np.round(ycoords[i])
         else:
@@ -2247,25 +4204,28 @@ def get_psf_xycoords(psfex_bintable, xcoords, ycoords, psf_oddsized=False, order
             #psf_ima_shift_resized = image_shift_fft(psf_ima_resized, xshift, yshift)
 
         # clean from low values
-        if psf_clean_factor!=0:
-            psf_ima_shift_resized = clean_psf(psf_ima_shift_resized, psf_clean_factor)
+        if ctx.psf_clean_factor!=0:
+            psf_ima_shift_resized = clean_psf(psf_ima_shift_resized, ctx.psf_clean_factor)
         # normalize to unity
         psf_cube_shift[i] = psf_ima_shift_resized / np.sum(psf_ima_shift_resized)
 
         # also return normalized PSF without any shift
         # clean from low values
-        if psf_clean_factor!=0:
-            psf_ima_resized = clean_psf(psf_ima_resized, psf_clean_factor)
+        if ctx.psf_clean_factor!=0:
+            psf_ima_resized = clean_psf(psf_ima_resized, ctx.psf_clean_factor)
         # normalize to unity
         psf_cube_noshift[i] =  psf_ima_resized / np.sum(psf_ima_resized)
+
+        if cell is not None:
+            cell_psfs[key] = (psf_cube_noshift[i], psf_cube_shift[i])
         
-    if timing: print 'wall-time spent in get_psf_xycoords', time.time() - t
+    if ctx.timing: print 'wall-time spent in get_psf_xycoords', time.time() - t
 
     return psf_cube_noshift, psf_cube_shift, xshift_array, yshift_array
 
 ################################################################################
 
-def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref):
+def get_fratio_radec(ctx, psfcat_new, psfcat_ref, sexcat_new, sexcat_ref):
 
     """Function that takes in output catalogs of stars used in the PSFex
     runs on the new and the ref image, and returns the arrays with
@@ -2278,6 +4238,8 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref):
     t = time.time()
     print '\nexecuting get_fratio_radec ...'
     
+    from astropy.io import ascii
+
     def readcat (psfcat):
         table = ascii.read(psfcat, format='sextractor')
         number = table['SOURCE_NUMBER']
@@ -2292,18 +4254,11 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref):
     number_ref, x_ref, y_ref, norm_ref = readcat(psfcat_ref)
 
     def xy2radec (number, sexcat):
-        # read SExtractor fits table
-        with fits.open(sexcat) as hdulist:
-            data = hdulist[2].data
-            ra_sex = data['ALPHAWIN_J2000']
-            dec_sex = data['DELTAWIN_J2000']
-        # loop numbers and record in ra, dec
-        ra = []
-        dec = []
-        for n in number:
-            ra.append(ra_sex[n-1])
-            dec.append(dec_sex[n-1])      
-        return np.array(ra), np.array(dec)
+        # read the RA and DEC columns of the SExtractor catalog, which
+        # is sorted by NUMBER
+        cat = ctx.read_catalog(sexcat)
+        index = np.asarray(number) - 1
+        return cat['ALPHAWIN_J2000'][index], cat['DELTAWIN_J2000'][index]
     
     # get ra, dec corresponding to x, y
     ra_new, dec_new = xy2radec(number_new, sexcat_new)
@@ -2332,24 +4287,25 @@ def get_fratio_radec(psfcat_new, psfcat_ref, sexcat_new, sexcat_ref):
             # append ratio of normalized counts to fratios
             fratio.append(norm_new[i_new] / norm_ref[i_ref])
                         
-    if verbose:
+    if ctx.verbose:
         print 'fraction of PSF stars that match', float(nmatch)/len(x_new)
             
-    if timing: print 'wall-time spent in get_fratio_radec', time.time()-t
+    if ctx.timing: print 'wall-time spent in get_fratio_radec', time.time()-t
 
     return np.array(x_new_match), np.array(y_new_match), np.array(fratio), \
         np.array(dra_match), np.array(ddec_match)
 
 ################################################################################
 
-def centers_cutouts(subsize, ysize, xsize, get_remainder=False):
+def centers_cutouts(subsize, ysize, xsize, get_remainder=False, border=subimage_border):
     
     """Function that determines the input image indices (!) of the centers
     (list of nsubs x 2 elements) and cut-out regions (list of nsubs x
     4 elements) of image with the size xsize x ysize. Subsize is the
     fixed size of the subimages, e.g. 512 or 1024. The routine will
     fit as many of these in the full frames, and for the moment it
-    will ignore any remaining pixels outside."""
+    will ignore any remaining pixels outside. [border] is the width
+    of the border added around each subimage for the FFTs."""
     
     nxsubs = xsize / subsize
     nysubs = ysize / subsize
@@ -2374,8 +4330,8 @@ def centers_cutouts(subsize, ysize, xsize, get_remainder=False):
     cuts_fft = np.ndarray((nsubs, 4), dtype=int)
     sizes = np.ndarray((nsubs, 2), dtype=int)
 
-    ysize_fft = subsize + 2*subimage_border
-    xsize_fft = subsize + 2*subimage_border
+    ysize_fft = subsize + 2*border
+    xsize_fft = subsize + 2*border
         
     nsub = -1
     for i in range(nxsubs): 
@@ -2391,13 +4347,13 @@ def centers_cutouts(subsize, ysize, xsize, get_remainder=False):
             nsub += 1
             centers[nsub] = [y, x]
             cuts_ima[nsub] = [y-ny/2, y+ny/2, x-nx/2, x+nx/2]
-            y1 = np.amax([0,y-ny/2-subimage_border])
-            x1 = np.amax([0,x-nx/2-subimage_border])
-            y2 = np.amin([ysize,y+ny/2+subimage_border])
-            x2 = np.amin([xsize,x+nx/2+subimage_border])
+            y1 = np.amax([0,y-ny/2-border])
+            x1 = np.amax([0,x-nx/2-border])
+            y2 = np.amin([ysize,y+ny/2+border])
+            x2 = np.amin([xsize,x+nx/2+border])
             cuts_ima_fft[nsub] = [y1,y2,x1,x2]
-            cuts_fft[nsub] = [y1-(y-ny/2-subimage_border),ysize_fft-(y+ny/2+subimage_border-y2),
-                              x1-(x-nx/2-subimage_border),xsize_fft-(x+nx/2+subimage_border-x2)]
+            cuts_fft[nsub] = [y1-(y-ny/2-border),ysize_fft-(y+ny/2+border-y2),
+                              x1-(x-nx/2-border),xsize_fft-(x+nx/2+border-x2)]
             sizes[nsub] = [ny, nx]
             
     return centers, cuts_ima, cuts_ima_fft, cuts_fft, sizes
@@ -2406,6 +4362,7 @@ def centers_cutouts(subsize, ysize, xsize, get_remainder=False):
 
 def show_image(image):
 
+    import matplotlib.pyplot as plt
     im = plt.imshow(np.real(image), origin='lower', cmap='gist_heat',
                     interpolation='nearest')
     plt.show(im)
@@ -2427,9 +4384,26 @@ def ds9_arrays(**kwargs):
     
 ################################################################################
 
-def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_existing_wcs):
+def link_or_copy(filename, link):
+
+    """Function that makes [link] a hard link to [filename], which is
+    only read afterwards, so that the image is not copied; if the
+    link cannot be made (e.g. [link] is on another file system), it
+    is a copy."""
+
+    if os.path.lexists(link):
+        os.remove(link)
+    try:
+        os.link(filename, link)
+    except OSError:
+        shutil.copyfile(filename, link)
+
+################################################################################
+
+@instrumented
+def run_wcs(ctx, image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_existing_wcs):
 
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting run_wcs ...'
     print 'use_existing_wcs: ', use_existing_wcs
     
@@ -2445,37 +4419,36 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
 
     # if psf_sampling is zero, scale the size of the VIGNET output
     # in the output catalog with [psf_radius]*[fwhm]
-    if psf_sampling == 0.:
+    if ctx.psf_sampling == 0.:
         # replace VIGNET size in SExtractor parameter file based on [psf_radius]
-        size_vignet = np.int(np.ceil(2.*psf_radius*fwhm))
+        size_vignet = np.int(np.ceil(2.*ctx.psf_radius*fwhm))
         # make sure it's odd (not sure if this is important; suggested in
         # PSFex manual)
         if size_vignet % 2 == 0: size_vignet += 1
         size_vignet_str = str((size_vignet, size_vignet))
-        sex_par_temp = sex_par+'_temp'
-        with open(sex_par, 'rt') as file_in:
-            with open(sex_par_temp, 'wt') as file_out:
-                for line in file_in:
-                    file_out.write(line.replace('VIGNET(99,99)', 'VIGNET'+size_vignet_str))
-        if verbose:
+        # named after the image, so that the new and ref images can
+        # be processed at the same time
+        sex_par_temp = sex_params(ctx.sex_par, image_out.replace('.fits', '.params'),
+                                  vignet=(size_vignet, size_vignet))
+        if ctx.verbose:
             print 'VIGNET size:', size_vignet_str
     # if psf_sampling is non-zero, the VIGNET size as defined in the
-    # SExtractor config file is used, at the moment this is (99,99)
+    # SExtractor parameter file is used, at the moment this is (9,9)
     else:
-        sex_par_temp = sex_par
+        sex_par_temp = ctx.sex_par
             
     #scampcat = image_in.replace('.fits','.scamp')
 #----------------------------------------------------------------------------
     # prepare aperture radii string 
-    apphot_diams = np.array(apphot_radii) * 2 * fwhm
+    apphot_diams = np.array(ctx.apphot_radii) * 2 * fwhm
     apphot_diams_str = ",".join(apphot_diams.astype(str))
-    if verbose:
+    if ctx.verbose:
         print 'aperture diameters used for PHOT_APERTURES', apphot_diams_str
 
-    cmd_sex = 'sex -SEEING_FWHM '+str(seeing)+' -PARAMETERS_NAME '+sex_par_temp\
-              +' -PHOT_APERTURES '+apphot_diams_str+' -BACK_SIZE '+str(bkg_boxsize)\
-              +' -BACK_FILTERSIZE '+str(bkg_filtersize)\
-              +' -FILTER_NAME '+ sex_filter + ' -STARNNW_NAME '+ sex_nnw
+    sex_args = ['-SEEING_FWHM', str(seeing), '-PARAMETERS_NAME', sex_par_temp,
+                '-PHOT_APERTURES', apphot_diams_str, '-BACK_SIZE', str(ctx.bkg_boxsize),
+                '-BACK_FILTERSIZE', str(ctx.bkg_filtersize),
+                '-FILTER_NAME', ctx.sex_filter, '-STARNNW_NAME', ctx.sex_nnw]
 
     # add commands to produce BACKGROUND, BACKGROUND_RMS and
     # background-subtracted image with all pixels where objects were
@@ -2484,82 +4457,29 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
     bkg = image_in.replace('.fits','_bkg.fits')
     bkg_std = image_in.replace('.fits','_bkg_std.fits')
     objmask = image_in.replace('.fits','_objmask.fits')
-    cmd_sex += ' -CHECKIMAGE_TYPE BACKGROUND,BACKGROUND_RMS,-OBJECTS -CHECKIMAGE_NAME '\
-               +bkg+','+bkg_std+','+objmask
+    sex_args += ['-CHECKIMAGE_TYPE', 'BACKGROUND,BACKGROUND_RMS,-OBJECTS',
+                 '-CHECKIMAGE_NAME', bkg+','+bkg_std+','+objmask]
+    cmd_sex = ' '.join(['sex'] + sex_args)
 
+    wcsfile = image_in.replace('.fits', '.wcs')
     if use_existing_wcs:
-        # just write head of incoming file to wcsfile
-        # add to cmd_sex
-        #    "-PARAMETERS_NAME %s", paramfn
-        #    "-FILTER_NAME %s", filterfn
-        #    "-CATALOG_TYPE FITS_1.0"
-        #    "-CATALOG_NAME %s", xylsfn
-        #    fitsimgfn
-        # and then run cmd_sex - but where is its input coming from?
-        if False:
-            wcsfile = image_in.replace('.fits', '.wcs')
-            with fits.open(image_in) as hdulist:
-                header_in = hdulist[0].header
-                wcshdu = fits.PrimaryHDU(header=header_in)
-                wcshdu.writeto(wcsfile, clobber=True)
-            image_axy = image_in.replace('.fits','.axy')
-            cmd = ['augment-xylist', '-i', image_in, '-o', image_axy, '-k', sexcat,
-                   '--x-column', 'XWIN_IMAGE', '--y-column', 'YWIN_IMAGE',
-                   '--sextractor-config', sex_cfg,
-                   '--sextractor-path', cmd_sex]
-            print cmd
-            result = call(cmd)
-            print 'augment-xylist done'
-
-            cmd = ['new-wcs', '-i', image_axy, '-w', wcsfile, '-o', image_out, '-d']
-
-            print cmd
-            result = call(cmd)
-            print 'new-wcs done'
-        cmd = ['solve-field', '--no-plots',
-           '--sextractor-config', sex_cfg,
-           '--x-column', 'XWIN_IMAGE', '--y-column', 'YWIN_IMAGE',
-           '--sort-column', 'FLUX_AUTO',
-           '--no-remove-lines',
-           '--keep-xylist', sexcat,
-           # ignore existing WCS headers in FITS input images
-           #'--no-verify', 
-           #'--code-tolerance', str(0.01), 
-           #'--quad-size-min', str(0.1),
-           # for KMTNet images restrict the max quad size:
-           '--quad-size-max', str(0.4),
-           # number of field objects to look at:
-           #'--depth', str(10),
-           #'--scamp', scampcat,
-           image_in,
-           '--tweak-order', str(astronet_tweak_order), '--scale-low', str(scale_low),
-           '--scale-high', str(scale_high), '--scale-units', 'app',
-           '--ra', str(ra), '--dec', str(dec), '--radius', str(2.),
-               '--new-fits', image_out, '--overwrite', '--just-augment']
-
-
-        cmd += ['--sextractor-path', cmd_sex]
-        if verbose:
-            print 'Astrometry.net command:', cmd
-
-        result = call(cmd)
-
-        wcsfile = image_in.replace('.fits', '.wcs')
-        with fits.open(image_in) as hdulist:
-            header_in = hdulist[0].header
-            wcshdu = fits.PrimaryHDU(header=header_in)
-            wcshdu.writeto(wcsfile, clobber=True)
-
-        image_axy = image_in.replace('.fits','.axy')
-        cmd = ['new-wcs', '-i', image_in, '-w', wcsfile, '-o', image_out, '-d']
+        # the WCS in the header of [image_in] is trusted, so
+        # Astrometry.net is skipped: SExtractor is run directly (with
+        # the same parameters as inside Astrometry.net), [image_out]
+        # is a link to [image_in] (see [link_or_copy]), and the RA
+        # and DEC of the sources are computed from the header WCS
+        # below
+        cmd = ['sex', image_in, '-c', ctx.sex_cfg, '-CATALOG_NAME', sexcat,
+               '-CATALOG_TYPE', 'FITS_1.0'] + sex_args
+        result = run_tool(ctx, cmd, sexcat+'.log')
+
+        header_in = ctx.read_fits_header(image_in)
+        fits.PrimaryHDU(header=header_in).writeto(wcsfile, clobber=True)
+        link_or_copy(image_in, image_out)
 
-        print cmd
-        result = call(cmd)
-        print 'new-wcs done'
-        
     else:
         cmd = ['solve-field', '--no-plots',
-           '--sextractor-config', sex_cfg,
+           '--sextractor-config', ctx.sex_cfg,
            '--x-column', 'XWIN_IMAGE', '--y-column', 'YWIN_IMAGE',
            '--sort-column', 'FLUX_AUTO',
            '--no-remove-lines',
@@ -2574,23 +4494,23 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
            #'--depth', str(10),
            #'--scamp', scampcat,
            image_in,
-           '--tweak-order', str(astronet_tweak_order), '--scale-low', str(scale_low),
+           '--tweak-order', str(ctx.astronet_tweak_order), '--scale-low', str(scale_low),
            '--scale-high', str(scale_high), '--scale-units', 'app',
            '--ra', str(ra), '--dec', str(dec), '--radius', str(2.),
            '--new-fits', image_out, '--overwrite']
 
 
         cmd += ['--sextractor-path', cmd_sex]
-        if verbose:
+        if ctx.verbose:
             print 'Astrometry.net command:', cmd
 
-        result = call(cmd)
+        result = run_tool(ctx, cmd, image_out.replace('.fits', '.solve-field.log'))
 
 
-    if timing: t2 = time.time()
+    if ctx.timing: t2 = time.time()
 #-----------------------------------------------------------------------------
-    # this is the file containing just the WCS solution from Astrometry.net
-    wcsfile = image_in.replace('.fits', '.wcs')
+    # [wcsfile] is the file containing just the WCS solution from
+    # Astrometry.net, or the header of [image_in] if [use_existing_wcs]
 
     use_wcs_xy2rd = False
     if use_wcs_xy2rd:
@@ -2601,7 +4521,7 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
         radecfile = image_in.replace('.fits', '.radec')
         cmd = ['wcs-xy2rd', '-w', wcsfile, '-i', sexcat, '-o', radecfile,
                '-X', 'XWIN_IMAGE', '-Y', 'YWIN_IMAGE']
-        result = call(cmd)
+        result = run_tool(ctx, cmd, radecfile+'.log')
         # read file with new ra and dec
         with fits.open(radecfile) as hdulist:
             data_newradec = hdulist[1].data
@@ -2615,6 +4535,7 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
         hdr_out = hdulist[0].header
 
     if not use_existing_wcs:
+        from sip_tpv import sip_to_pv
         sip_to_pv(hdr_out, tpv_format=False)
 
     # DOES hdr_out actually get USED?!  Yes, as hdulist[0].header
@@ -2651,9 +4572,13 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
     # although PSFex only seems to use 2 of them: SEXGAIN and SEXBKDEV.
     # Astrometry.net does not provide these values (zeros), so their
     # values need to be set.
-    axycat = image_in.replace('.fits','.axy')
-    with fits.open(axycat) as hdulist:
-        header_axycat = hdulist[0].header
+    if use_existing_wcs:
+        # there is no .axy file without Astrometry.net
+        header_axycat = fits.Header()
+    else:
+        axycat = image_in.replace('.fits','.axy')
+        with fits.open(axycat) as hdulist:
+            header_axycat = hdulist[0].header
     header_axycat['FITSFILE'] = image_out
     header_axycat['SEXGAIN'] = gain
     # estimate background r.m.s. (needed by PSFex) from BACKGROUND column in sexcat
@@ -2672,7 +4597,7 @@ def run_wcs(image_in, image_out, ra, dec, gain, readnoise, fwhm, pixscale, use_e
     result = fits2ldac(header_wcsimage+header_axycat,
                        data_sexcat, sexcat, doSort=True)
     
-    if timing:
+    if ctx.timing:
         print 'extra time for creating LDAC fits table', time.time()-t2
         print 'wall-time spent in run_wcs', time.time()-t
 
@@ -2737,30 +4662,33 @@ def fits2ldac (header4ext2, data4ext3, fits_ldac_out, doSort=True):
     
 ################################################################################
     
-def run_remap(image_new, image_ref, image_out, image_out_size,
-              gain, config=swarp_cfg, resampling_type='LANCZOS3',
+@instrumented
+def run_remap(ctx, image_new, image_ref, image_out, image_out_size,
+              gain, config=None, resampling_type='LANCZOS3',
               projection_err=0.001):
         
     """Function that remaps [image_ref] onto the coordinate grid of
        [image_new] and saves the resulting image in [image_out] with
-       size [image_size].
+       size [image_size]. If [config] is None, the SWarp configuration
+       file [swarp_cfg] of [ctx] is used.
     """
 
-    if timing: t = time.time()
+    if config is None:
+        config = ctx.swarp_cfg
+
+    if ctx.timing: t = time.time()
     print '\nexecuting run_remap ...'
 
     # read headers
     t = time.time()
-    with fits.open(image_new) as hdulist:
-        header_new = hdulist[0].header
-    with fits.open(image_ref) as hdulist:
-        header_ref = hdulist[0].header
+    header_new = ctx.read_fits_header(image_new)
+    header_ref = ctx.read_fits_header(image_ref)
         
     # create .head file with header info from [image_new]
     header_out = header_new[:]
     # copy some keywords from header_ref
     #for key in [key_exptime, key_satlevel, key_gain, key_ron, key_seeing]:
-    for key in [key_exptime, key_satlevel, key_gain, key_ron]:
+    for key in [ctx.key_exptime, ctx.key_satlevel, ctx.key_gain, ctx.key_ron]:
         header_out[key] = header_ref[key]
     # delete some others
     for key in ['WCSAXES', 'NAXIS1', 'NAXIS2']:
@@ -2775,15 +4703,48 @@ def run_remap(image_new, image_ref, image_out, image_out_size,
     cmd = ['swarp', image_ref, '-c', config, '-IMAGEOUT_NAME', image_out, 
            '-IMAGE_SIZE', size_str, '-GAIN_DEFAULT', str(gain),
            '-RESAMPLING_TYPE', resampling_type,
-           '-PROJECTION_ERR', str(projection_err), '-RESAMPLE_DIR', output_dir, '-XML_NAME', os.path.join(output_dir, 'swarp.xml')]
+           '-PROJECTION_ERR', str(projection_err), '-RESAMPLE_DIR', ctx.output_dir, '-XML_NAME', os.path.join(ctx.output_dir, 'swarp.xml')]
     print 'swarp cmd: ', cmd
-    result = call(cmd)
+    result = run_tool(ctx, cmd, image_out.replace('.fits', '.swarp.log'))
     
-    if timing: print 'wall-time spent in run_remap', time.time()-t
+    if ctx.timing: print 'wall-time spent in run_remap', time.time()-t
+
+################################################################################
+
+def seeing_catalog(ctx, sexcat):
+
+    """Function that returns the catalog written by [run_sextractor]
+    for the seeing estimate with catalog name [sexcat], which is
+    [sexcat]_fraction if only the central [ctx].fwhm_imafrac of the
+    image is used."""
+
+    if ctx.fwhm_imafrac < 1.:
+        return sexcat+'_fraction'
+    return sexcat
+
+################################################################################
+
+def sex_params(file_params, file_out, vignet=None):
+
+    """Function that writes the SExtractor parameter file [file_out]: a
+    copy of [file_params] without the VIGNET column if [vignet] is
+    None, or with the size of VIGNET set to [vignet], a (size, size)
+    tuple. Returns [file_out]."""
+
+    with open(file_params, 'rt') as file_in:
+        with open(file_out, 'wt') as f:
+            for line in file_in:
+                if re.match(r'\s*VIGNET\(', line):
+                    if vignet is None:
+                        continue
+                    line = re.sub(r'VIGNET\([^)]*\)', 'VIGNET({},{})'.format(*vignet), line)
+                f.write(line)
+    return file_out
 
 ################################################################################
 
-def run_sextractor(image, cat_out, file_config, file_params, pixscale,
+@instrumented
+def run_sextractor(ctx, image, cat_out, file_config, file_params, pixscale,
                    fitpsf=False, fraction=1.0, fwhm=5.0, mask_file=None, wt_file=None):
 
     """Function that runs SExtractor on [image], and saves the output
@@ -2797,51 +4758,49 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale,
 
     """
 
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting run_sextractor ...'
 
+    # the catalogs of this function are not used by PSFex, so the
+    # VIGNET column can be left out
+    if ctx.sex_par_lean:
+        file_params = sex_params(file_params, cat_out+'.params')
+
     # if fraction less than one, run SExtractor on specified fraction of
     # the image
     if fraction < 1.:
 
-        # read in input image and header
-        with fits.open(image) as hdulist:
-            header = hdulist[0].header
-            data = hdulist[0].data
+        # read in header of input image
+        header = ctx.read_fits_header(image)
         # get input image size from header
-        ysize, xsize = read_header(header, ['NAXIS2', 'NAXIS1'])
+        ysize, xsize = read_header(header, ['NAXIS2', 'NAXIS1'], verbose=ctx.verbose)
         
         # determine cutout from [fraction]
         center_x = np.int(xsize/2+0.5)
         center_y = np.int(ysize/2+0.5)
         halfsize_x = np.int((xsize * np.sqrt(fraction))/2.+0.5)
         halfsize_y = np.int((ysize * np.sqrt(fraction))/2.+0.5)
-        data_fraction = data[center_y-halfsize_y:center_y+halfsize_y,
-                             center_x-halfsize_x:center_x+halfsize_x]
+        index_fraction = [slice(center_y-halfsize_y, center_y+halfsize_y),
+                          slice(center_x-halfsize_x, center_x+halfsize_x)]
+        # only the pixels of the cutout are read from the
+        # memory-mapped image
+        data_fraction = ctx.read_fits(image, index=index_fraction)
 
         # write small image to fits
         image_fraction = image.replace('.fits','_fraction.fits')
         fits.writeto(image_fraction, data_fraction.astype(np.float32), header, clobber=True)
 
         if mask_file:
-            with fits.open(mask_file) as hdulist:
-                mask_header = hdulist[0].header
-                mask_data = hdulist[0].data
-                
-            mask_data_fraction = mask_data[center_y-halfsize_y:center_y+halfsize_y,
-                             center_x-halfsize_x:center_x+halfsize_x]
+            mask_header = ctx.read_fits_header(mask_file)
+            mask_data_fraction = ctx.read_fits(mask_file, index=index_fraction, dtype=None)
 
             mask_fraction = mask_file.replace('.fits','_fraction.fits')
             fits.writeto(mask_fraction, mask_data_fraction.astype(np.int32), mask_header, clobber=True)
             mask_file = mask_fraction
 
         if wt_file:
-            with fits.open(wt_file) as hdulist:
-                wt_header = hdulist[0].header
-                wt_data = hdulist[0].data
-                
-            wt_data_fraction = wt_data[center_y-halfsize_y:center_y+halfsize_y,
-                             center_x-halfsize_x:center_x+halfsize_x]
+            wt_header = ctx.read_fits_header(wt_file)
+            wt_data_fraction = ctx.read_fits(wt_file, index=index_fraction)
 
             wt_fraction = wt_file.replace('.fits','_fraction.fits')
             fits.writeto(wt_fraction, wt_data_fraction.astype(np.float32), wt_header, clobber=True)
@@ -2860,18 +4819,18 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale,
     # determine seeing
     seeing = fwhm * pixscale
     # prepare aperture diameter string to provide to SExtractor 
-    apphot_diams = np.array(apphot_radii) * 2 * fwhm
+    apphot_diams = np.array(ctx.apphot_radii) * 2 * fwhm
     apphot_diams_str = ",".join(apphot_diams.astype(str))
     
     # run sextractor from the unix command line
     cmd = ['sex', image, '-c', file_config, '-CATALOG_NAME', cat_out, 
            '-PARAMETERS_NAME', file_params, '-PIXEL_SCALE', str(pixscale),
            '-SEEING_FWHM', str(seeing),'-PHOT_APERTURES',apphot_diams_str,
-           '-BACK_SIZE', str(bkg_boxsize), '-BACK_FILTERSIZE', str(bkg_filtersize),
-           '-FILTER_NAME', sex_filter, '-STARNNW_NAME', sex_nnw]
+           '-BACK_SIZE', str(ctx.bkg_boxsize), '-BACK_FILTERSIZE', str(ctx.bkg_filtersize),
+           '-FILTER_NAME', ctx.sex_filter, '-STARNNW_NAME', ctx.sex_nnw]
 
     # in case of fraction being less than 1: only care about higher S/N detections
-    if fraction < 1.: cmd += ['-DETECT_THRESH', str(fwhm_detect_thresh)]
+    if fraction < 1.: cmd += ['-DETECT_THRESH', str(ctx.fwhm_detect_thresh)]
     
     # provide PSF file from PSFex
     if fitpsf: cmd += ['-PSF_NAME', image.replace('.fits', '.psf')]
@@ -2884,18 +4843,18 @@ def run_sextractor(image, cat_out, file_config, file_params, pixscale,
 
     print 'sex cmd: ', cmd
     # run command
-    result = call(cmd)
+    result = run_tool(ctx, cmd, cat_out+'.log')
 
     # get estimate of seeing from output catalog
-    fwhm, fwhm_std = get_fwhm(cat_out, fwhm_frac, class_Sort=fwhm_class_sort)
+    fwhm, fwhm_std = get_fwhm(ctx, cat_out, ctx.fwhm_frac, class_Sort=ctx.fwhm_class_sort)
 
-    if timing: print 'wall-time spent in run_sextractor', time.time()-t
+    if ctx.timing: print 'wall-time spent in run_sextractor', time.time()-t
     return fwhm, fwhm_std
 
 
 ################################################################################
 
-def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
+def get_fwhm (ctx, cat_ldac, fraction, class_Sort = False, get_elongation=False):
 
     """Function that accepts a FITS_LDAC table produced by SExtractor and
     returns the FWHM and its standard deviation in pixels.  The
@@ -2910,11 +4869,10 @@ def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
 
     """
  
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
     print '\nexecuting get_fwhm ...'
 
-    with fits.open(cat_ldac) as hdulist:
-        data = hdulist[2].data
+    data = ctx.read_catalog(cat_ldac)
 
     # these arrays correspond to objecst with flag==0 and flux_auto>0.
     index = (data['FLAGS']==0) & (data['FLUX_AUTO']>0.)
@@ -2944,19 +4902,20 @@ def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
     
     # determine mean, median and standard deviation through sigma clipping
     fwhm_mean, fwhm_std, fwhm_median = clipped_stats(fwhm_select)
-    if verbose:
+    if ctx.verbose:
         print 'catalog', cat_ldac
         print 'fwhm_mean, fwhm_median, fwhm_std', fwhm_mean, fwhm_median, fwhm_std
     if get_elongation:
         # determine mean, median and standard deviation through sigma clipping
         elongation_mean, elongation_std, elongation_median = clipped_stats(elongation_select)
-        if verbose:
+        if ctx.verbose:
             print 'elongation_mean, elongation_median, elongation_std',\
                 elongation_mean, elongation_median, elongation_std
             
     make_plots = False
     
     if make_plots:
+        import matplotlib.pyplot as plt
 
         # best parameter to plot vs. FWHM is MAG_AUTO
         mag_auto_select = mag_auto[index_sort][index_select]
@@ -2978,8 +4937,8 @@ def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
         plt.axis((0,20,y2,y1))
         plt.xlabel('FWHM (pixels)')
         plt.ylabel('MAG_AUTO')
-        plt.savefig(os.path.join(output_dir,'fwhm.pdf'))
-        if show_plots: plt.show()
+        plt.savefig(os.path.join(ctx.output_dir,'fwhm.pdf'))
+        if ctx.show_plots: plt.show()
         plt.close()
 
         if get_elongation:
@@ -2996,11 +4955,11 @@ def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
             plt.axis((0,20,y2,y1))
             plt.xlabel('ELONGATION (A/B)')
             plt.ylabel('MAG_AUTO')
-            plt.savefig(os.path.join(output_dir,'elongation.pdf'))
-            if show_plots: plt.show()
+            plt.savefig(os.path.join(ctx.output_dir,'elongation.pdf'))
+            if ctx.show_plots: plt.show()
             plt.close()
             
-    if timing: print 'wall-time spent in get_fwhm', time.time()-t
+    if ctx.timing: print 'wall-time spent in get_fwhm', time.time()-t
 
     if get_elongation:
         return fwhm_median, fwhm_std, elongation_median, elongation_std
@@ -3010,20 +4969,21 @@ def get_fwhm (cat_ldac, fraction, class_Sort = False, get_elongation=False):
 
 ################################################################################
 
-def run_psfex(cat_in, file_config, cat_out, dir_override=None):
+@instrumented
+def run_psfex(ctx, cat_in, file_config, cat_out, dir_override=None):
     
     """Function that runs PSFEx on [cat_in] (which is a SExtractor output
        catalog in FITS_LDAC format) using the configuration file
        [file_config]"""
 
-    if timing: t = time.time()
+    if ctx.timing: t = time.time()
 
-    if psf_sampling == 0:
+    if ctx.psf_sampling == 0:
         # provide new PSF_SIZE based on psf_radius, which is 2 *
         # [psf_radius] * FWHM / sampling factor. The sampling factor is
         # automatically determined in PSFex, and is such that FWHM /
         # sampling factor ~ 4-5, so:
-        size = np.int(psf_radius*9+0.5)
+        size = np.int(ctx.psf_radius*9+0.5)
         # make sure it's odd
         if size % 2 == 0: size += 1
         psf_size_config = str(size)+','+str(size)
@@ -3031,7 +4991,7 @@ def run_psfex(cat_in, file_config, cat_out, dir_override=None):
         # use some reasonable default size
         psf_size_config = '45,45'
 
-    if verbose:
+    if ctx.verbose:
         print 'psf_size_config', psf_size_config
         
     # get FWHM and ELONGATION to limit the PSFex configuration
@@ -3049,24 +5009,24 @@ def run_psfex(cat_in, file_config, cat_out, dir_override=None):
     if dir_override:
         psfDir = dir_override
     else:
-        psfDir = output_dir
+        psfDir = ctx.output_dir
 
     checkImageStr = ''
     checkImageList = ['chi.fits','proto.fits','samp.fits','resi.fits','snap.fits','basis.fits']
     nMax = len(checkImageList) - 1
     for (n, i) in enumerate(checkImageList):
-        checkImageStr += os.path.join(output_dir, i)
+        checkImageStr += os.path.join(ctx.output_dir, i)
         if n < nMax:
             checkImageStr += ','
     
     cmd = ['psfex', cat_in, '-c', file_config,'-OUTCAT_NAME', cat_out,
-           '-PSF_SIZE', psf_size_config, '-PSF_SAMPLING', str(psf_sampling), '-PSF_DIR', psfDir, '-XML_NAME', os.path.join(output_dir, 'psfex.xml'), '-CHECKIMAGE_NAME', checkImageStr]
+           '-PSF_SIZE', psf_size_config, '-PSF_SAMPLING', str(ctx.psf_sampling), '-PSF_DIR', psfDir, '-XML_NAME', os.path.join(ctx.output_dir, 'psfex.xml'), '-CHECKIMAGE_NAME', checkImageStr]
     #       '-SAMPLE_FWHMRANGE', sample_fwhmrange,
     #       '-SAMPLE_MAXELLIP', maxellip_str]
     print cmd
-    result = call(cmd)    
+    result = run_tool(ctx, cmd, cat_out+'.log')
 
-    if timing: print 'wall-time spent in run_psfex', time.time()-t
+    if ctx.timing: print 'wall-time spent in run_psfex', time.time()-t
 
 ################################################################################
 
@@ -3079,16 +5039,39 @@ def clean_psf(psf_array, clean_factor):
     
 ################################################################################
 
-def run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy):
+def run_ZOGY(ctx, R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy):
 
 # edited Barak's original code to include variances sigma_n**2 and
 # sigma_r**2 (see Eq. 9, here sn and sr) and Fn and Fr which are
 # assumed to be unity in Barak's code.
+
+# the calculation is split into the part that only depends on the
+# reference image and the PSFs ([run_ZOGY_ref]), and the part that
+# depends on the new image ([run_ZOGY_new]), so that the former can be
+# reused when only the new image changes (see [run_completeness])
+    
+    if ctx.timing: t = time.time()
+
+    zogy_ref = run_ZOGY_ref(ctx, R,Pr,Pn,sr,sn,fr,fn,Vr,dx,dy)
+    D, S, S_corr, alpha, alpha_std = run_ZOGY_new(ctx, zogy_ref, N, Vn)
+
+    if ctx.timing:
+        print 'wall-time spent in optimal subtraction', time.time()-t
+        #print 'peak memory used in run_ZOGY in GB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e9
     
-    if timing: t = time.time()
+    return D, S, S_corr, alpha, alpha_std
 
+################################################################################
+
+def run_ZOGY_ref(ctx, R,Pr,Pn,sr,sn,fr,fn,Vr,dx,dy):
+
+    """Function that performs the part of [run_ZOGY] that does not
+    depend on the new image: the Fourier transforms of the reference
+    image and the PSFs, the kernels kr and kn, and the (astrometric)
+    variance of the reference image. Returns a dictionary that is
+    passed on to [run_ZOGY_new]."""
+    
     R_hat = fft.fft2(R)
-    N_hat = fft.fft2(N)
     Pn_hat = fft.fft2(Pn)
     #if psf_clean_factor!=0:
         # clean Pn_hat
@@ -3115,22 +5098,21 @@ def run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy):
         
     #denominator_beta = sn2*Pr_hat2_abs + beta2*sr2*Pn_hat2_abs
 
-    D_hat = (fr*Pr_hat*N_hat - fn*Pn_hat*R_hat) / np.sqrt(denominator)
+    # D_hat = (fr*Pr_hat*N_hat - fn*Pn_hat*R_hat) / np.sqrt(denominator)
+    # is calculated in [run_ZOGY_new] as D_hat = DN_hat*N_hat - DR_hat
+    sqrt_denominator = np.sqrt(denominator)
+    DN_hat = fr*Pr_hat / sqrt_denominator
+    DR_hat = fn*Pn_hat*R_hat / sqrt_denominator
     # alternatively using beta:
     #D_hat = (Pr_hat*N_hat - beta*Pn_hat*R_hat) / np.sqrt(denominator_beta)
 
-    D = np.real(fft.ifft2(D_hat)) / fD
-    
-    P_D_hat = (fr*fn/fD) * (Pr_hat*Pn_hat) / np.sqrt(denominator)
+    P_D_hat = (fr*fn/fD) * (Pr_hat*Pn_hat) / sqrt_denominator
     #alternatively using beta:
     #P_D_hat = np.sqrt(sn2+beta2*sr2)*(Pr_hat*Pn_hat) / np.sqrt(denominator_beta)
 
     #P_D = np.real(fft.ifft2(P_D_hat))
     #print 'np.sum(P_D)', np.sum(P_D)
     
-    S_hat = fD*D_hat*np.conj(P_D_hat)
-    S = np.real(fft.ifft2(S_hat))
-
     # alternative way to calculate S
     #S_hat = (fn*fr2*Pr_hat2_abs*np.conj(Pn_hat)*N_hat -
     #         fr*fn2*Pn_hat2_abs*np.conj(Pr_hat)*R_hat) / denominator
@@ -3157,57 +5139,34 @@ def run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy):
     #print 'fD squared', fD**2
     
     Vr_hat = fft.fft2(Vr)
-    Vn_hat = fft.fft2(Vn)
-
     VSr = np.real(fft.ifft2(Vr_hat*kr2_hat))
-    VSn = np.real(fft.ifft2(Vn_hat*kn2_hat))
 
     dx2 = dx**2
     dy2 = dy**2
     # and calculate astrometric variance
-    Sn = np.real(fft.ifft2(kn_hat*N_hat))
-    dSndy = Sn - np.roll(Sn,1,axis=0)
-    dSndx = Sn - np.roll(Sn,1,axis=1)
-    VSn_ast = dx2 * dSndx**2 + dy2 * dSndy**2
-    
     Sr = np.real(fft.ifft2(kr_hat*R_hat))
     dSrdy = Sr - np.roll(Sr,1,axis=0)
     dSrdx = Sr - np.roll(Sr,1,axis=1)
     VSr_ast = dx2 * dSrdx**2 + dy2 * dSrdy**2
 
-    if verbose:
+    if ctx.verbose:
         print 'fD', fD
         #print 'kr_hat is finite?', np.all(np.isfinite(kr_hat))
         #print 'kn_hat is finite?', np.all(np.isfinite(kn_hat))
         #print 'dSrdx is finite?', np.all(np.isfinite(dSrdx))
         #print 'dSrdy is finite?', np.all(np.isfinite(dSrdy))
-        #print 'dSndy is finite?', np.all(np.isfinite(dSndy))
-        #print 'dSndx is finite?', np.all(np.isfinite(dSndx))
         #print 'VSr_ast is finite?', np.all(np.isfinite(VSr_ast))
-        #print 'VSn_ast is finite?', np.all(np.isfinite(VSn_ast))
         #print 'dx is finite?', np.isfinite(dx)
         #print 'dy is finite?', np.isfinite(dy)
     
-    if display:
-        fits.writeto(os.path.join(output_dir,'Pn_hat.fits'), np.real(Pn_hat).astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'Pr_hat.fits'), np.real(Pr_hat).astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'kr.fits'), np.real(kr).astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'kn.fits'), np.real(kn).astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'Sr.fits'), Sr.astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'Sn.fits'), Sn.astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'VSr.fits'), VSr.astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'VSn.fits'), VSn.astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'VSr_ast.fits'), VSr_ast.astype(np.float32), clobber=True)
-        fits.writeto(os.path.join(output_dir,'VSn_ast.fits'), VSn_ast.astype(np.float32), clobber=True)
-
-    # and finally S_corr
-    V_S = VSr + VSn
-    V_ast = VSr_ast + VSn_ast
-    V = V_S + V_ast
-    #S_corr = S / np.sqrt(V)
-    # make sure there's no division by zero
-    S_corr = np.copy(S)
-    S_corr[V>0] /= np.sqrt(V[V>0])
+    if ctx.display:
+        fits.writeto(os.path.join(ctx.output_dir,'Pn_hat.fits'), np.real(Pn_hat).astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'Pr_hat.fits'), np.real(Pr_hat).astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'kr.fits'), np.real(kr).astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'kn.fits'), np.real(kn).astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'Sr.fits'), Sr.astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'VSr.fits'), VSr.astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'VSr_ast.fits'), VSr_ast.astype(np.float32), clobber=True)
 
     # PMV 2017/03/05: added following PSF photometry part based on
     # Eqs. 41-43 from Barak's paper
@@ -3215,24 +5174,153 @@ def run_ZOGY(R,N,Pr,Pn,sr,sn,fr,fn,Vr,Vn,dx,dy):
     # divide by the number of pixels in the images (related to do
     # the normalization of the ffts performed)
     F_S /= R.size
-    if verbose:
+    if ctx.verbose:
         print 'F_S', F_S
     # an alternative (slower) way to calculate the same F_S:
     #F_S_array = fft.ifft2((fn2*Pn_hat2_abs*fr2*Pr_hat2_abs) / denominator)
     #F_S = F_S_array[0,0]
 
+    return {'fD': fD, 'DN_hat': DN_hat, 'DR_hat': DR_hat, 'P_D_hat_conj': np.conj(P_D_hat),
+            'kn_hat': kn_hat, 'kn2_hat': kn2_hat, 'VSr': VSr, 'VSr_ast': VSr_ast,
+            'dx2': dx2, 'dy2': dy2, 'F_S': F_S}
+
+################################################################################
+
+def run_ZOGY_new(ctx, zogy_ref, N, Vn):
+
+    """Function that performs the part of [run_ZOGY] that depends on the
+    new image [N] and its variance [Vn], using the dictionary
+    [zogy_ref] returned by [run_ZOGY_ref]. Returns D, S, Scorr and
+    the PSF flux and its error, like [run_ZOGY]."""
+
+    fD = zogy_ref['fD']
+    kn_hat = zogy_ref['kn_hat']
+
+    N_hat = fft.fft2(N)
+
+    D_hat = zogy_ref['DN_hat']*N_hat - zogy_ref['DR_hat']
+    D = np.real(fft.ifft2(D_hat)) / fD
+    
+    S_hat = fD*D_hat*zogy_ref['P_D_hat_conj']
+    S = np.real(fft.ifft2(S_hat))
+
+    Vn_hat = fft.fft2(Vn)
+    VSn = np.real(fft.ifft2(Vn_hat*zogy_ref['kn2_hat']))
+
+    # and calculate astrometric variance
+    Sn = np.real(fft.ifft2(kn_hat*N_hat))
+    dSndy = Sn - np.roll(Sn,1,axis=0)
+    dSndx = Sn - np.roll(Sn,1,axis=1)
+    VSn_ast = zogy_ref['dx2'] * dSndx**2 + zogy_ref['dy2'] * dSndy**2
+    
+    if ctx.display:
+        fits.writeto(os.path.join(ctx.output_dir,'Sn.fits'), Sn.astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'VSn.fits'), VSn.astype(np.float32), clobber=True)
+        fits.writeto(os.path.join(ctx.output_dir,'VSn_ast.fits'), VSn_ast.astype(np.float32), clobber=True)
+
+    # and finally S_corr
+    V_S = zogy_ref['VSr'] + VSn
+    V_ast = zogy_ref['VSr_ast'] + VSn_ast
+    V = V_S + V_ast
+    #S_corr = S / np.sqrt(V)
+    # make sure there's no division by zero
+    S_corr = np.copy(S)
+    S_corr[V>0] /= np.sqrt(V[V>0])
+
+    F_S = zogy_ref['F_S']
     alpha = S / F_S
     alpha_std = np.zeros(alpha.shape)
     alpha_std[V_S>=0] = np.sqrt(V_S[V_S>=0]) / F_S
 
-    if timing:
-        print 'wall-time spent in optimal subtraction', time.time()-t
-        #print 'peak memory used in run_ZOGY in GB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e9
-    
     return D, S, S_corr, alpha, alpha_std
 
 ################################################################################
 
+def run_completeness(ctx, zogy_ref, N, Vn, psf, bkg, RON, fwhm):
+
+    """Function that measures the recovery of fake stars in the
+    background-subtracted new subimage [N] with variance [Vn]. In
+    each of [ctx].completeness_ntrials trials,
+    [ctx].completeness_nstars stars with the PSF [psf] are added at
+    random positions to copies of [N] and [Vn], with magnitudes taken
+    from the grid [ctx].completeness_dmag, which is relative to the
+    flux of a point source with a S/N of [ctx].transient_nsigma on the
+    background [bkg] at the subimage center. Only the part of the
+    ZOGY calculation that depends on the new image is redone in each
+    trial ([run_ZOGY_new]), with [zogy_ref] as returned by
+    [run_ZOGY_ref].
+
+    A star is recovered if the highest Scorr within one pixel of its
+    position is at least [ctx].transient_nsigma. Returns a
+    dictionary of arrays with the trial number, position in the
+    subimage, magnitude offset, input flux, and the Fpsf, Fpsferr and
+    Scorr at the position of each fake star and whether it was
+    recovered."""
+
+    if ctx.timing: t = time.time()
+
+    ysize, xsize = N.shape
+    psf_hsize = psf.shape[0]/2
+    edge = ctx.subimage_border + psf_hsize + 1
+    steps = np.arange(-psf_hsize, psf_hsize+1)
+    steps_peak = np.arange(-1, 2)
+
+    # flux of a point source at the detection threshold
+    yc, xc = ysize/2, xsize/2
+    bkg_center = bkg[yc-psf_hsize:yc+psf_hsize+1, xc-psf_hsize:xc+psf_hsize+1]
+    flux_lim = flux_optimal_s2n_batch(psf, bkg_center[None], RON, ctx.transient_nsigma,
+                                      fwhm=fwhm)[0]
+    
+    dmag_grid = np.array(ctx.completeness_dmag, dtype=float)
+    nstars = ctx.completeness_nstars
+
+    names = ['TRIAL', 'X_POS', 'Y_POS', 'DMAG', 'FLUX_IN', 'FLUX_PSF', 'FLUXERR_PSF',
+             'SCORR', 'SCORR_PEAK', 'RECOVERED']
+    trials = dict([(name, []) for name in names])
+    
+    for trial in range(ctx.completeness_ntrials):
+
+        # positions and magnitudes of the fake stars, with the
+        # magnitudes spread evenly over the grid
+        x = np.random.randint(edge, xsize-edge, nstars)
+        y = np.random.randint(edge, ysize-edge, nstars)
+        dmag = dmag_grid[np.random.permutation(nstars) % len(dmag_grid)]
+        flux = flux_lim * 10**(-0.4*dmag)
+
+        # add all stars to copies of the new subimage and its variance
+        index_y = y[:,None,None] + steps[None,:,None]
+        index_x = x[:,None,None] + steps[None,None,:]
+        stamps = flux[:,None,None] * psf
+        N_trial = np.copy(N)
+        np.add.at(N_trial, (index_y, index_x), stamps)
+        Vn_trial = np.copy(Vn)
+        np.add.at(Vn_trial, (index_y, index_x), stamps)
+
+        D, S, Scorr, Fpsf, Fpsferr = run_ZOGY_new(ctx, zogy_ref, N_trial, Vn_trial)
+
+        # gather the results at all positions at once
+        Scorr_peak = Scorr[y[:,None,None] + steps_peak[None,:,None],
+                           x[:,None,None] + steps_peak[None,None,:]].reshape(nstars,-1).max(axis=1)
+        trials['TRIAL'].append(np.zeros(nstars, dtype=int) + trial)
+        trials['X_POS'].append(x.astype(float))
+        trials['Y_POS'].append(y.astype(float))
+        trials['DMAG'].append(dmag)
+        trials['FLUX_IN'].append(flux)
+        trials['FLUX_PSF'].append(Fpsf[y, x])
+        trials['FLUXERR_PSF'].append(Fpsferr[y, x])
+        trials['SCORR'].append(Scorr[y, x])
+        trials['SCORR_PEAK'].append(Scorr_peak)
+        trials['RECOVERED'].append(Scorr_peak >= ctx.transient_nsigma)
+
+    for name in names:
+        trials[name] = np.concatenate(trials[name])
+
+    if ctx.timing: print 'wall-time spent in run_completeness', time.time()-t
+
+    return trials
+
+################################################################################
+
 def optimal_binary_image_subtraction(R,N,Pr,Pn,sr,sn):
 
 # original code from Barak (this assumes fr and fn are unity, and it
@@ -3244,12 +5332,12 @@ def optimal_binary_image_subtraction(R,N,Pr,Pn,sr,sn):
     Pr_hat = fft.fft2(Pr)
     G_hat = (Pr_hat*N_hat - Pn_hat*R_hat) / np.sqrt((sr**2*abs(Pn_hat**2) + sn**2*abs(Pr_hat**2)))
     P_G_hat = (Pr_hat*Pn_hat) / np.sqrt((sr**2*abs(Pn_hat**2) + sn**2*abs(Pr_hat**2)))
-    S_hat = G_hat*conj(P_G_hat)
+    S_hat = G_hat*np.conj(P_G_hat)
     #S_hat = (conj(Pn_hat)*np.abs(Pr_hat)**2*N_hat - conj(Pr_hat)*np.abs(Pn_hat)**2*R_hat) / (sr**2*abs(Pn_hat**2) + sn**2*abs(Pr_hat**2))
     S = fft.ifft2(S_hat)
     G = fft.ifft2(G_hat)
-    P_G = real(fft.ifft2(P_G_hat))
-    return S/std(S[15::30,15::30]), G/std(G[15::30,15::30]), P_G / sum(P_G)
+    P_G = np.real(fft.ifft2(P_G_hat))
+    return S/np.std(S[15::30,15::30]), G/np.std(G[15::30,15::30]), P_G / np.sum(P_G)
 
 ################################################################################
 
@@ -3326,18 +5414,167 @@ def image_shift_fft(Image, DX, DY):
 
 ################################################################################
 
+def serve(spool_dir, telescope=None, nthreads=1, poll_time=1., **settings):
+
+    """Function that runs [optimal_subtraction] as a long-lived service
+    on the jobs submitted to the directory [spool_dir], so that the
+    cost of importing the modules, of planning the FFTs and of
+    processing the same reference image is not paid again for every
+    image pair.
+
+    A job is a JSON file with extension .job in [spool_dir] containing
+    the keyword arguments of [optimal_subtraction], at least new_fits
+    and ref_fits. Write it under a different name and rename it, so
+    that it is not picked up half-written. The job is claimed by
+    renaming it to .run, and renamed to .done or .failed when
+    finished.
+
+    [nthreads] jobs are processed concurrently, each with its own
+    [RunContext] built from [telescope] and [settings], but jobs with
+    the same ref_fits are processed one after the other, as they write
+    to the same files next to the reference image. All runs share a
+    [WarmCache], so that the seeing, WCS and PSF of a reference image
+    are only determined once, and the FFTW plans are kept alive
+    between jobs; the FFTW wisdom is saved in [spool_dir] for the next
+    session. Every [poll_time] seconds, the queue depth, the numbers
+    of jobs done and failed and their latency (from submission to
+    finish) are written to status.json in [spool_dir]. The service
+    stops, after finishing the claimed jobs, when a file named stop is
+    created in [spool_dir].
+
+    """
+
+    # keep the FFTW plans between jobs and start from the wisdom
+    # collected in previous sessions
+    pyfftw.interfaces.cache.set_keepalive_time(3600.)
+    wisdom_file = os.path.join(spool_dir, 'fftw_wisdom.pkl')
+    if os.path.isfile(wisdom_file):
+        with open(wisdom_file, 'rb') as f:
+            pyfftw.import_wisdom(pickle.load(f))
+
+    warm_cache = WarmCache()
+    ref_locks = {}
+    jobs = Queue.Queue()
+    stats = {'running': 0, 'done': 0, 'failed': 0,
+             'latency': collections.deque(maxlen=100),
+             'runtime': collections.deque(maxlen=100)}
+    stats_lock = threading.Lock()
+
+    def process(run_file):
+
+        t_submit = os.path.getmtime(run_file)
+        t_start = time.time()
+        with stats_lock:
+            stats['running'] += 1
+
+        try:
+            with open(run_file) as f:
+                kwargs = dict((str(key), str(value) if isinstance(value, unicode) else value)
+                              for key, value in json.load(f).items())
+            kwargs.pop('telescope', None)
+            ctx = RunContext(telescope, **settings)
+            ctx.warm_cache = warm_cache
+            if kwargs.get('use_existing_wcs'):
+                ctx.dosex = True
+            ref_lock = ref_locks.setdefault(os.path.abspath(kwargs['ref_fits']),
+                                            threading.Lock())
+            with ref_lock:
+                optimal_subtraction(ctx=ctx, **kwargs)
+            status = 'done'
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            status = 'failed'
+
+        os.rename(run_file, run_file[:-4]+'.'+status)
+        t_end = time.time()
+        with stats_lock:
+            stats['running'] -= 1
+            stats[status] += 1
+            stats['latency'].append(t_end - t_submit)
+            stats['runtime'].append(t_end - t_start)
+        print 'job {} {} in {:.1f}s, latency {:.1f}s'.format(run_file, status, t_end-t_start,
+                                                          t_end-t_submit)
+
+    def worker():
+        while True:
+            run_file = jobs.get()
+            if run_file is None:
+                return
+            process(run_file)
+
+    def write_status():
+        with stats_lock:
+            status = {'queue_depth': jobs.qsize(), 'running': stats['running'],
+                      'done': stats['done'], 'failed': stats['failed'],
+                      'warm_cache_hits': warm_cache.hits,
+                      'warm_cache_misses': warm_cache.misses,
+                      'warm_cache_bytes': warm_cache.nbytes,
+                      'time': time.time()}
+            if stats['latency']:
+                status['latency_last'] = stats['latency'][-1]
+                status['latency_mean'] = np.mean(stats['latency'])
+                status['runtime_mean'] = np.mean(stats['runtime'])
+        status_file = os.path.join(spool_dir, 'status.json')
+        with open(status_file+'_temp', 'w') as f:
+            json.dump(status, f, indent=1)
+        os.rename(status_file+'_temp', status_file)
+
+    threads = [threading.Thread(target=worker, name='zogy_worker{}'.format(i))
+               for i in range(nthreads)]
+    for thread in threads:
+        thread.start()
+
+    stop_file = os.path.join(spool_dir, 'stop')
+    try:
+        while not os.path.isfile(stop_file):
+            job_files = []
+            for job_file in glob.glob(os.path.join(spool_dir, '*.job')):
+                run_file = job_file[:-4]+'.run'
+                try:
+                    os.rename(job_file, run_file)
+                except OSError:
+                    # claimed by another service
+                    continue
+                job_files.append(run_file)
+            # oldest jobs first
+            for run_file in sorted(job_files, key=os.path.getmtime):
+                jobs.put(run_file)
+            write_status()
+            time.sleep(poll_time)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for thread in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+        with open(wisdom_file, 'wb') as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+        write_status()
+
+################################################################################
+
 def main():
     """Wrapper allowing optimal_subtraction to be run from the command line"""
     
     parser = argparse.ArgumentParser(description='Run optimal_subtraction on images')
-    parser.add_argument('new_fits', help='filename of new image')
-    parser.add_argument('ref_fits', help='filename of ref image')
+    parser.add_argument('new_fits', nargs='?', help='filename of new image')
+    parser.add_argument('ref_fits', nargs='?', help='filename of ref image')
     parser.add_argument('--ref_fits_remap', default=None, help='remapped ref image')
     parser.add_argument('--sub', default=None, help='sub image')
     parser.add_argument('--telescope', default=None, help='telescope')
     parser.add_argument('--log', default=None, help='help')
+    parser.add_argument('--spool', default=None,
+                        help='run as a service on the jobs submitted to this directory')
+    parser.add_argument('--nthreads', type=int, default=1,
+                        help='number of jobs processed concurrently by the service')
 
     args = parser.parse_args()
+    if args.spool is not None:
+        serve(args.spool, telescope=args.telescope, nthreads=args.nthreads)
+        return
+    if args.new_fits is None or args.ref_fits is None:
+        parser.error('new_fits and ref_fits are required unless --spool is given')
     optimal_subtraction(args.new_fits, args.ref_fits, args.ref_fits_remap, args.sub, args.telescope, args.log)
         
 if __name__ == "__main__":